@@ -0,0 +1,268 @@
+"""
+Benchmarks of the conversion, clean and proofreading functions.
+
+Usage:
+    python benchmarks/bench.py [options]
+
+Options:
+    --chapters N, --paragraphs N, --cjk-ratio R, --depth N, --seed N:
+        options of the generated corpus, see corpus.py.
+
+    --corpus PATH: use an existing ebook repository instead of generating one.
+
+    --repeat N: timed runs of each benchmark, the fastest counts, default 3.
+
+    --only NAME[,NAME...]: run only these benchmarks.
+
+    --output PATH: write the results as JSON to PATH.
+
+    --compare PATH: compare the throughput with the JSON results of an earlier run.
+
+    --json: print the results as JSON instead of a table.
+
+Every benchmark reports the characters it handled per second and the peak
+Python memory of one extra run under tracemalloc. Memory allocated inside
+lxml and OpenCC is not seen by tracemalloc.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import tempfile
+import tracemalloc
+import subprocess
+import contextlib
+from unittest import mock
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+# pr.py and clean.py import their siblings by bare name, the siblings import each other relatively
+import proofreading.data, proofreading.utils
+sys.modules.setdefault('data', proofreading.data)
+sys.modules.setdefault('utils', proofreading.utils)
+sys.path.insert(1, os.path.join(root, 'proofreading'))
+
+import clean
+import pr
+import chinese_convert
+from proofreading import data, utils
+from proofreading.discovery import FileIndex
+from corpus import generate_corpus, parse_options, corpus_options
+
+# Same files as chinese_convert.main
+convert_patterns = [
+    "images/*.svg",
+    "src/epub/content.opf",
+    "src/epub/toc.xhtml",
+    "src/epub/text/*.xhtml"
+]
+
+class Benchmark:
+    """One benchmark, setup runs before every run and is not timed."""
+
+    def __init__(self, name, run, chars, setup=None):
+        self.name = name
+        self.run = run
+        self.chars = chars
+        self.setup = setup
+
+def get_text_nodes(file_paths):
+    """Get the (text, lang) of every text node in the files, lang inherited from xml:lang."""
+    from lxml import etree
+    xml_lang = '{http://www.w3.org/XML/1998/namespace}lang'
+    nodes = []
+    for file_path in file_paths:
+        tree = etree.parse(file_path)
+
+        def walk(element, lang):
+            lang = element.get(xml_lang, lang)
+            if element.text:
+                nodes.append((element.text, lang))
+            for child in element:
+                if isinstance(child.tag, str):
+                    walk(child, lang)
+                if child.tail:
+                    nodes.append((child.tail, lang))
+
+        walk(tree.getroot(), '')
+    return nodes
+
+def get_file_chars(file_paths):
+    chars = 0
+    for file_path in file_paths:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            chars += len(f.read())
+    return chars
+
+def get_benchmarks(corpus_path, work_path):
+    index = FileIndex(corpus_path)
+    convert_paths = [entry.path for pattern in convert_patterns for entry in index.match(pattern)]
+    html_paths = [entry.path for entry in index.select(data.html_like_extensions)]
+    nodes = get_text_nodes(html_paths)
+    node_chars = sum(len(text) for text, _ in nodes)
+    convert_chars = get_file_chars(convert_paths)
+    html_chars = get_file_chars(html_paths)
+    benchmarks = []
+
+    def run_convert_text():
+        for text, _ in nodes:
+            chinese_convert.convert_text(text, 't2s')
+
+    def run_convert_texts():
+        chinese_convert.convert_texts([text for text, _ in nodes], 't2s')
+
+    def run_convert_file(stream=False):
+        output_path = os.path.join(work_path, 'convert')
+        for file_path in convert_paths:
+            chinese_convert.convert_file(file_path, corpus_path, output_path, 't2s', stream)
+
+    # The conversion cache is emptied before each run, except for convert_texts.cached
+    clear_cache = chinese_convert.conversion_cache.clear
+    benchmarks += [
+        Benchmark("convert_text", run_convert_text, node_chars, clear_cache),
+        Benchmark("convert_texts", run_convert_texts, node_chars, clear_cache),
+        Benchmark("convert_texts.cached", run_convert_texts, node_chars, run_convert_texts),
+        Benchmark("convert_file", run_convert_file, convert_chars, clear_cache),
+        Benchmark("convert_file.stream", lambda: run_convert_file(True), convert_chars, clear_cache),
+    ]
+
+    # Each clean rule on its own, on the text nodes
+    for name, rule in clean.clean_rules.items():
+
+        def run_rule(handler=rule.handler):
+            for text, lang in nodes:
+                handler(text, lang, 1, corpus_path, True)  # auto only, never prompt
+
+        benchmarks.append(Benchmark(f"clean.{name}", run_rule, node_chars))
+
+    # All clean rules on a fresh copy of the files, with parsing and writing
+    clean_path = os.path.join(work_path, 'clean')
+    clean_rules = list(clean.clean_rules.values())
+
+    def setup_process_file():
+        shutil.rmtree(clean_path, ignore_errors=True)
+        shutil.copytree(corpus_path, clean_path)
+
+    def run_process_file():
+        # Prompt entries of text_replace are answered with no, a real corpus may have them
+        with contextlib.redirect_stdout(io.StringIO()), mock.patch.object(utils, 'get_single_keypress', return_value='n'):
+            for file_path in html_paths:
+                copy_path = os.path.join(clean_path, os.path.relpath(file_path, corpus_path))
+                clean.process_file(clean_rules, copy_path)
+
+    benchmarks.append(Benchmark("clean.process_file", run_process_file, html_chars, setup_process_file))
+
+    # pr.review_session shows the findings on screen, check_file does the same work without it
+    for rule in pr.pr_rules.values():
+        rule_paths = [entry.path for entry in index.select_rule(rule)]
+        rule_chars = get_file_chars(rule_paths)
+        for stream in [False, True]:
+
+            def run_check(rule=rule, rule_paths=rule_paths, stream=stream):
+                for file_path in rule_paths:
+                    pr.check_file(rule, file_path, stream)
+
+            name = f"pr.{rule.name}" + (".stream" if stream else "")
+            benchmarks.append(Benchmark(name, run_check, rule_chars))
+
+    return benchmarks
+
+def measure(benchmark, repeat):
+    """Get the fastest time of repeat runs and the peak memory of one more run."""
+    seconds = None
+    for _ in range(repeat):
+        if benchmark.setup:
+            benchmark.setup()
+        start = time.perf_counter()
+        benchmark.run()
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+    if benchmark.setup:
+        benchmark.setup()
+    tracemalloc.start()
+    benchmark.run()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "chars": benchmark.chars,
+        "seconds": round(seconds, 6),
+        "chars_per_second": round(benchmark.chars / seconds) if seconds else None,
+        "peak_bytes": peak_bytes,
+    }
+
+def get_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+def print_table(results, previous=None):
+    print(f"{'benchmark':32} {'chars/s':>12} {'seconds':>9} {'peak MiB':>9}" + (f" {'change':>8}" if previous else ''))
+    for name, result in results.items():
+        line = f"{name:32} {result['chars_per_second'] or 0:12,} {result['seconds']:9.4f} {result['peak_bytes'] / (1 << 20):9.2f}"
+        if previous:
+            old = previous.get(name)
+            if old and old.get("chars_per_second") and result["chars_per_second"]:
+                line += f" {result['chars_per_second'] / old['chars_per_second'] - 1:+8.1%}"
+            else:
+                line += f" {'new':>8}"
+        print(line)
+
+def main():
+    args = sys.argv[1:]
+    if "-h" in args or "--help" in args:
+        print(__doc__.strip())
+        return
+
+    options = parse_options(args, dict(corpus_options, repeat=3))
+    repeat = options.pop("repeat")
+    paths = parse_options(args, {"corpus": "", "only": "", "output": "", "compare": ""})
+    output_json = "--json" in args
+
+    previous = None
+    if paths["compare"]:
+        with open(paths["compare"], 'r', encoding='utf-8') as f:
+            previous = json.load(f)["results"]
+
+    with tempfile.TemporaryDirectory(prefix="proofreading-bench-") as work_path:
+        corpus_path = paths["corpus"]
+        if not corpus_path:
+            corpus_path = os.path.join(work_path, 'corpus')
+            generate_corpus(corpus_path, **options)
+
+        benchmarks = get_benchmarks(corpus_path, work_path)
+        if paths["only"]:
+            names = paths["only"].split(',')
+            benchmarks = [benchmark for benchmark in benchmarks if benchmark.name in names]
+
+        results = {}
+        for benchmark in benchmarks:
+            results[benchmark.name] = measure(benchmark, repeat)
+            if not output_json:
+                print(f"{benchmark.name} done", file=sys.stderr)
+
+    report = {
+        "commit": get_commit(),
+        "python": sys.version.split()[0],
+        "corpus": paths["corpus"] or options,
+        "repeat": repeat,
+        "results": results,
+    }
+
+    if paths["output"]:
+        with open(paths["output"], 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+    if output_json:
+        print(json.dumps(report, ensure_ascii=False, indent=1))
+    else:
+        print_table(results, previous)
+
+if __name__ == "__main__":
+    main()
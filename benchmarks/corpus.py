@@ -0,0 +1,245 @@
+"""
+Generator of synthetic ebook repositories in the Standard Ebooks layout.
+
+Usage:
+    python benchmarks/corpus.py [options] <directory>
+
+Options:
+    --chapters N: number of chapter files, default 10.
+
+    --paragraphs N: paragraphs per chapter, default 200.
+
+    --cjk-ratio R: share of the text segments in Chinese, from 0 to 1, default 0.8.
+
+    --depth N: nesting depth of sections and inline tags, default 2.
+
+    --seed N: random seed, the same options and seed give the same corpus, default 0.
+
+Files generated:
+    - images/cover.svg
+    - src/epub/content.opf
+    - src/epub/toc.xhtml
+    - src/epub/text/chapter-*.xhtml
+
+The text has what the rules look for: half-width punctuation after Chinese,
+spaces between Chinese and Latin, spaced numbers, auto replace entries of
+data.text_replace, noteref anchors and lines without end punctuation.
+"""
+
+import os
+import sys
+import random
+from xml.sax.saxutils import escape
+
+# Common characters, without the prompt entries of text_replace so clean.py never asks
+cjk_chars = (
+    "的是不了人我在有他這中大來上個國到說們為子和你地出道也時年得就那要下以生會自去之過家學對可她"
+    "裡後小麼心多天而能好都然沒日於起還發成事只作當想看文無開手十用主行方又如前所本見經頭面公同三"
+    "已老從動兩長知民樣現分將外但身些與高意進把法此實回二理美點月明其種聲全工己話兒者向情部正名定"
+    "女問力機給等幾很業最間新什打便位因重被走電四第門相次東政海口使教西再平真聽世氣信北少關並內加"
+    "化由卻代軍產入先山五太水萬市眼體別處總才場師書比住員九笑性通目華報立馬命張活難神數件安表原車"
+)
+# Auto entries of text_replace, kept rare like in real books
+replace_chars = "晩硏槪尙値鄕倂処関濶敍塡郷髪"
+latin_words = (
+    "the of and to in is was he for it with as his on be at by had not are but from or have an they which "
+    "one you were her all she there would their we him been has when who will more no if out so said what"
+).split()
+zh_punct = "，。、；：！？"
+half_width_punct = [",", ";", "?", "!"]
+inline_tags = ["span", "em", "b", "i"]
+line_ends = "。！？」』"
+
+def generate_segment(rng, cjk_ratio):
+    """Get one run of text: Chinese, Latin words or a number, with the spacing mistakes the rules fix."""
+    roll = rng.random()
+    if roll < cjk_ratio:
+        text = ''.join(rng.choice(cjk_chars) for _ in range(rng.randint(2, 12)))
+        if rng.random() < 0.05:
+            position = rng.randint(0, len(text))
+            text = text[:position] + rng.choice(replace_chars) + text[position:]
+        if rng.random() < 0.3:
+            text += rng.choice(zh_punct)
+        elif rng.random() < 0.1:
+            text += rng.choice(half_width_punct)
+        return text
+    elif roll < cjk_ratio + (1 - cjk_ratio) * 0.85:
+        return ' '.join(rng.choice(latin_words) for _ in range(rng.randint(1, 5)))
+    elif rng.random() < 0.5:
+        return f"{rng.randint(1, 999)} . {rng.randint(0, 99)}"
+    return ' '.join(str(rng.randint(0, 9)) for _ in range(rng.randint(2, 4)))
+
+def generate_sentence(rng, cjk_ratio):
+    segments = [generate_segment(rng, cjk_ratio) for _ in range(rng.randint(2, 8))]
+    text = ''
+    for segment in segments:
+        text += rng.choice(['', '', ' ', '  ']) + segment
+    if rng.random() < 0.1:
+        text = f"({text.strip()})"
+    return text.strip()
+
+def generate_inline(rng, cjk_ratio, depth):
+    """Get the markup of a run of sentences, nested in inline tags up to depth."""
+    pieces = []
+    for _ in range(rng.randint(1, 3)):
+        text = escape(generate_sentence(rng, cjk_ratio))
+        if depth > 0 and rng.random() < 0.4:
+            tag = rng.choice(inline_tags)
+            inner = generate_inline(rng, cjk_ratio, depth - 1)
+            attributes = ' xml:lang="en-GB"' if tag == "i" else ''
+            pieces.append(f"{text}<{tag}{attributes}>{inner}</{tag}>")
+        else:
+            pieces.append(text)
+    return ''.join(pieces)
+
+def generate_paragraph(rng, cjk_ratio, depth, note_id):
+    content = generate_inline(rng, cjk_ratio, depth)
+    if rng.random() < 0.85:
+        content += rng.choice(line_ends)  # the others are findings of punctuation_line_end
+    if note_id:
+        content += f'<a href="endnotes.xhtml#note-{note_id}" id="noteref-{note_id}" epub:type="noteref">{note_id}</a>'
+    return f"<p>{content}</p>"
+
+def generate_title(rng, number):
+    return f"第{number}章 " + ''.join(rng.choice(cjk_chars) for _ in range(rng.randint(2, 6)))
+
+def generate_chapter(rng, number, title, paragraphs, cjk_ratio, depth):
+    lines = [
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" '
+        'epub:prefix="z3998: http://www.daisy.org/z3998/2012/vocab/structure/" xml:lang="zh-Hant">',
+        '\t<head>',
+        f'\t\t<title>{escape(title)}</title>',
+        '\t\t<link href="../css/core.css" rel="stylesheet" type="text/css"/>',
+        '\t</head>',
+        '\t<body epub:type="bodymatter z3998:fiction">',
+    ]
+
+    # Nested sections, the paragraphs are spread over the innermost ones
+    section_depth = max(depth, 1)
+    for level in range(section_depth):
+        indent = '\t' * (level + 2)
+        section_id = f"chapter-{number}-{level}" if level else f"chapter-{number}"
+        lines.append(f'{indent}<section id="{section_id}" epub:type="chapter">')
+        lines.append(f'{indent}\t<h{min(level + 2, 6)} epub:type="title">{escape(title)}</h{min(level + 2, 6)}>')
+
+    indent = '\t' * (section_depth + 2)
+    note_id = 0
+    for _ in range(paragraphs):
+        if rng.random() < 0.05:
+            note_id += 1
+            lines.append(indent + generate_paragraph(rng, cjk_ratio, depth, note_id))
+        else:
+            lines.append(indent + generate_paragraph(rng, cjk_ratio, depth, None))
+        if rng.random() < 0.02:
+            lines.append(indent + '<hr/>')
+
+    for level in reversed(range(section_depth)):
+        lines.append('\t' * (level + 2) + '</section>')
+    lines += ['\t</body>', '</html>', '']
+    return '\n'.join(lines)
+
+def generate_toc(titles):
+    lines = [
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="zh-Hant">',
+        '\t<head>',
+        '\t\t<title>目錄</title>',
+        '\t</head>',
+        '\t<body epub:type="frontmatter">',
+        '\t\t<nav id="toc" epub:type="toc">',
+        '\t\t\t<h2 epub:type="title">目錄</h2>',
+        '\t\t\t<ol>',
+    ]
+    for number, title in enumerate(titles, 1):
+        lines.append(f'\t\t\t\t<li><a href="text/chapter-{number}.xhtml">{escape(title)}</a></li>')
+    lines += ['\t\t\t</ol>', '\t\t</nav>', '\t</body>', '</html>', '']
+    return '\n'.join(lines)
+
+def generate_opf(book_title, chapters):
+    lines = [
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<package xmlns="http://www.idpf.org/2007/opf" dir="ltr" unique-identifier="uid" version="3.0" xml:lang="zh-Hant">',
+        '\t<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">',
+        f'\t\t<dc:title id="title">{escape(book_title)}</dc:title>',
+        '\t\t<dc:language>zh-Hant</dc:language>',
+        '\t</metadata>',
+        '\t<manifest>',
+        '\t\t<item href="toc.xhtml" id="toc.xhtml" media-type="application/xhtml+xml" properties="nav"/>',
+    ]
+    for number in range(1, chapters + 1):
+        lines.append(f'\t\t<item href="text/chapter-{number}.xhtml" id="chapter-{number}.xhtml" media-type="application/xhtml+xml"/>')
+    lines += ['\t</manifest>', '\t<spine>']
+    for number in range(1, chapters + 1):
+        lines.append(f'\t\t<itemref idref="chapter-{number}.xhtml"/>')
+    lines += ['\t</spine>', '</package>', '']
+    return '\n'.join(lines)
+
+def generate_cover(book_title):
+    return '\n'.join([
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" viewBox="0 0 1400 2100">',
+        f'\t<title>封面：{escape(book_title)}</title>',
+        f'\t<text x="700" y="600">{escape(book_title)}</text>',
+        '</svg>',
+        '',
+    ])
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+def generate_corpus(path, chapters=10, paragraphs=200, cjk_ratio=0.8, depth=2, seed=0):
+    """Write a synthetic ebook repository to path, returns the paths of the files written."""
+    rng = random.Random(seed)
+    book_title = ''.join(rng.choice(cjk_chars) for _ in range(4))
+    titles = [generate_title(rng, number) for number in range(1, chapters + 1)]
+
+    files = {
+        os.path.join(path, "images", "cover.svg"): generate_cover(book_title),
+        os.path.join(path, "src", "epub", "content.opf"): generate_opf(book_title, chapters),
+        os.path.join(path, "src", "epub", "toc.xhtml"): generate_toc(titles),
+    }
+    for number, title in enumerate(titles, 1):
+        chapter_path = os.path.join(path, "src", "epub", "text", f"chapter-{number}.xhtml")
+        files[chapter_path] = generate_chapter(rng, number, title, paragraphs, cjk_ratio, depth)
+
+    for file_path, content in files.items():
+        write_file(file_path, content)
+    return list(files)
+
+def parse_options(args, options):
+    """Take the --name value pairs of options out of args, converted with the type of the default."""
+    values = dict(options)
+    for name, default in options.items():
+        flag = "--" + name.replace('_', '-')
+        if flag in args:
+            idx = args.index(flag)
+            try:
+                values[name] = type(default)(args[idx + 1])
+            except (IndexError, ValueError):
+                print(f"Invalid {flag} value.")
+                sys.exit(1)
+            del args[idx:idx + 2]
+    return values
+
+corpus_options = {"chapters": 10, "paragraphs": 200, "cjk_ratio": 0.8, "depth": 2, "seed": 0}
+
+def main():
+    args = sys.argv[1:]
+    if "-h" in args or "--help" in args:
+        print(__doc__.strip())
+        return
+
+    options = parse_options(args, corpus_options)
+    if len(args) != 1:
+        print("Usage: python corpus.py [--chapters N] [--paragraphs N] [--cjk-ratio R] [--depth N] [--seed N] <directory>")
+        sys.exit(1)
+
+    file_paths = generate_corpus(args[0], **options)
+    size = sum(os.path.getsize(file_path) for file_path in file_paths)
+    print(f"{len(file_paths)} files, {size} bytes written to {args[0]}")
+
+if __name__ == "__main__":
+    main()
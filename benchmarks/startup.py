@@ -0,0 +1,83 @@
+"""
+Cold-start time of the pr, clean and convert entry points.
+
+Usage:
+    python benchmarks/startup.py [--runs N] [--json]
+
+Each entry point is started N times (default 10) in a fresh interpreter
+with --help, so only the time to import and parse the arguments is
+measured. The median and the fastest run are printed in milliseconds.
+
+pr.py and clean.py import their siblings by bare name while the siblings
+import each other relatively, so they are started through a launcher that
+loads the proofreading package first, the same way the editor hooks do.
+"""
+
+import os
+import sys
+import json
+import time
+import statistics
+import subprocess
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+launcher = """
+import sys, runpy, importlib
+sys.path.insert(0, {root!r})
+for name in ["data", "utils"]:
+    sys.modules[name] = importlib.import_module("proofreading." + name)
+sys.path.insert(1, {script_dir!r})
+script = sys.argv[1]
+sys.argv = sys.argv[1:]
+runpy.run_path(script, run_name="__main__")
+"""
+
+def get_script_args(script):
+    script_dir = os.path.join(root, "proofreading")
+    code = launcher.format(root=root, script_dir=script_dir)
+    return ["-c", code, os.path.join(script_dir, script), "--help"]
+
+entry_points = {
+    "pr": get_script_args("pr.py"),
+    "clean": get_script_args("clean.py"),
+    "convert": [os.path.join(root, "chinese_convert.py"), "--help"],
+}
+
+def time_entry_point(args, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=root, stdout=subprocess.DEVNULL, check=True)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def main():
+    args = sys.argv[1:]
+    runs = 10
+    if "--runs" in args:
+        idx = args.index("--runs")
+        try:
+            runs = int(args[idx + 1])
+        except (IndexError, ValueError):
+            print("Invalid --runs value, it should be a number.")
+            sys.exit(1)
+
+    # Baseline: an interpreter that does nothing
+    results = {"python": time_entry_point(["-c", "pass"], runs)}
+    for name, entry_args in entry_points.items():
+        results[name] = time_entry_point(entry_args, runs)
+
+    summary = {
+        name: {"median_ms": round(statistics.median(timings), 1), "min_ms": round(min(timings), 1)}
+        for name, timings in results.items()
+    }
+
+    if "--json" in args:
+        print(json.dumps({"runs": runs, "python": sys.version.split()[0], "results": summary}, indent=1))
+    else:
+        for name, result in summary.items():
+            print(f"{name:8} median {result['median_ms']:7.1f} ms  min {result['min_ms']:7.1f} ms")
+
+if __name__ == "__main__":
+    main()
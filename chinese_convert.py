@@ -2,7 +2,7 @@
 Script to Convert Text between Traditional Chinese and Simplified Chinese in XML, XHTML, and SVG Files.
 
 Usage:
-    python my.py <t2s|s2t> <input_directory> <output_directory>
+    python my.py [--jobs N] <t2s|s2t> <input_directory> <output_directory>
 
 Arguments:
     t2s|s2t: Conversion direction. 
@@ -13,6 +13,20 @@ Arguments:
 
     output_directory: Path for converted files.
 
+    --jobs N: Convert files in N worker processes, default 1.
+
+    --force: Convert all files even if the manifest says they are up to date.
+
+    --cache PATH: Keep the converted texts in an SQLite file at PATH, texts converted in an earlier
+              run are taken from it. Within a run they are always kept in memory.
+
+    --stream: Convert every file with the chunked scanner instead of a parsed tree, memory stays
+              bounded whatever the file size. Files of 32 MiB or more are always streamed.
+
+    --stats: Print the time of each phase and the counters of the run.
+
+    --stats-json PATH: Same as --stats, also write them to PATH as JSON.
+
 Files Processed:
     - images/*.svg
     - src/epub/content.opf
@@ -24,14 +38,16 @@ Features:
     - Skips lines that don't contain any Chinese characters.
     - Adjusts the "xml:lang" attribute in the tags based on the conversion direction.
     - Keeps the original spacing and formatting, converting Chinese text only.
+    - Keeps a manifest in the output directory, only converts files whose source, direction,
+      OpenCC config, text_replace table or converter version changed, and removes outputs of
+      deleted sources, also with --force.
 
 Dependencies:
     - OpenCC
-    - beautifulsoup4
     - lxml
 
 Install Dependencies:
-    pip install OpenCC beautifulsoup4 lxml
+    pip install OpenCC lxml
 """
 
 # Todo:
@@ -39,35 +55,140 @@ Install Dependencies:
 
 import sys
 import os
-from opencc import OpenCC
-from bs4 import BeautifulSoup
-import glob, re
-from proofreading.utils import replace_text
-from proofreading.data import zh_chars
+import re
+import json, hashlib
+from functools import lru_cache
+from proofreading.utils import replace_text, get_text_replace_hash, get_jobs
+from proofreading.stats import stats
+from proofreading.data import char_classifier
+from proofreading.discovery import FileIndex
+from proofreading.cache import ConversionCache, get_namespace
+from proofreading.dictionary import list_dictionaries
+from proofreading.scanner import iter_tokens
+
+# OpenCC, lxml (parsing) and the process pool are imported where they are used, keeps startup fast
+
+# Do not use tw2sp or s2twp cause high volume of error.
+opencc_configs = {
+    "t2s": ("t2s.json", "zh-Hans"),
+    "s2t": ("s2t.json", "zh-Hant"),
+}
+
+# Private use character to join texts for batched conversion, OpenCC keeps it as is.
+batch_separator = '\ue000'
+batch_size = 1 << 20  # characters per OpenCC call
+stream_threshold = 32 << 20  # files of this many bytes or more are converted with convert_file_stream
+
+# Manifest of converted files, kept in the output directory
+manifest_name = ".convert-manifest.json"
+manifest_version = 1
+# Increase converter_version when the output of a conversion changes, every file is converted again.
+converter_version = 2
+
+# Conversions of the process, main adds the SQLite tier with --cache PATH
+conversion_cache = ConversionCache()
 
 def contains_chinese_character(text):
-    result = bool(re.search(zh_chars, text))
-    return result
+    return char_classifier.contains(text, 'zh')
 
-def convert_text(text, direction):
-    # Do not use tw2sp or s2twp cause high volume of error.
-    if direction == "t2s":
-        lang_dest = "zh-Hans"
-        converter = OpenCC('t2s.json')
-    elif direction == "s2t":
-        lang_dest = "zh-Hant"
-        converter = OpenCC('s2t.json')
-    else:
+@lru_cache(maxsize=None)
+def get_converter(config):
+    """Get the OpenCC converter for config, loaded once per process."""
+    from opencc import OpenCC
+    return OpenCC(config)
+
+def get_direction_config(direction):
+    """Get the OpenCC config and destination lang of a conversion direction."""
+    if direction not in opencc_configs:
         raise ValueError(f"Invalid conversion direction: {direction}")
-    
+    return opencc_configs[direction]
+
+def convert_text(text, direction):
+    config, lang_dest = get_direction_config(direction)
+
     # Todo:
-    #   - Better way interact with OpenCC.
     #   - More accurate lang detection.
     #   - Disable edit in function replace_text.
-    if contains_chinese_character(text):
-        text = converter.convert(text)
-    text = replace_text(text, lang_dest, 1, "/", True)  # pass fake line number and file path here
-    return text
+    if not contains_chinese_character(text):
+        return replace_text(text, lang_dest, 1, "/", True)  # pass fake line number and file path here
+
+    namespace = get_cache_namespace(direction)
+    converted = conversion_cache.get(namespace, text)
+    if converted is None:
+        converted = replace_text(get_converter(config).convert(text), lang_dest, 1, "/", True)
+        conversion_cache.put(namespace, text, converted)
+    return converted
+
+def convert_batches(converter, texts, file_path=None):
+    """
+    Convert texts with OpenCC in as few calls as possible.
+
+    Texts are joined with batch_separator and converted in batches of
+    about batch_size characters, then split back.
+    """
+    results = []
+    start = 0
+    while start < len(texts):
+        # Take texts until the batch is full, at least one per batch
+        end = start + 1
+        length = len(texts[start])
+        while end < len(texts) and length + len(texts[end]) < batch_size:
+            length += len(texts[end]) + 1
+            end += 1
+        batch_texts = texts[start:end]
+        start = end
+
+        converted = None
+        with stats.timer("convert.opencc", file_path):
+            if not any(batch_separator in text for text in batch_texts):
+                converted = converter.convert(batch_separator.join(batch_texts)).split(batch_separator)
+            if converted is None or len(converted) != len(batch_texts):
+                # Fall back to one call per text
+                converted = [converter.convert(text) for text in batch_texts]
+        results.extend(converted)
+    return results
+
+@lru_cache(maxsize=None)
+def get_cache_namespace(direction):
+    """Get the cache namespace of a direction, changes with its OpenCC config and the text_replace table."""
+    config, _ = get_direction_config(direction)
+    return get_namespace(direction, config, get_text_replace_hash())
+
+def convert_texts(texts, direction, file_path=None):
+    """
+    Convert a list of texts with as few OpenCC calls as possible.
+
+    Each distinct text with Chinese characters is converted once, and only
+    if conversion_cache does not have it yet. Returns the converted texts
+    in the same order, file_path is only used for the stats.
+    """
+    config, lang_dest = get_direction_config(direction)
+
+    results = list(texts)
+    pending = [idx for idx, text in enumerate(results) if contains_chinese_character(text)]
+    stats.count("convert.opencc_texts", len(pending))
+
+    if pending:
+        namespace = get_cache_namespace(direction)
+        unique = list(dict.fromkeys(results[idx] for idx in pending))
+        with stats.timer("convert.cache", file_path):
+            found = conversion_cache.get_many(namespace, unique)
+        missing = [text for text in unique if text not in found]
+        if missing:
+            converted = convert_batches(get_converter(config), missing, file_path)
+            with stats.timer("convert.replace_text", file_path):
+                converted = [replace_text(text, lang_dest, 1, "/", True) for text in converted]  # pass fake line number and file path here
+            conversions = dict(zip(missing, converted))
+            with stats.timer("convert.cache", file_path):
+                conversion_cache.put_many(namespace, conversions)
+            found.update(conversions)
+        for idx in pending:
+            results[idx] = found[results[idx]]
+
+    # Texts without Chinese characters only go through replace_text
+    pending = set(pending)
+    with stats.timer("convert.replace_text", file_path):
+        return [text if idx in pending else replace_text(text, lang_dest, 1, "/", True) for idx, text in enumerate(results)]
 
 def get_output_path(file_path, input_dir, output_dir):
     # Get the relative path of the file to the input directory
@@ -75,46 +196,263 @@ def get_output_path(file_path, input_dir, output_dir):
     # Combine the output directory with this relative path
     return os.path.join(output_dir, relative_path)
 
-def convert_file(file_path, input_dir, output_dir, direction):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        content = f.read()
+def convert_file(file_path, input_dir, output_dir, direction, stream=None):
+    """
+    Convert a file into output_dir, at the same path relative to input_dir.
 
-        # Determine the parser based on the file extension
-        if file_path.endswith('.xhtml'):
-            parser = 'lxml'
-        else:
-            parser = 'xml'
+    With stream, or if stream is None and the file is larger than
+    stream_threshold, the file is converted with convert_file_stream.
+    """
+    if stream is None:
+        stream = os.path.getsize(file_path) >= stream_threshold
+    if stream:
+        return convert_file_stream(file_path, input_dir, output_dir, direction)
+
+    from proofreading.parsing import parse, iter_text_nodes, get_lang, set_lang
+
+    with stats.timer("convert.read", file_path):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
 
-        soup = BeautifulSoup(content, parser)
+    # XML, XHTML and SVG are parsed the same way, as XML if well-formed
+    with stats.timer("convert.parse", file_path):
+        document = parse(content)
 
-        # Iterate through text in XML, XHTML, SVG and convert
-        for text in soup.find_all(string=True):
-            text.replace_with(convert_text(text, direction))
+    # Convert all text in XML, XHTML, SVG at once
+    nodes = [node for node in iter_text_nodes(document.root, skip_note_anchors=False) if not node.is_comment]
+    changed = 0
+    for node, converted in zip(nodes, convert_texts([node.text for node in nodes], direction, file_path)):
+        if converted != node.text:
+            node.replace(converted)
+            changed += 1
 
-        # Adjust xml:lang attribute
-        if direction == "t2s":
-            for tag in soup.find_all(attrs={"xml:lang": "zh-Hant"}):
-                tag['xml:lang'] = "zh-Hans"
-        elif direction == "s2t":
-            for tag in soup.find_all(attrs={"xml:lang": "zh-Hans"}):
-                tag['xml:lang'] = "zh-Hant"
+    # Adjust xml:lang attribute
+    _, lang_dest = get_direction_config(direction)
+    lang_source = {"zh-Hans": "zh-Hant", "zh-Hant": "zh-Hans"}[lang_dest]
+    for element in document.root.iter():
+        if isinstance(element.tag, str) and get_lang(element) == lang_source:
+            set_lang(element, lang_dest)
 
-        # Write to output file
-        output_path = get_output_path(file_path, input_dir, output_dir)
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with stats.timer("convert.serialize", file_path):
+        output = document.serialize()
+
+    # Write to output file
+    output_path = get_output_path(file_path, input_dir, output_dir)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with stats.timer("convert.write", file_path):
         with open(output_path, 'w', encoding='utf-8') as out_f:
-            out_f.write(str(soup))
+            out_f.write(output)
+
+    if stats.enabled:
+        stats.count("convert.files")
+        stats.count("convert.nodes_visited", len(nodes))
+        stats.count("convert.nodes_changed", changed)
+        stats.count("convert.bytes_read", len(content.encode('utf-8')))
+        stats.count("convert.bytes_written", len(output.encode('utf-8')))
+
+def get_lang_replace(direction):
+    """Get the re.sub callback that swaps the xml:lang of a start tag to the destination lang."""
+    _, lang_dest = get_direction_config(direction)
+    lang_source = {"zh-Hans": "zh-Hant", "zh-Hant": "zh-Hans"}[lang_dest]
+
+    def lang_replace(match):
+        if match.group(3) != lang_source:
+            return match.group()
+        return match.group(1) + match.group(2) + lang_dest + match.group(2)
+    return lang_replace
+
+lang_attribute_pattern = re.compile(r'(\sxml:lang\s*=\s*)(["\'])([^"\']*)\2')
+
+def convert_file_stream(file_path, input_dir, output_dir, direction):
+    """
+    Convert a file without parsing it, with memory bounded whatever the file size.
+
+    The source is read in chunks and split into markup and text by the
+    scanner, texts are converted in batches of about batch_size characters
+    and written out with the markup between them as it is. Unlike
+    convert_file, the output keeps the markup exactly as written, and
+    character references are not decoded before the conversion.
+    """
+
+    lang_replace = get_lang_replace(direction)
+    output_path = get_output_path(file_path, input_dir, output_dir)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    pieces = []  # markup, or the index of a text in texts
+    texts = []
+    size = 0
+    counts = {"nodes": 0, "changed": 0, "bytes_written": 0}
+
+    def flush(out_f):
+        converted = convert_texts(texts, direction, file_path)
+        output = ''.join(piece if isinstance(piece, str) else converted[piece] for piece in pieces)
+        out_f.write(output)
+        if stats.enabled:
+            counts["nodes"] += len(texts)
+            counts["changed"] += sum(1 for text, new_text in zip(texts, converted) if text != new_text)
+            counts["bytes_written"] += len(output.encode('utf-8'))
+        pieces.clear()
+        texts.clear()
+
+    with stats.timer("convert.stream", file_path):
+        with open(file_path, 'r', encoding='utf-8', newline='') as f, \
+                open(output_path, 'w', encoding='utf-8', newline='') as out_f:
+            for kind, token in iter_tokens(f):
+                if kind != 'markup':
+                    pieces.append(len(texts))
+                    texts.append(token)
+                elif 'xml:lang' in token and token[1:2] not in ('/', '!', '?'):
+                    pieces.append(lang_attribute_pattern.sub(lang_replace, token))
+                else:
+                    pieces.append(token)
+                size += len(token)
+                if size >= batch_size:
+                    flush(out_f)
+                    size = 0
+            flush(out_f)
+
+    if stats.enabled:
+        stats.count("convert.files")
+        stats.count("convert.files_streamed")
+        stats.count("convert.nodes_visited", counts["nodes"])
+        stats.count("convert.nodes_changed", counts["changed"])
+        stats.count("convert.bytes_read", os.path.getsize(file_path))
+        stats.count("convert.bytes_written", counts["bytes_written"])
+
+def get_file_hash(file_path):
+    """Hash a file in blocks, large files are not read into memory at once."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest(output_dir):
+    """Load the manifest of output_dir, empty if missing, unreadable or of another version."""
+    try:
+        with open(os.path.join(output_dir, manifest_name), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != manifest_version:
+        return {}
+    return manifest.get("files", {})
+
+def save_manifest(output_dir, files):
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, manifest_name)
+    with open(manifest_path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump({"version": manifest_version, "files": files}, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+def get_manifest_entry(file_entry, direction, old_entry=None):
+    """
+    Build the manifest entry of a source file from its FileIndex entry.
+
+    The source hash is reused from old_entry when size and mtime did not change.
+    """
+    if old_entry and old_entry.get("size") == file_entry.size and old_entry.get("mtime_ns") == file_entry.mtime_ns:
+        source_hash = old_entry["source_hash"]
+    else:
+        source_hash = get_file_hash(file_entry.path)
+
+    config, _ = get_direction_config(direction)
+    return {
+        "source_hash": source_hash,
+        "direction": direction,
+        "config": config,
+        "text_replace_hash": get_text_replace_hash(),
+        "converter_version": converter_version,
+        "size": file_entry.size,
+        "mtime_ns": file_entry.mtime_ns,
+    }
+
+def is_up_to_date(entry, old_entry, output_path):
+    keys = ["source_hash", "direction", "config", "text_replace_hash", "converter_version"]
+    return bool(old_entry) and all(entry[key] == old_entry.get(key) for key in keys) and os.path.exists(output_path)
+
+def init_worker(direction, stats_enabled=False, cache_path=None):
+    """Load the converter once when a worker process starts."""
+    stats.pop()  # a forked worker starts with a copy of the counts of the main process
+    if stats_enabled:
+        stats.enable()
+    if cache_path:
+        conversion_cache.open(cache_path)
+    config, _ = get_direction_config(direction)
+    get_converter(config)
+
+def convert_file_task(file_path, input_dir, output_dir, direction, stream=None):
+    """
+    Convert one file, return the error message instead of raising.
+
+    Returns (error, worker stats), the stats are None when disabled.
+    """
+    error = None
+    try:
+        convert_file(file_path, input_dir, output_dir, direction, stream)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return error, stats.pop() if stats.enabled else None
+
+def convert_files(file_paths, input_dir, output_dir, direction, jobs=1, stream=None):
+    """
+    Convert files serially or in a pool of jobs processes.
+
+    Yields (file_path, error) in the order of file_paths, error is None on success.
+    """
+    if jobs <= 1 or len(file_paths) <= 1:
+        for file_path in file_paths:
+            error, worker_stats = convert_file_task(file_path, input_dir, output_dir, direction, stream)
+            stats.merge(worker_stats)
+            yield file_path, error
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(direction, stats.enabled, conversion_cache.db_path)) as executor:
+        count = len(file_paths)
+        results = executor.map(convert_file_task, file_paths, [input_dir] * count, [output_dir] * count, [direction] * count,
+                               [stream] * count)
+        for file_path, (error, worker_stats) in zip(file_paths, results):
+            stats.merge(worker_stats)
+            yield file_path, error
 
 def main():
-    if len(sys.argv) != 4:
-        print("Usage: python my.py <t2s|s2t> <input_directory> <output_directory>")
+    args = sys.argv[1:]
+    if "-h" in args or "--help" in args:
+        print(__doc__.strip())
+        return
+    stats_path = stats.setup(args)
+    jobs = get_jobs(args)
+
+    force = "--force" in args
+    if force:
+        args.remove("--force")
+    stream = None  # by file size
+    if "--cache" in args:
+        idx = args.index("--cache")
+        if idx + 1 >= len(args):
+            print("Missing path after --cache.")
+            sys.exit(1)
+        conversion_cache.open(args[idx + 1])
+        del args[idx:idx + 2]
+    if "--stream" in args:
+        args.remove("--stream")
+        stream = True
+
+    if len(args) != 3:
+        print("Usage: python my.py [--jobs N] [--force] [--stream] [--cache PATH] [--stats] <t2s|s2t> <input_directory> <output_directory>")
         sys.exit(1)
 
-    direction, input_dir, output_dir = sys.argv[1], sys.argv[2], sys.argv[3]
+    direction, input_dir, output_dir = args
 
     if direction not in ["t2s", "s2t"]:
         print("Invalid direction. Use either 't2s' or 's2t'.")
         sys.exit(1)
+    try:
+        list_dictionaries()  # a broken dictionary stops the run before any file is converted
+    except ValueError as e:
+        print(f"Invalid dictionary: {e}")
+        sys.exit(1)
 
     files_to_convert = [
         "images/*.svg",
@@ -123,9 +461,51 @@ def main():
         "src/epub/text/*.xhtml"
     ]
 
-    for pattern in files_to_convert:
-        for file_path in glob.glob(os.path.join(input_dir, pattern)):
-            convert_file(file_path, input_dir, output_dir, direction)
+    index = FileIndex(input_dir)
+    file_entries = [entry for pattern in files_to_convert for entry in index.match(pattern)]
+    file_paths = [entry.path for entry in file_entries]
+
+    # Skip files whose output would not change, with --force the manifest is still read for the removed sources
+    manifest = load_manifest(output_dir)
+    files = {}
+    pending = []
+    for file_entry in file_entries:
+        file_path = file_entry.path
+        relative_path = os.path.relpath(file_path, input_dir)
+        entry = get_manifest_entry(file_entry, direction, manifest.get(relative_path))
+        if not force and is_up_to_date(entry, manifest.get(relative_path),
+                                       get_output_path(file_path, input_dir, output_dir)):
+            files[relative_path] = entry
+        else:
+            pending.append((relative_path, file_path, entry))
+
+    # Remove outputs whose source is gone
+    pending_paths = {item[0] for item in pending}
+    for relative_path in manifest:
+        if relative_path not in files and relative_path not in pending_paths:
+            output_path = os.path.join(output_dir, relative_path)
+            if os.path.exists(output_path):
+                os.remove(output_path)
+                print(f"Removed: {output_path}")
+
+    failed = 0
+    converted = convert_files([item[1] for item in pending], input_dir, output_dir, direction, jobs, stream)
+    for (relative_path, file_path, entry), (_, error) in zip(pending, converted):
+        if error:
+            failed += 1
+            print(f"Failed: {file_path}: {error}")
+        else:
+            files[relative_path] = entry
+            print(f"Converted: {file_path}")
+
+    save_manifest(output_dir, files)
+    conversion_cache.close()
+    print(f"{len(pending)} converted, {len(file_paths) - len(pending)} up to date.")
+    stats.report(stats_path)
+
+    if failed:
+        print(f"{failed} of {len(pending)} files failed to convert.")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
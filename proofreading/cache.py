@@ -0,0 +1,195 @@
+"""
+Cache of converted texts for chinese_convert.py.
+
+Titles, metadata, running headers and names come back in every file and
+every run, the cache keeps their conversion by (namespace, text), the
+namespace being the direction, the OpenCC config and the text_replace hash
+(see get_namespace). An in-memory LRU tier is always used, an SQLite file
+is added as a second tier with open(db_path). Both tiers are bounded by
+their number of entries and drop the least recently used ones first.
+"""
+
+import os
+import time
+import hashlib
+from collections import OrderedDict
+from .stats import stats
+
+schema_version = 2
+memory_entries = 1 << 16  # entries of the in-memory tier
+disk_entries = 1 << 20  # entries of the SQLite tier
+max_text_length = 1 << 14  # longer texts are not cached, they rarely come back
+query_size = 500  # texts looked up in one query, below the SQLite variable limit
+touch_interval = 3600  # seconds, the last use of an entry is only written again after this, keeps reads cheap
+evict_room = 16  # a full disk tier drops 1/16 more than needed, so it is not counted and trimmed on every write
+
+def get_namespace(direction, config, text_replace_hash):
+    return f"{direction}:{config}:{text_replace_hash}"
+
+def get_key(namespace, text):
+    """Get the key of a text on disk, a digest is shorter to index and compare than the text."""
+    return hashlib.blake2b(f"{namespace}\0{text}".encode('utf-8'), digest_size=16).digest()
+
+class ConversionCache:
+    def __init__(self, max_entries=memory_entries, max_disk_entries=disk_entries):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.memory = OrderedDict()  # (namespace, text) -> converted text
+        self.db_path = None
+        self.connection = None
+        self.pid = None  # process of the connection, a forked worker opens its own
+        self.disk_count = 0  # entries on disk as far as this process knows, evict counts them again
+        self.hits = 0  # found in memory
+        self.disk_hits = 0
+        self.misses = 0
+
+    def open(self, db_path):
+        """Add the SQLite tier at db_path, it is connected on first use."""
+        self.close()
+        self.db_path = db_path
+
+    def get_connection(self):
+        if self.db_path is None:
+            return None
+        if self.connection is None or self.pid != os.getpid():
+            import sqlite3
+            if self.db_path != ':memory:':
+                os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            # Worker processes share the file, they wait for each other's writes
+            self.connection = sqlite3.connect(self.db_path, timeout=60)
+            self.connection.execute("PRAGMA journal_mode = WAL")
+            self.connection.execute("PRAGMA synchronous = NORMAL")  # a lost entry is only converted again
+            self.pid = os.getpid()
+            self.create_tables()
+            self.disk_count = self.connection.execute("SELECT COUNT(*) FROM conversions").fetchone()[0]
+        return self.connection
+
+    def create_tables(self):
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != schema_version:
+            self.connection.execute("DROP TABLE IF EXISTS conversions")
+        self.connection.executescript(f"""
+            CREATE TABLE IF NOT EXISTS conversions (
+                key BLOB PRIMARY KEY,
+                converted TEXT NOT NULL,
+                used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS conversions_used ON conversions (used);
+            PRAGMA user_version = {schema_version};
+        """)
+        self.connection.commit()
+
+    def get(self, namespace, text):
+        """Get the cached conversion of a text, None if it is not in the cache."""
+        key = (namespace, text)
+        converted = self.memory.get(key)
+        if converted is None:
+            return self.get_many(namespace, [text]).get(text)
+        self.memory.move_to_end(key)
+        self.hits += 1
+        stats.count("convert.cache.hits")
+        return converted
+
+    def put(self, namespace, text, converted):
+        self.put_many(namespace, {text: converted})
+
+    def get_many(self, namespace, texts):
+        """Get the cached conversions of texts as a dict, texts not in the cache are left out."""
+        found = {}
+        missing = []
+        for text in texts:
+            key = (namespace, text)
+            converted = self.memory.get(key)
+            if converted is None:
+                missing.append(text)
+            else:
+                self.memory.move_to_end(key)
+                found[text] = converted
+        memory_hits = len(found)
+        self.hits += memory_hits
+
+        missing = [text for text in missing if len(text) <= max_text_length]
+        connection = self.get_connection()
+        if connection is not None and missing:
+            now = time.time()
+            keys = {get_key(namespace, text): text for text in missing}
+            key_list = list(keys)
+            disk_found = {}
+            stale = []  # keys whose last use is too old to be kept as it is
+            for start in range(0, len(key_list), query_size):
+                chunk = key_list[start:start + query_size]
+                rows = connection.execute(
+                    f"SELECT key, converted, used FROM conversions WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                for key, converted, used in rows:
+                    disk_found[keys[key]] = converted
+                    if used < now - touch_interval:
+                        stale.append(key)
+            if stale:
+                with connection:
+                    connection.executemany("UPDATE conversions SET used = ? WHERE key = ?", [(now, key) for key in stale])
+            if disk_found:
+                self.add_memory(namespace, disk_found)
+                found.update(disk_found)
+            self.disk_hits += len(disk_found)
+        self.misses += len(texts) - len(found)
+
+        if stats.enabled:
+            stats.count("convert.cache.hits", len(found))
+            stats.count("convert.cache.disk_hits", len(found) - memory_hits)
+            stats.count("convert.cache.misses", len(texts) - len(found))
+        return found
+
+    def put_many(self, namespace, conversions):
+        """Add a dict of text -> converted text to both tiers."""
+        conversions = {text: converted for text, converted in conversions.items() if len(text) <= max_text_length}
+        if not conversions:
+            return
+        self.add_memory(namespace, conversions)
+
+        connection = self.get_connection()
+        if connection is None:
+            return
+        now = time.time()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO conversions (key, converted, used) VALUES (?, ?, ?)",
+                [(get_key(namespace, text), converted, now) for text, converted in conversions.items()])
+            self.disk_count += len(conversions)  # replaced entries are counted too, evict counts them right
+            if self.disk_count > self.max_disk_entries:
+                self.evict(connection)
+
+    def evict(self, connection):
+        """Drop the least recently used entries on disk, entries written together go in the order they were written."""
+        count = connection.execute("SELECT COUNT(*) FROM conversions").fetchone()[0]
+        if count > self.max_disk_entries:
+            keep = self.max_disk_entries - self.max_disk_entries // evict_room
+            # A replaced entry gets a new rowid, so the rowid orders the entries that share their last use
+            cursor = connection.execute(
+                "DELETE FROM conversions WHERE rowid IN (SELECT rowid FROM conversions ORDER BY used, rowid LIMIT ?)",
+                (count - keep,))
+            stats.count("convert.cache.evicted", cursor.rowcount)
+            count -= cursor.rowcount
+        self.disk_count = count
+
+    def add_memory(self, namespace, conversions):
+        for text, converted in conversions.items():
+            key = (namespace, text)
+            self.memory[key] = converted
+            self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def clear(self):
+        """Empty both tiers."""
+        self.memory.clear()
+        connection = self.get_connection()
+        if connection is not None:
+            with connection:
+                connection.execute("DELETE FROM conversions")
+            self.disk_count = 0
+
+    def close(self):
+        if self.connection is not None and self.pid == os.getpid():
+            self.connection.close()
+        self.connection = None
+        self.pid = None
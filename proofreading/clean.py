@@ -1,121 +1,459 @@
+"""
+Script to clean up text in place.
+
+Usage:
+    python clean.py clean [-r {all|NAME_OF_RULE[,NAME_OF_RULE...]}] <directory>
+
+Arguments:
+    clean: start cleaning
+
+    directory: path to the directory to clean, files are changed in place
+
+    --no-git-check: skip git repository check
+
+    --dry-run: print the changes as unified diffs, do not write anything.
+
+    --watch: after the first run, keep running the rules on the files that change, until Ctrl-C.
+
+    --jobs N: run the rules in N worker processes, default 1. The automatic changes are made
+        in parallel, the replacements that need an answer are asked once all files are done,
+        then the files with them are written with the answers.
+
+    --stats: print the time of each phase and rule and the counters of the run.
+
+    --stats-json PATH: same as --stats, also write them to PATH as JSON.
+
+    -r {all|NAME_OF_RULE[,NAME_OF_RULE...]}
+        if 'all' or null, run all rules;
+        if others, run the rules with these names.
+        Rules run in the order of data.clean_rule_order on each text node.
+
+Replacement dictionaries:
+    replace_text uses data.text_replace and the compiled dictionaries in
+    $PROOFREADING_DICTIONARIES, see dictionary.py for how to compile them.
+    A truncated or broken dictionary file is reported by name and nothing
+    is cleaned.
+"""
+
 import os, sys
-import re, json
-from bs4 import BeautifulSoup, NavigableString
+import re
+import hashlib
 import data
-from data import RULES, text_style
-from utils import get_current_branch, replace_text
-from data import zh_chars, numbers, alphanumeric, zh_punct, zh_chars_punct
+from data import rules, text_style
+from utils import get_current_branch, get_jobs, replace_text, get_matcher, prompt_replace, list_dictionaries
+from utils import stats  # the same Stats object replace_text counts in
+from discovery import FileIndex
+from ruleset import build_rules
+from data import zh_chars, numbers, alphanumeric, zh_punct, zh_chars_punct, char_classifier
+from textbuffer import TextBuffer
+from patch import Patcher, write_atomic, get_diff
+from watch import Watcher
+
+# lxml (parsing) and the process pool are imported where they are used, keeps startup fast
 
 # Todo:
 #   - Add lang check before run functions.
-#   - Order of execution of functions.
 
-def chinese_spacing(content, *_):  # only use the first argument
-    # Add one space between Chinese and alphanumeric OR alphanumeric and Chinese
-    content = re.sub(rf'({zh_chars})\s*({alphanumeric})', r'\1 \2', content)
-    content = re.sub(rf'({alphanumeric})\s*({zh_chars})', r'\1 \2', content)
-    
-    # remove space between Chinese characters and Chinese punctuations
-    content = re.sub(rf'({zh_chars})\s*({zh_punct})', r'\1\2', content)
-    content = re.sub(rf'({zh_punct})\s*({zh_chars})', r'\1\2', content)
-    
+# Patterns of the rules, compiled once and fused so each rule scans the text once.
+# A rule used to run several re.sub passes in sequence, the callbacks keep the same result:
+#   - a pass consumes both characters around a gap, so in a chain like "。 。 。" only every
+#     other gap is fixed by one pass, the same is tracked here;
+#   - a character converted by an earlier pass (, to ，) counts as a Chinese punctuation
+#     in the later passes.
+zh_alphanumeric = f'[{zh_chars[1:-1]}{alphanumeric[1:-1]}]'
+
+spacing_pattern = re.compile(
     # remove space between Chinese punctuations
-    content = re.sub(rf'({zh_punct})\s*({zh_punct})', r'\1\2', content)
+    rf'(?P<punct>{zh_punct}\s*{zh_punct})'
+    # Add one space between Chinese and alphanumeric OR alphanumeric and Chinese
+    rf'|(?P<space>(?<={zh_chars})\s*(?={alphanumeric})|(?<={alphanumeric})\s*(?={zh_chars}))'
+    # remove space between Chinese characters or alphanumeric and Chinese punctuations
+    rf'|(?P<strip>(?<={zh_alphanumeric})\s+(?={zh_punct})|(?<={zh_punct})\s+(?={zh_alphanumeric}))'
+)
 
-    # remove space between Chinese punctuations and alphanumeric
-    content = re.sub(rf'({zh_punct})\s*({alphanumeric})', r'\1\2', content)
-    content = re.sub(rf'({alphanumeric})\s*({zh_punct})', r'\1\2', content)
+punctuation_pattern = re.compile(
+    # change comma (,) after Chinese characters or punctuations to full-width
+    rf'(?P<comma>(?<={zh_chars_punct})\s*,)'
+    # change ( before Chinese characters or punctuations to full-width
+    rf'|(?P<open>\(\s*(?={zh_chars_punct}))'
+    # change ) after Chinese characters or punctuations to full-width
+    rf'|(?P<close>(?<=[{zh_chars_punct[1:-1]},])\s*\))'
+    # change ; after Chinese characters or punctuations to full-width
+    rf'|(?P<semicolon>(?<=[{zh_chars_punct[1:-1]},)])\s*;)'
+)
 
-    return content
+# remove space between numbers
+number_pattern = re.compile(rf'(?P<number>(?<={numbers})\s*(?={numbers}))')
+# remove space error like: 10. 1, 10 .1, 10 . 1
+number_pattern_zh = re.compile(rf'(?P<number>(?<={numbers})\s*(?={numbers}))|(?P<decimal>(?<=\d)\s*\.\s*(?=\d))')
 
-def chinese_punctuation(content, *_):  # only use the first argument
-    # change comma (,) after Chinese characters or punctuations to full-width
-    content = re.sub(rf'({zh_chars_punct})\s*,', r'\1，', content)
+def spacing_replace(match):
+    kind = match.lastgroup
+    if kind == 'space':
+        return ' '
+    elif kind == 'strip':
+        return ''
+    text = match.group()
+    return text[0] + text[-1]
 
-    # change ( before Chinese characters or punctuations to full-width
-    content = re.sub(rf'\(\s*({zh_chars_punct})', r'（\1', content)
+def chinese_spacing(content, *_):  # only use the first argument
+    if not char_classifier.contains(content, 'zh', 'punct'):
+        return content  # every gap it changes has Chinese on one side
+    return spacing_pattern.sub(spacing_replace, content)
 
-    # change ) after Chinese characters or punctuations to full-width
-    content = re.sub(rf'({zh_chars_punct})\s*\)', r'\1）', content)
+def chinese_punctuation(content, *_):  # only use the first argument
+    if not char_classifier.contains(content, 'zh', 'punct'):
+        return content
+    converted = set()  # positions of , and ) changed to full-width
 
-    # change ; after Chinese characters or punctuations to full-width
-    content = re.sub(rf'({zh_chars_punct})\s*\;', r'\1；', content)
+    def punctuation_replace(match):
+        kind = match.lastgroup
+        if kind == 'comma':
+            converted.add(match.end() - 1)
+            return '，'
+        elif kind == 'open':
+            return '（'
 
-    return content
+        # The left character is , or ) which only counts if it was converted
+        left = match.start() - 1
+        if content[left] in ',)' and left not in converted:
+            return match.group()
+        if kind == 'close':
+            converted.add(match.end() - 1)
+            return '）'
+        return '；'
+
+    return punctuation_pattern.sub(punctuation_replace, content)
 
 def number_spacing(content, lang, *_):
     # Todo: generalize for edge cases
+    last_right = {}  # the right digit of the last fixed gap, by kind
 
-    # remove space between numbers
-    content = re.sub(rf'({numbers})\s*({numbers})', r'\1\2', content)
+    def number_replace(match):
+        kind = match.lastgroup
+        if last_right.get(kind) == match.start() - 1:
+            return match.group()  # the left digit was already taken by the last gap
+        last_right[kind] = match.end()
+        return '' if kind == 'number' else '.'
 
     # Check language
     if lang == 'zh' or lang.startswith('zh-'):
-        # remove space error like: 10. 1, 10 .1, 10 . 1
-        content = re.sub(r'(\d)\s*\.\s*(\d)', r'\1.\2', content)
+        return number_pattern_zh.sub(number_replace, content)
+    return number_pattern.sub(number_replace, content)
+
+def run_rules(handlers, nodes, file_path, answer=None):
+    """
+    Get the texts of the nodes after all the rules, in the order of nodes.
+
+    The nodes of each lang are joined into one TextBuffer and every rule
+    runs once over it, which gives the same texts as running the rules
+    node by node. Texts that can not be joined go node by node. The
+    prompts of replace_text come in the order of the nodes. answer, if
+    given, takes them instead of the reviewer:
+    answer(node_idx, line_num, key, entry, text, spans) returns the key pressed.
+    """
+    def run_handler(name, handler, text, node_idx):
+        node = nodes[node_idx]
+        if name == "replace_text" and answer is not None:
+            return handler(text, node.lang, node.line, file_path, False,
+                           lambda *prompt: answer(node_idx, node.line, *prompt))
+        return handler(text, node.lang, node.line, file_path, False)
+
+    by_lang = {}
+    for idx, node in enumerate(nodes):
+        by_lang.setdefault(node.lang, []).append(idx)
+
+    texts = [node.text for node in nodes]  # of the nodes that are not in a buffer
+    groups = []  # (lang, node indexes, their TextBuffer or None) of each lang
+    for lang, indexes in by_lang.items():
+        try:
+            buffer = TextBuffer([texts[idx] for idx in indexes])
+        except ValueError:
+            buffer = None
+            stats.count("clean.nodes_unbatched", len(indexes))
+        groups.append((lang, indexes, buffer))
+
+    for name, handler in handlers:
+        with stats.timer(f"clean.rule.{name}"):
+            if name != "replace_text":
+                for lang, indexes, buffer in groups:
+                    if buffer is not None:
+                        buffer.apply(handler, lang, nodes[indexes[0]].line, file_path, False)
+                    else:
+                        for idx in indexes:
+                            texts[idx] = run_handler(name, handler, texts[idx], idx)
+                continue
+
+            # Only on the nodes with a key in them, a prompt shows the node and its line. The nodes
+            # of all langs go in their order, so the prompts come in the order of the document.
+            targets = []  # (node index, group index, position in the group)
+            for group_idx, (lang, indexes, buffer) in enumerate(groups):
+                if buffer is None:
+                    positions = range(len(indexes))
+                else:
+                    positions = buffer.nodes_at([start for start, _, _ in get_matcher(lang).find(buffer.text)])
+                targets.extend((indexes[position], group_idx, position) for position in positions)
+            buffer_texts = {}  # group index -> the texts of its buffer, while they change
+            for idx, group_idx, position in sorted(targets):
+                buffer = groups[group_idx][2]
+                if buffer is None:
+                    texts[idx] = run_handler(name, handler, texts[idx], idx)
+                else:
+                    if group_idx not in buffer_texts:
+                        buffer_texts[group_idx] = buffer.split()
+                    group_texts = buffer_texts[group_idx]
+                    group_texts[position] = run_handler(name, handler, group_texts[position], idx)
+            for group_idx, group_texts in buffer_texts.items():
+                groups[group_idx][2].set_texts(group_texts)
+
+    for lang, indexes, buffer in groups:
+        if buffer is not None:
+            for idx, text in zip(indexes, buffer.split()):
+                texts[idx] = text
+    return texts
+
+def read_content(file_path):
+    with stats.timer("clean.read", file_path):
+        with open(file_path, 'r', encoding='utf-8', newline='') as f:
+            content = f.read()
+    if stats.enabled:
+        stats.count("clean.files")
+        stats.count("clean.bytes_read", len(content.encode('utf-8')))
     return content
- 
-def process_file(rule, file_path):
-    """Process HTML like files, write directly."""
-
-    with open(file_path, 'r', encoding='utf-8') as f:
-        content = f.read()
-        soup = BeautifulSoup(content, 'html.parser')
-
-    # Extract xml:lang attribute from the html tag for lang_file
-    html_tag = soup.find('html')
-    lang_file = html_tag.get('xml:lang', '')  # Default to empty string if attribute is not present
-
-    # This recursive function goes through the html tags and appends all text it finds
-    def recursive_extract(tag, lang, line_num):
-        lang = tag.get('xml:lang', lang)
-        # if not lang == lang_file:  # debug
-        #     print(f"DEBUG: found new lang {lang}")
-
-        if hasattr(tag, 'sourceline'):
-            line_num = tag.sourceline
-
-        for child in tag.children:
-            if isinstance(child, NavigableString):
-                if hasattr(child, 'sourceline'):
-                    line_num = child.sourceline
-                adjusted_text = globals()[rule["name"]](child, lang, line_num, file_path, False)
-                child.replace_with(adjusted_text)
-            else:
-                recursive_extract(child, lang, line_num)
-
-    for tag in soup.find_all(data.html_text_tags):
-        recursive_extract(tag, lang_file, 1)
-
-    with open(file_path, 'w', encoding='utf-8') as f:
-        f.write(str(soup))
-    print(f"Processed: {file_path}")
-
-def apply_rule(rule, path, rules):
-    # Add missing key value to rule
-    rule_default = next((d for d in rules if d["name"] == "default"), None)
-    if rule_default and rule:
-        # Add from default
-        for key, value in rule_default.items():
-            if key not in rule:
-                rule[key] = value
-
-    for root, dirs, files in os.walk(path):
-        # Modify 'dirs' in-place to remove directories that start with a dot.
-        # This also ensures that os.walk doesn't traverse into these directories.
-        dirs[:] = [d for d in dirs if not d.startswith('.')]
-
-        for file in files:
-            check_hidden = not file.startswith('.')
-            check_name = os.path.basename(file) not in rule["skip_file"]
-            check_extension = file.split('.')[-1] in rule["extension"]
-            if check_hidden and check_name and check_extension:
-                # print(f"processing file {file}") # debug
-                file_path = os.path.join(root, file)
-                process_file(rule, file_path)
+
+def clean_content(rules, content, file_path, answer=None):
+    """
+    Run the rules on the content of a file, returns the output and the Patcher of the changes.
+
+    Every text node goes through all the rules in order, the content is
+    parsed once and each rule runs once over the texts of each lang. The
+    changed texts are patched into the source as it is. answer is passed
+    to run_rules.
+    """
+    from parsing import parse, iter_text_nodes
+
+    with stats.timer("clean.parse", file_path):
+        document = parse(content)
+        patcher = Patcher(content, document)
+
+    handlers = [(rule.name, rule.handler) for rule in rules]
+    tags = frozenset().union(*(rule.tags for rule in rules))
+
+    # The lang of the file comes from the xml:lang attribute of the html tag, default to empty string
+    with stats.timer("clean.rules", file_path):
+        nodes = [node for node in iter_text_nodes(document.root, tags) if node.selected]
+        for node, adjusted_text in zip(nodes, run_rules(handlers, nodes, file_path, answer)):
+            if adjusted_text != node.text:
+                patcher.replace(node, adjusted_text)
+                if stats.enabled:
+                    stats.count("clean.nodes_changed")
+        if stats.enabled:
+            stats.count("clean.nodes_visited", len(nodes))
+
+    with stats.timer("clean.serialize", file_path):
+        output = patcher.get_output()
+    return output, patcher
+
+def write_output(file_path, content, output, patcher, dry_run=False):
+    """
+    Write the output of clean_content if it changed, with dry_run get its diff instead.
+
+    Returns the message to print, None if nothing changed.
+    """
+    if output == content:
+        return None
+    if not patcher.patchable:
+        stats.count("clean.files_serialized")  # the source could not be patched, written as lxml serializes it
+
+    if dry_run:
+        return get_diff(file_path, content, output)
+
+    with stats.timer("clean.write", file_path):
+        write_atomic(file_path, output)
+    if stats.enabled:
+        stats.count("clean.files_changed")
+        stats.count("clean.edits", len(patcher.edits))
+        stats.count("clean.bytes_written", len(output.encode('utf-8')))
+    return f"Processed: {file_path}\n"
+
+def process_file(rules, file_path, dry_run=False):
+    """
+    Process HTML like files with a list of rules, write directly.
+
+    The file is only written if anything changed. With dry_run, the
+    changes are printed as a diff instead.
+    """
+    content = read_content(file_path)
+    output, patcher = clean_content(rules, content, file_path)
+    message = write_output(file_path, content, output, patcher, dry_run)
+    if message:
+        print(message, end='')
+
+def get_content_hash(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def init_worker(stats_enabled):
+    stats.pop()  # a forked worker starts with a copy of the counts of the main process
+    if stats_enabled:
+        stats.enable()
+
+def clean_file_task(rule_names, file_path, dry_run):
+    """
+    First pass of a parallel run, in a worker: run the rules without asking anything.
+
+    The prompts of replace_text are collected and answered with no. A file
+    without prompts is written, a file with prompts is left as it is and
+    cleaned again by answer_file_task once they are answered. Returns
+    (message, prompts, content hash, error, worker stats), the stats are
+    None when disabled.
+    """
+    prompts = []
+
+    def collect(node_idx, line_num, key, entry, text, spans):
+        prompts.append((node_idx, line_num, key, entry['replace'], text, spans))
+        return 'n'
+
+    message = content_hash = error = None
+    try:
+        content = read_content(file_path)
+        output, patcher = clean_content([clean_rules[name] for name in rule_names], content, file_path, collect)
+        if prompts:
+            content_hash = get_content_hash(content)
+            stats.pop()  # counted when the file is cleaned again
+            stats.count("clean.files_deferred")
+        else:
+            message = write_output(file_path, content, output, patcher, dry_run)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return message, prompts, content_hash, error, stats.pop() if stats.enabled else None
+
+def answer_file_task(rule_names, file_path, dry_run, content_hash, answers):
+    """
+    Last pass of a parallel run, in a worker: clean a file with the answers to its prompts.
+
+    answers maps (node_idx, key) to the key pressed. The file is skipped if
+    it changed since the first pass, the answers may not fit it any more.
+    Returns (message, error, worker stats).
+    """
+    message = error = None
+    try:
+        content = read_content(file_path)
+        if get_content_hash(content) != content_hash:
+            error = "changed since it was checked, not cleaned, run clean again"
+        else:
+            output, patcher = clean_content([clean_rules[name] for name in rule_names], content, file_path,
+                                            lambda node_idx, line_num, key, *_: answers.get((node_idx, key), 'n'))
+            message = write_output(file_path, content, output, patcher, dry_run)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return message, error, stats.pop() if stats.enabled else None
+
+def print_result(file_path, message, error):
+    if error:
+        print(f"Error: {file_path}: {error}")
+    elif message:
+        print(message, end='')
+
+def apply_rules_parallel(file_rules, jobs, dry_run=False):
+    """
+    Apply the rules of each file in file_rules with jobs worker processes.
+
+    The workers make every automatic change and collect the prompts of
+    replace_text, so the whole run uses all the cores without waiting for
+    the reviewer. The prompts are asked here once all files are done, in
+    the order a serial run asks them, then the files with prompts are
+    cleaned again in the workers with the answers and written once.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    file_paths = sorted(file_rules)
+    rule_names = [[rule.name for rule in file_rules[file_path]] for file_path in file_paths]
+    deferred = []  # (file path, rule names, prompts, content hash)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(stats.enabled,)) as executor:
+        results = executor.map(clean_file_task, rule_names, file_paths, [dry_run] * len(file_paths), chunksize=4)
+        for file_path, names, (message, prompts, content_hash, error, worker_stats) in zip(file_paths, rule_names, results):
+            stats.merge(worker_stats)
+            print_result(file_path, message, error)
+            if prompts:
+                deferred.append((file_path, names, prompts, content_hash))
+        if not deferred:
+            return
+
+        total = sum(len(prompts) for _, _, prompts, _ in deferred)
+        stats.count("clean.prompts", total)
+        answers = []
+        count = 0
+        for file_path, _, prompts, _ in deferred:
+            file_answers = {}
+            for node_idx, line_num, key, replacement, text, spans in prompts:
+                count += 1
+                print(f"\n[{count}/{total}] {file_path}:{line_num}")
+                file_answers[(node_idx, key)] = prompt_replace(text, spans, key, replacement, line_num, file_path)
+            answers.append(file_answers)
+
+        results = executor.map(answer_file_task, [names for _, names, _, _ in deferred],
+                               [file_path for file_path, _, _, _ in deferred], [dry_run] * len(deferred),
+                               [content_hash for _, _, _, content_hash in deferred], answers)
+        for (file_path, _, _, _), (message, error, worker_stats) in zip(deferred, results):
+            stats.merge(worker_stats)
+            print_result(file_path, message, error)
+
+def apply_rules(selected_rules, index, dry_run=False, jobs=1):
+    """Apply the selected rules in one pass over the files in the index, in jobs worker processes if more than one."""
+    # Rules of each file, in the order of selected_rules
+    file_rules = {}
+    for rule in selected_rules:
+        for entry in index.select_rule(rule):
+            file_rules.setdefault(entry.path, []).append(rule)
+
+    if jobs > 1 and len(file_rules) > 1:
+        apply_rules_parallel(file_rules, jobs, dry_run)
+        return
+    for file_path in sorted(file_rules):
+        # print(f"processing file {file_path}") # debug
+        process_file(file_rules[file_path], file_path, dry_run)
+
+def watch_files(selected_rules, path, dry_run=False):
+    """
+    Run the rules again on every file that changes under path, until Ctrl-C.
+
+    The process stays up, so the rules, their patterns and the replacement
+    tables are only loaded once. The writes of the rules are not reported
+    as changes.
+    """
+    watcher = Watcher(path)
+    print(f"Watching {path} for changes ({watcher.backend}), press Ctrl-C to stop.")
+    try:
+        while True:
+            for file_path in watcher.changes():
+                file_rules = [rule for rule in selected_rules if rule.matches(file_path)]
+                if not file_rules:
+                    continue
+                try:
+                    process_file(file_rules, file_path, dry_run)
+                except Exception as e:
+                    print(f"Error: {file_path}: {type(e).__name__}: {e}")
+                watcher.refresh([file_path])
+    except KeyboardInterrupt:
+        print()
+    finally:
+        watcher.close()
+
+# Rules of clean.py in the order they run, built once with their functions
+clean_rules = build_rules(rules, {
+    "replace_text": replace_text,
+    "chinese_punctuation": chinese_punctuation,
+    "chinese_spacing": chinese_spacing,
+    "number_spacing": number_spacing,
+}, data.clean_rule_order)
+clean_rules = {name: clean_rules[name] for name in data.clean_rule_order}
 
 def main():
-    rules = json.loads(RULES)
+    if "-h" in sys.argv or "--help" in sys.argv:
+        print(__doc__.strip())
+        return
+    stats_path = stats.setup(sys.argv)
+    jobs = get_jobs(sys.argv)
 
     if len(sys.argv) < 2 or sys.argv[1] not in ["clean", "--no-git-check"]:
         print("Invalid arguments")
@@ -126,6 +464,11 @@ def main():
     if "-r" in sys.argv:
         rule_name = sys.argv[sys.argv.index("-r") + 1]
     path = os.path.expanduser(sys.argv[-1])
+    try:
+        list_dictionaries()  # a broken dictionary stops the run before any file is changed
+    except ValueError as e:
+        print(f"Invalid dictionary: {e}")
+        sys.exit(1)
 
     # Git check
     if '--no-git-check' not in sys.argv:
@@ -139,16 +482,22 @@ def main():
                 sys.exit(0)
 
     if rule_name == "all" or rule_name is None:
-        sys.exit(0) # Todo
-        # for rule in rules:
-        #     apply_rule(rule, path)
+        rule_names = data.clean_rule_order
     else:
-        for rule in rules:
-            if rule["name"] == rule_name:
-                apply_rule(rule, path, rules)
-                break
-        else:
-            print(f"Rule named {rule_name} not found.")
+        rule_names = rule_name.split(',')
+
+    for name in rule_names:
+        if name not in clean_rules:
+            print(f"Rule named {name} not found.")
+            return
+
+    # Run the rules in the defined order, whatever order they are given
+    selected_rules = [rule for name, rule in clean_rules.items() if name in rule_names]
+    dry_run = '--dry-run' in sys.argv
+    apply_rules(selected_rules, FileIndex(path), dry_run, jobs)
+    if '--watch' in sys.argv:
+        watch_files(selected_rules, path, dry_run)
+    stats.report(stats_path)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -2,6 +2,10 @@
 Dictionary and other variables.
 """
 
+import re
+from bisect import bisect_right
+from functools import lru_cache
+
 # Tags in html like files that contains texts
 html_text_tags = ["h1", "h2", "h3", "h4", "h5", "h6", "p", "figcaption", "title"]
 
@@ -16,44 +20,157 @@ full_width_punct = r'[，。！？、：；…—～《》「」『』【】〔
 zh_punct = typography_quotation[:-1] + full_width_punct[1:]
 zh_chars_punct = f'{zh_chars[:-1]}{zh_punct[1:]}'
 
-RULES = f'''
-[
-    {{
+def parse_char_class(char_class):
+    """Parse a regex character class like '[a-z\\u4e00]' to a list of (first, last) code points."""
+    chars = []
+    idx = 1
+    while idx < len(char_class) - 1:
+        if char_class.startswith('\\u', idx):
+            chars.append(int(char_class[idx + 2:idx + 6], 16))
+            idx += 6
+        elif char_class.startswith('\\U', idx):
+            chars.append(int(char_class[idx + 2:idx + 10], 16))
+            idx += 10
+        elif char_class[idx] == '-' and chars and idx < len(char_class) - 2:
+            chars.append(None)  # range marker
+            idx += 1
+        else:
+            chars.append(ord(char_class[idx]))
+            idx += 1
+
+    ranges = []
+    idx = 0
+    while idx < len(chars):
+        if idx + 2 < len(chars) and chars[idx + 1] is None:
+            ranges.append((chars[idx], chars[idx + 2]))
+            idx += 3
+        else:
+            ranges.append((chars[idx], chars[idx]))
+            idx += 1
+    return ranges
+
+class CharClassifier:
+    """
+    Classify code points into the character classes above.
+
+    Single characters are looked up in a table for the BMP and a sorted range
+    table for the rest. The helpers on whole texts use compiled patterns of the
+    same classes and return early for ASCII only text. Everything is built on
+    first use.
+    """
+
+    def __init__(self, char_classes):
+        self.char_classes = char_classes
+        self.names = list(char_classes)
+        self.built = False
+
+    def build(self):
+        """Build the tables and patterns on first use, keeps import fast."""
+        char_classes = self.char_classes
+        self.bmp = bytearray(0x10000)  # class index + 1, 0 for none
+        ranges = []
+        for idx, (name, char_class) in enumerate(char_classes.items()):
+            for first, last in parse_char_class(char_class):
+                if first < 0x10000:
+                    self.bmp[first:min(last, 0xffff) + 1] = bytes([idx + 1]) * (min(last, 0xffff) + 1 - first)
+                if last >= 0x10000:
+                    ranges.append((max(first, 0x10000), last, idx))
+        ranges.sort()
+        self.starts = [item[0] for item in ranges]
+        self.ranges = ranges
+        self.ascii_classes = {name for name, char_class in char_classes.items()
+                              if any(first < 0x80 for first, _ in parse_char_class(char_class))}
+        self.run_pattern = re.compile('|'.join(f'(?P<{name}>{char_class}+)' for name, char_class in char_classes.items()))
+        self.built = True
+
+    def classify(self, char):
+        """Get the class name of a character, None if it has no class."""
+        if not self.built:
+            self.build()
+        code = ord(char)
+        if code < 0x10000:
+            idx = self.bmp[code]
+            return self.names[idx - 1] if idx else None
+        pos = bisect_right(self.starts, code) - 1
+        if pos >= 0 and code <= self.ranges[pos][1]:
+            return self.names[self.ranges[pos][2]]
+        return None
+
+    @lru_cache(maxsize=None)
+    def get_pattern(self, names):
+        return re.compile('[' + ''.join(self.char_classes[name][1:-1] for name in names) + ']')
+
+    def contains(self, text, *names):
+        """Check if text contains any character of the classes, default to zh."""
+        names = names or ('zh',)
+        if not self.built:
+            self.build()
+        if text.isascii() and not self.ascii_classes.intersection(names):
+            return False
+        return self.get_pattern(names).search(text) is not None
+
+    def runs(self, text):
+        """Split text into runs of one class, returns a list of (name, start, end), characters without class are left out."""
+        if not self.built:
+            self.build()
+        if text.isascii() and not self.ascii_classes:
+            return []
+        return [(match.lastgroup, match.start(), match.end()) for match in self.run_pattern.finditer(text)]
+
+    def count(self, text):
+        """Count the characters of text by class, characters without class are counted as None."""
+        counts = dict.fromkeys(self.names, 0)
+        for name, start, end in self.runs(text):
+            counts[name] += end - start
+        counts[None] = len(text) - sum(counts.values())
+        return counts
+
+char_classifier = CharClassifier({
+    "zh": zh_chars,
+    "punct": zh_punct,
+    "alphanumeric": alphanumeric,
+})
+
+# Rules, "default" gives the keys other rules do not have
+rules = [
+    {
         "name": "default",
         "location": ["./"],
         "extension": ["svg", "xhtml"],
         "tag": ["h", "p", "text", "figcaption"],
         "switch": "prompt",
         "skip_file": []
-    }},
-    {{
+    },
+    {
         "name": "punctuation_line_end",
         "extension": ["xhtml"],
         "tag": ["p", "figcaption"],
         "skip_file": ["loi.xhtml", "titlepage.xhtml"]
-    }},
-    {{
+    },
+    {
         "name": "chinese_spacing",
-        "extension": "{html_like_extensions}",
-        "tag": "{html_text_tags}"
-    }},
-    {{
+        "extension": html_like_extensions,
+        "tag": html_text_tags
+    },
+    {
         "name": "number_spacing",
-        "extension": "{html_like_extensions}",
-        "tag": "{html_text_tags}"
-    }},
-    {{
+        "extension": html_like_extensions,
+        "tag": html_text_tags
+    },
+    {
         "name": "replace_text",
-        "extension": "{html_like_extensions}",
-        "tag": "{html_text_tags}"
-    }},
-    {{
+        "extension": html_like_extensions,
+        "tag": html_text_tags
+    },
+    {
         "name": "chinese_punctuation",
-        "extension": "{html_like_extensions}",
-        "tag": "{html_text_tags}"
-    }}
+        "extension": html_like_extensions,
+        "tag": html_text_tags
+    }
 ]
-'''
+
+# Rules of clean.py, in the order they run on each text node
+clean_rule_order = ["replace_text", "chinese_punctuation", "chinese_spacing", "number_spacing"]
 
 text_style = {
     "RED_BOLD": "\033[1;31m",
@@ -0,0 +1,415 @@
+"""
+External replacement dictionaries for replace_text, compiled to a binary file and memory-mapped.
+
+Lists too large for data.text_replace (variants, OCR errors, house style)
+are kept in text files and compiled with:
+
+    python -m proofreading.dictionary compile SOURCE OUTPUT [--lang LANG] [--switch auto|prompt] [--type NAME]
+    python -m proofreading.dictionary list
+
+SOURCE is either a JSON object in the format of data.text_replace, or a
+text file with one entry per line: key, replacement and optionally switch
+and type, separated by tabs. Empty lines and lines starting with '#' are
+skipped. --lang is needed for a text file, --switch (default prompt) and
+--type set the entries that do not have their own.
+
+Compiled files end in .dict and are read from the directory in
+$PROOFREADING_DICTIONARIES, default $XDG_DATA_HOME/proofreading/dictionaries.
+A file holds the entries of one lang, it is only mapped when text of a lang
+it applies to is first matched. The keys are sorted and looked up by
+binary search in the mapped file, nothing but the header and the first
+characters of the keys is read at load, and worker processes share the
+mapped pages. data.text_replace comes before the dictionaries, which come
+in the order of their file names.
+
+Layout, little-endian: magic, header length (uint32), the header as JSON,
+then the sections the header lists by offset from the aligned end of the
+header:
+    key_offsets, value_offsets: uint32, count + 1 offsets into keys and values
+    info: uint16 per entry, bit 0 set for prompt, the type index above it
+    first_chars: uint32, sorted code points the keys start with
+    first_starts: uint32, index of the first key of each, and count at the end
+    first_lengths: uint32, length in characters of the longest key of each
+    pairs: bits set for the first two characters of the keys, see get_pair_bit
+    keys, values: UTF-8 strings, the keys in code point order
+"""
+
+import os
+import re
+import sys
+import json
+import mmap
+import struct
+import hashlib
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+
+magic = b'PRDICT\x00\x01'
+header_struct = struct.Struct('<8sI')  # magic, header length
+alignment = 8
+extension = '.dict'
+switches = ["auto", "prompt"]
+pair_multiplier = 0x9E3779B97F4A7C15  # spreads the pairs of close code points over the bits
+header_types = {"lang": str, "count": int, "pair_bits": int, "types": list, "digest": str, "sections": dict}
+section_names = ["key_offsets", "value_offsets", "info", "first_chars", "first_starts", "first_lengths", "pairs",
+                 "keys", "values"]
+
+def get_pair_bit(first, second, mask):
+    """
+    Get the bit of the pair of code points first and second, second is 0 for a key of one character.
+
+    A position can only start a key if the bit of its two characters is
+    set, most positions are passed over without looking at the keys.
+    Dictionary.find has the same expression inline.
+    """
+    return ((first << 21 | second) * pair_multiplier >> 32) & mask
+
+def get_dictionary_path():
+    data_home = os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share')
+    return os.environ.get('PROOFREADING_DICTIONARIES') or os.path.join(data_home, 'proofreading', 'dictionaries')
+
+def align(offset):
+    return -(-offset // alignment) * alignment
+
+def read_header(file_path):
+    """
+    Read the header of a compiled dictionary without mapping it.
+
+    Raises ValueError naming the file if it is not one, if the header is
+    broken, or if the sections do not fit the count of entries and the
+    size of the file, like in a truncated copy.
+    """
+    with open(file_path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        head = f.read(header_struct.size)
+        if len(head) != header_struct.size or head[:len(magic)] != magic:
+            raise ValueError(f"{file_path} is not a compiled dictionary of this version")
+        _, length = header_struct.unpack(head)
+        try:
+            header = json.loads(f.read(length).decode('utf-8'))
+        except ValueError:  # also the UnicodeDecodeError of a cut character
+            header = None
+    if not isinstance(header, dict) or any(not isinstance(header.get(key), key_type)
+                                           for key, key_type in header_types.items()):
+        raise ValueError(f"{file_path}: the header is broken or incomplete")
+    pair_bits = header["pair_bits"]
+    if header["count"] < 0 or pair_bits < 8 or pair_bits & (pair_bits - 1):
+        raise ValueError(f"{file_path}: the header has a count of {header['count']} and {pair_bits} pair bits")
+    header["data_start"] = align(header_struct.size + length)
+
+    sections = header["sections"]
+    for name in section_names:
+        section = sections.get(name)
+        if not (isinstance(section, list) and len(section) == 2
+                and all(isinstance(number, int) and number >= 0 for number in section)):
+            raise ValueError(f"{file_path}: the {name} section is missing from the header")
+        if header["data_start"] + section[0] + section[1] > file_size:
+            raise ValueError(f"{file_path}: the {name} section ends after the end of the file, it may be truncated")
+
+    # The sections read as arrays, their sizes follow from the count and the first characters
+    first_size = sections["first_chars"][1]
+    sizes = {
+        "key_offsets": 4 * (header["count"] + 1),
+        "value_offsets": 4 * (header["count"] + 1),
+        "info": 2 * header["count"],
+        "first_chars": first_size - first_size % 4,
+        "first_starts": first_size + 4,
+        "first_lengths": first_size,
+        "pairs": pair_bits // 8,
+    }
+    for name, size in sizes.items():
+        if sections[name][1] != size:
+            raise ValueError(f"{file_path}: the {name} section has {sections[name][1]} bytes instead of {size}")
+    return header
+
+@lru_cache(maxsize=None)
+def list_dictionaries():
+    """
+    Get (file path, header) of the compiled dictionaries, sorted by file name.
+
+    Raises the ValueError of read_header for the first broken file, the
+    scripts call it before they process any file.
+    """
+    path = get_dictionary_path()
+    try:
+        names = sorted(name for name in os.listdir(path) if name.endswith(extension) and not name.startswith('.'))
+    except FileNotFoundError:
+        return []
+    return [(os.path.join(path, name), read_header(os.path.join(path, name))) for name in names]
+
+@lru_cache(maxsize=None)
+def open_dictionary(file_path):
+    return Dictionary(file_path)
+
+class Keys:
+    """The sorted keys of a dictionary as a sequence of UTF-8 bytes, for bisect."""
+    __slots__ = ('map', 'start', 'offsets')
+
+    def __init__(self, map, start, offsets):
+        self.map = map
+        self.start = start
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.map[self.start + self.offsets[idx]:self.start + self.offsets[idx + 1]]
+
+class Dictionary:
+    """A compiled dictionary mapped read-only, looked up like the text_replace table."""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.header = read_header(file_path)
+        self.lang = self.header["lang"]
+        self.types = self.header["types"]
+        self.count = self.header["count"]
+        with open(file_path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+
+        self.key_offsets = self.get_array("key_offsets", 'I')
+        self.value_offsets = self.get_array("value_offsets", 'I')
+        self.info = self.get_array("info", 'H')
+        self.first_chars = self.get_array("first_chars", 'I')
+        self.first_starts = self.get_array("first_starts", 'I')
+        self.first_lengths = self.get_array("first_lengths", 'I')
+        self.pairs = self.get_array("pairs", 'B')
+        self.pair_mask = self.header["pair_bits"] - 1
+        self.keys = Keys(self.map, self.get_offset("keys"), self.key_offsets)
+        self.values_start = self.get_offset("values")
+        self.first_pattern = None  # characters keys start with, compiled on first use
+
+    def get_offset(self, name):
+        return self.header["data_start"] + self.header["sections"][name][0]
+
+    def get_array(self, name, typecode):
+        """Get a section as a sequence of numbers, a view of the mapped pages where the byte order allows."""
+        start = self.get_offset(name)
+        section = self.view[start:start + self.header["sections"][name][1]]
+        if sys.byteorder == 'little':
+            return section.cast(typecode)
+        numbers = array(typecode, section)
+        numbers.byteswap()
+        return numbers
+
+    def get_first(self, char):
+        """Get the range of the keys starting with char and the length of the longest, None if there is none."""
+        code = ord(char)
+        idx = bisect_left(self.first_chars, code)
+        if idx == len(self.first_chars) or self.first_chars[idx] != code:
+            return None
+        return self.first_starts[idx], self.first_starts[idx + 1], self.first_lengths[idx]
+
+    def find(self, text):
+        """Get the (start, end) spans of the longest key starting at each position of text."""
+        if not self.count:
+            return []
+        if self.first_pattern is None:
+            self.first_pattern = re.compile('[' + ''.join(re.escape(chr(code)) for code in self.first_chars) + ']')
+        keys, pairs, mask = self.keys, self.pairs, self.pair_mask
+        spans = []
+        for match in self.first_pattern.finditer(text):
+            start = match.start()
+            char = match.group()
+            code = ord(char)
+            next_code = ord(text[start + 1]) if start + 1 < len(text) else 0
+            bit = ((code << 21 | next_code) * pair_multiplier >> 32) & mask
+            longer = next_code and pairs[bit >> 3] >> (bit & 7) & 1
+            if not longer:
+                bit = ((code << 21) * pair_multiplier >> 32) & mask
+                if not pairs[bit >> 3] >> (bit & 7) & 1:
+                    continue
+            lo, hi, longest = self.get_first(char)
+            # The keys with a prefix follow each other, their range narrows as the prefix grows
+            end = start + 1 if keys[lo] == char.encode('utf-8') else 0
+            for length in range(2, min(longest, len(text) - start) + 1 if longer else 0):
+                prefix = text[start:start + length].encode('utf-8')
+                lo = bisect_left(keys, prefix, lo, hi)
+                if lo == hi:
+                    break
+                key = keys[lo]
+                if key == prefix:
+                    end = start + length
+                elif not key.startswith(prefix):
+                    break
+            if end:
+                spans.append((start, end))
+        return spans
+
+    def get(self, key):
+        """Get the entry of key in the format of data.text_replace, None if it is not in the dictionary."""
+        first = self.get_first(key[0]) if key else None
+        if first is None or len(key) > first[2]:
+            return None
+        encoded = key.encode('utf-8')
+        idx = bisect_left(self.keys, encoded, first[0], first[1])
+        if idx == first[1] or self.keys[idx] != encoded:
+            return None
+        start = self.values_start
+        info = self.info[idx]
+        return {
+            'replace': self.map[start + self.value_offsets[idx]:start + self.value_offsets[idx + 1]].decode('utf-8'),
+            'lang': self.lang,
+            'switch': "prompt" if info & 1 else "auto",
+            'type': self.types[info >> 1],
+        }
+
+def read_source(source_path, lang=None, switch="prompt", entry_type=None):
+    """
+    Read the entries of a source list as key -> (replacement, switch, type), and its lang.
+
+    Raises ValueError on a bad or duplicated entry.
+    """
+    entries = {}
+    if source_path.endswith('.json'):
+        with open(source_path, encoding='utf-8') as f:
+            table = json.load(f)
+        for key, value in table.items():
+            entry_lang = value.get('lang', lang)
+            if lang is None:
+                lang = entry_lang
+            if entry_lang != lang:
+                raise ValueError(f"{source_path}: {key!r} is in {entry_lang}, a dictionary holds one lang ({lang})")
+            entries[key] = (value['replace'], value.get('switch', switch), value.get('type', entry_type))
+    else:
+        with open(source_path, encoding='utf-8') as f:
+            for line_num, line in enumerate(f, start=1):
+                line = line.rstrip('\r\n')
+                if not line.strip() or line.startswith('#'):
+                    continue
+                fields = line.split('\t')
+                if len(fields) < 2 or len(fields) > 4:
+                    raise ValueError(f"{source_path}:{line_num}: expected key, replacement, switch and type separated by tabs")
+                fields += [switch, entry_type][len(fields) - 2:]
+                if fields[0] in entries:
+                    raise ValueError(f"{source_path}:{line_num}: {fields[0]!r} is listed twice")
+                entries[fields[0]] = (fields[1], fields[2], fields[3] or entry_type)
+
+    if not lang:
+        raise ValueError(f"{source_path}: the lang of the entries is not known, give it with --lang")
+    for key, (replacement, entry_switch, _) in entries.items():
+        if not key or '\x00' in key or '\x00' in replacement:
+            raise ValueError(f"{source_path}: {key!r} is empty or has a NUL character in it")
+        if entry_switch not in switches:
+            raise ValueError(f"{source_path}: {key!r} has switch {entry_switch!r}, should be auto or prompt")
+    return entries, lang
+
+def compile_dictionary(entries, lang, output_path):
+    """Write entries, key -> (replacement, switch, type), as a compiled dictionary to output_path."""
+    keys = sorted(entries)  # code point order, the same as the order of the UTF-8 bytes
+    types = sorted({entry_type or "" for _, _, entry_type in entries.values()})
+    type_index = {entry_type: idx for idx, entry_type in enumerate(types)}
+
+    key_offsets, value_offsets, info = array('I', [0]), array('I', [0]), array('H')
+    first_chars, first_starts, first_lengths = array('I'), array('I'), array('I')
+    key_blob, value_blob = bytearray(), bytearray()
+    for idx, key in enumerate(keys):
+        replacement, switch, entry_type = entries[key]
+        key_blob += key.encode('utf-8')
+        value_blob += replacement.encode('utf-8')
+        key_offsets.append(len(key_blob))
+        value_offsets.append(len(value_blob))
+        info.append(type_index[entry_type or ""] << 1 | (switch == "prompt"))
+        if not first_chars or first_chars[-1] != ord(key[0]):
+            first_chars.append(ord(key[0]))
+            first_starts.append(idx)
+            first_lengths.append(0)
+        first_lengths[-1] = max(first_lengths[-1], len(key))
+    first_starts.append(len(keys))
+
+    prefixes = {(ord(key[0]), ord(key[1]) if len(key) > 1 else 0) for key in keys}
+    pair_bits = 64
+    while pair_bits < 16 * len(prefixes):
+        pair_bits *= 2
+    pairs = bytearray(pair_bits // 8)
+    for first, second in prefixes:
+        bit = get_pair_bit(first, second, pair_bits - 1)
+        pairs[bit >> 3] |= 1 << (bit & 7)
+
+    sections = {}
+    data = bytearray()
+    for name, section in [("key_offsets", key_offsets), ("value_offsets", value_offsets), ("info", info),
+                          ("first_chars", first_chars), ("first_starts", first_starts),
+                          ("first_lengths", first_lengths), ("pairs", pairs), ("keys", key_blob),
+                          ("values", value_blob)]:
+        if isinstance(section, array):
+            if sys.byteorder != 'little':
+                section.byteswap()
+            section = section.tobytes()
+        data += b'\0' * (align(len(data)) - len(data))
+        sections[name] = [len(data), len(section)]
+        data += section
+
+    header = json.dumps({
+        "lang": lang,
+        "count": len(keys),
+        "pair_bits": pair_bits,
+        "types": [entry_type or None for entry_type in types],
+        "digest": hashlib.sha256(data).hexdigest(),
+        "sections": sections,
+    }, ensure_ascii=False).encode('utf-8')
+    head = header_struct.pack(magic, len(header)) + header
+    head += b'\0' * (align(len(head)) - len(head))
+
+    # A new file moved over the old one, processes that have the old one mapped keep reading it
+    import tempfile
+    directory = os.path.dirname(os.path.abspath(output_path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(output_path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(head)
+            f.write(data)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def main():
+    args = sys.argv[1:]
+    if not args or "-h" in args or "--help" in args or args[0] not in ["compile", "list"]:
+        print(__doc__.strip())
+        return
+
+    if args[0] == "list":
+        print(f"Dictionaries in {get_dictionary_path()}:")
+        try:
+            dictionaries = list_dictionaries()
+        except ValueError as e:
+            print(f"Invalid dictionary: {e}")
+            sys.exit(1)
+        for file_path, header in dictionaries:
+            print(f"  {os.path.basename(file_path):30} {header['lang']:10} {header['count']:10,} entries")
+        return
+
+    options = {}
+    for option in ["--lang", "--switch", "--type"]:
+        if option in args:
+            idx = args.index(option)
+            if idx + 1 >= len(args):
+                print(f"Missing value after {option}.")
+                sys.exit(2)
+            options[option] = args[idx + 1]
+            del args[idx:idx + 2]
+    if len(args) != 3:
+        print("Usage: python -m proofreading.dictionary compile SOURCE OUTPUT [--lang LANG] [--switch auto|prompt] [--type NAME]")
+        sys.exit(2)
+
+    source_path, output_path = args[1:]
+    if not output_path.endswith(extension):
+        print(f"Warning: {output_path} does not end in {extension}, it will not be loaded from the dictionary directory.")
+    try:
+        entries, lang = read_source(source_path, options.get("--lang"), options.get("--switch", "prompt"),
+                                    options.get("--type"))
+    except (ValueError, KeyError) as e:
+        print(f"Invalid source: {e}")
+        sys.exit(2)
+    compile_dictionary(entries, lang, output_path)
+    print(f"Compiled {len(entries):,} entries in {lang} to {output_path} ({os.path.getsize(output_path):,} bytes).")
+
+if __name__ == "__main__":
+    main()
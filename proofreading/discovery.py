@@ -0,0 +1,88 @@
+"""
+Index of the files in a directory, shared by the rules of one run.
+
+The directory is walked once, rules select their files from the index by
+extension and skipped names instead of walking again.
+"""
+
+import os
+import fnmatch
+
+def as_set(value):
+    """Get a rule value, a string or a list of strings, as a frozenset."""
+    if isinstance(value, str):
+        value = [value]
+    return frozenset(value)
+
+class FileEntry:
+    __slots__ = ('path', 'name', 'extension', 'mtime_ns', 'size')
+
+    def __init__(self, path, name, extension, mtime_ns, size):
+        self.path = path
+        self.name = name
+        self.extension = extension
+        self.mtime_ns = mtime_ns
+        self.size = size
+
+class FileIndex:
+    """Files under path by extension, hidden files and directories are left out."""
+
+    def __init__(self, path):
+        self.path = path
+        self.by_extension = {}
+        self.scan()
+
+    def scan(self):
+        self.by_extension = {}
+        pending = [self.path]
+        while pending:
+            directory = pending.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    extension = entry.name.rsplit('.', 1)[-1]
+                    file_entry = FileEntry(entry.path, entry.name, extension, stat.st_mtime_ns, stat.st_size)
+                    self.by_extension.setdefault(extension, []).append(file_entry)
+
+        for entries in self.by_extension.values():
+            entries.sort(key=lambda file_entry: file_entry.path)
+
+    def select(self, extensions, skip_files=()):
+        """Get the entries with one of the extensions, sorted by path."""
+        extensions = as_set(extensions)
+        skip_files = as_set(skip_files)
+        selected = []
+        for extension in extensions:
+            selected.extend(entry for entry in self.by_extension.get(extension, []) if entry.name not in skip_files)
+        if len(extensions) > 1:
+            selected.sort(key=lambda entry: entry.path)
+        return selected
+
+    def select_rule(self, rule):
+        """Get the entries of the files a Rule runs on."""
+        return self.select(rule.extensions, rule.skip_files)
+
+    def match(self, pattern):
+        """Get the entries matching a glob pattern relative to the indexed path, like glob.glob."""
+        directory, name_pattern = os.path.split(os.path.normpath(pattern))
+        extension = name_pattern.rsplit('.', 1)[-1]
+        if any(char in extension for char in '*?['):
+            candidates = [entry for entries in self.by_extension.values() for entry in entries]
+            candidates.sort(key=lambda entry: entry.path)
+        else:
+            candidates = self.by_extension.get(extension, [])
+
+        matched = []
+        for entry in candidates:
+            relative_path = os.path.relpath(entry.path, self.path)
+            if os.path.dirname(relative_path) == directory and fnmatch.fnmatchcase(entry.name, name_pattern):
+                matched.append(entry)
+        return matched
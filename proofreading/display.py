@@ -6,144 +6,247 @@ Todo:
 import curses
 import unicodedata
 import os
+import queue
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import lru_cache
+
+lines_nearby = 2  # print out how many lines with text before and after each
+page_cache_size = 64  # rendered pages kept for each text
+
+@lru_cache(maxsize=8192)
+def char_width(char):
+    """Determine the width of a character in a terminal."""
+    width = unicodedata.east_asian_width(char)
+    if width in ('F', 'W'):
+        return 2
+    else:
+        return 1
+
+class TextLayout:
+    """
+    Lines of a text prepared for display.
+
+    The lines with text are indexed once, wrapped lines and rendered pages are
+    cached, so moving between findings does not touch the rest of the text.
+    """
+
+    def __init__(self, text):
+        self.lines = text.splitlines() if isinstance(text, str) else [line.rstrip('\r\n') for line in text]
+        self.text_line_indices = [idx for idx, line in enumerate(self.lines) if line.strip()]
+        self.wrapped = {}
+        self.pages = OrderedDict()
+
+    def wrap(self, idx, available_width):
+        """Wrap line idx to the width, returns the wrapped parts."""
+        key = (idx, available_width)
+        if key not in self.wrapped:
+            wrapped_lines = []
+            current_line = ""
+            current_length = 0
+            for char in self.lines[idx].strip():  # Strip the line for standard display
+                width = char_width(char)
+                if current_length + width > available_width:
+                    wrapped_lines.append(current_line)
+                    current_line = ""
+                    current_length = 0
+                current_line += char
+                current_length += width
+            if current_line:
+                wrapped_lines.append(current_line)
+            self.wrapped[key] = wrapped_lines
+        return self.wrapped[key]
+
+    def surrounding(self, idx):
+        """Get the indexes of the lines with text before and after line idx."""
+        position = bisect_left(self.text_line_indices, idx)
+        above = self.text_line_indices[max(0, position - lines_nearby):position]
+        if position < len(self.text_line_indices) and self.text_line_indices[position] == idx:
+            position += 1
+        below = self.text_line_indices[position:position + lines_nearby]
+        return above, below
+
+    def page(self, idx, available_width):
+        """
+        Render the page of line idx as a list of (text, kind) rows.
+
+        kind is 'label', 'normal', 'center' or 'blank'.
+        """
+        key = (idx, available_width)
+        if key in self.pages:
+            self.pages.move_to_end(key)
+            return self.pages[key]
+
+        above, below = self.surrounding(idx)
+        rows = []
+        for block, kind in [(above, 'normal'), ([idx], 'center'), (below, 'normal')]:
+            for line_idx in block:
+                if line_idx >= len(self.lines):
+                    continue
+                rows.append((f"Line {line_idx + 1}:", 'label'))  # Line label is inserted as a separate line
+                rows.extend((part, kind) for part in self.wrap(line_idx, available_width))
+            rows.append(("", 'blank'))  # Insert an empty line after processing an original block
+
+        self.pages[key] = rows
+        if len(self.pages) > page_cache_size:
+            self.pages.popitem(last=False)
+        return rows
+
+def print_centered(window, y, text, attr=0):
+    width = window.getmaxyx()[1]
+    startx = max(0, (width // 2) - (len(text) // 2))
+    window.addnstr(y, startx, text, max(1, width - startx - 1), attr)
+
+def draw_page(screen, layout, idx, scroll_offset, title, file_path):
+    """Draw the page of line idx, returns the number of rows that did not fit below."""
+    max_y, max_x = screen.getmaxyx()
+    styles = {
+        'label': curses.A_BOLD | curses.color_pair(2),
+        'normal': curses.A_NORMAL,
+        'center': curses.A_BOLD | curses.color_pair(1),
+        'blank': curses.A_NORMAL,
+    }
+
+    screen.erase()
+    print_centered(screen, 1, title)
+    screen.addnstr(3, 2, file_path, max(1, max_x - 3))
+
+    rows = layout.page(idx, max(1, max_x - 4))  # Add some space in boarder
+    y_pos = 5
+    shown = 0
+    for row_text, kind in rows[scroll_offset:]:
+        if y_pos >= max_y - 2:
+            break
+        if row_text:
+            screen.addstr(y_pos, 2, row_text, styles[kind])
+        y_pos += 1
+        shown += 1
+
+    screen.refresh()
+    return len(rows) - scroll_offset - shown
+
+def init_colors():
+    curses.start_color()
+    curses.init_pair(1, curses.COLOR_RED, curses.COLOR_WHITE)
+    curses.init_pair(2, curses.COLOR_GREEN, curses.COLOR_BLACK)
 
-def text(screen, line_numbers, text, file_path, rule):
+def review(screen, findings_queue, on_reviewed=None, history_size=16, waiting_message="Checking files..."):
     """
-    Display specified lines from a multiline text in a curses interface.
+    Review the findings of many files and rules in one curses session.
 
     Parameters:
     - screen: The window object provided by curses.wrapper().
-    - line_numbers: A list of line numbers to display from the text.
-    - text: A multiline string.
-    - file_path: The path to the file (for display purposes).
-    - rule_json: A JSON string containing formatting rules. Currently, this function only expects a 'name' key.
+    - findings_queue: A queue.Queue of items starting with (rule, file_path, text_lines, line_numbers),
+      filled while the review goes on, with None after the last item. More fields of an item are
+      only passed back to on_reviewed.
+    - on_reviewed: Called as on_reviewed(item, count) when leaving an item, count is the number
+      of its line numbers the reviewer went past.
+    - history_size: How many items to keep for going back.
+    - waiting_message: Shown while waiting for the next item, q quits the wait.
 
     Key Controls:
-    - q: Quit the display.
-    - Right Arrow / Down Arrow / n / Space / Enter: Go to the next line number. Exit if already on the last page.
-    - Left Arrow / Up Arrow / p: Go back to the previous line number.
+    - q: Quit the whole session.
+    - Right Arrow / n / Space / Enter: Go to the next line number, from the last one of a file to the next file.
+    - Left Arrow / p: Go back to the previous line number, from the first one of a file to the previous file.
+    - Down Arrow / Up Arrow: Scroll the page.
+    - e: Open the file at the line in vim, in a new gnome-terminal.
     """
 
-    lines_nearby = 2  # print out how many lines with text before and after each
+    init_colors()
+    history = []  # (item, layout, reviewed) of the items shown
+    position = -1
+
+    def next_item():
+        """Move to the next item, from the history or the queue, False when there are no more."""
+        nonlocal position
+        if position + 1 < len(history):
+            position += 1
+            return True
+
+        screen.erase()
+        screen.addstr(1, 2, waiting_message)
+        screen.refresh()
+        screen.nodelay(True)
+        try:
+            while True:
+                try:
+                    item = findings_queue.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    if screen.getch() == ord('q'):
+                        return False
+        finally:
+            screen.nodelay(False)
+        if item is None:
+            findings_queue.put(None)  # keep the end for later calls
+            return False
+
+        history.append([item, TextLayout(item[2]), 0])
+        if len(history) > history_size:
+            history.pop(0)
+        position = len(history) - 1
+        return True
+
+    def leave_item():
+        item, _, reviewed = history[position]
+        if on_reviewed:
+            on_reviewed(item, reviewed)
+
+    if not next_item():
+        return
 
-    curses.start_color()
-    curses.init_pair(1, curses.COLOR_RED, curses.COLOR_WHITE)
-    curses.init_pair(2, curses.COLOR_GREEN, curses.COLOR_BLACK)
-    
-    def print_centered(window, y, text, attr=0):
-        width = window.getmaxyx()[1]
-        startx = (width // 2) - (len(text) // 2)
-        window.addstr(y, startx, text, attr)
-
-    def gather_surrounding_lines(line_no, lines):
-        above = []
-        below = []
-        
-        # Gather lines with text above
-        idx = line_no - 1
-        while len(above) < lines_nearby and idx >= 0:
-            if lines[idx].strip():
-                above.insert(0, lines[idx])
-            idx -= 1
-        
-        # Gather lines with text below
-        idx = line_no + 1
-        while len(below) < lines_nearby and idx < len(lines):
-            if lines[idx].strip():
-                below.append(lines[idx])
-            idx += 1
-        
-        return above, [lines[line_no]], below
-
-    text_lines = text.splitlines()
     idx = 0
-    width = screen.getmaxyx()[1] - 4  # Add some space in boarder
-    
-    def char_width(char):
-        """Determine the width of a character in a terminal."""
-        width = unicodedata.east_asian_width(char)
-        if width in ('F', 'W'):
-            return 2
-        else:
-            return 1
-
-    def wrap_text(line_no, line, available_width):
-        line_label = f"Line {line_no}:"
-        full_line = line.strip()  # Strip the line for standard display
-
-        wrapped_lines = [(line_label, "")]  # Line label is inserted as a separate line
-
-        current_line = ""
-        current_length = 0
-        for char in full_line:
-            if current_length + char_width(char) > available_width:
-                wrapped_lines.append(("", current_line))
-                current_line = ""
-                current_length = 0
-            current_line += char
-            current_length += char_width(char)
-        if current_line:
-            wrapped_lines.append(("", current_line))
-
-        return wrapped_lines
-    
     scroll_offset = 0
-    max_y, _ = screen.getmaxyx()
+    drawn = None
+    rows_below = 0
 
     while True:
-        screen.clear()
-        print_centered(screen, 1, rule["name"])
-        screen.addstr(3, 2, file_path)
-
+        entry = history[position]
+        item, layout, _ = entry
+        rule, file_path, _, line_numbers = item[:4]
+        entry[2] = max(entry[2], idx)
         line_no = line_numbers[idx] - 1
-        above, center, below = gather_surrounding_lines(line_no, text_lines)
-        
-        y_pos = 5
-
-        lines_to_display = []
-        for block, style in [(above, curses.A_NORMAL), (center, curses.A_BOLD | curses.color_pair(1)), (below, curses.A_NORMAL)]:
-            for line in block:
-                actual_line_no = text_lines.index(line) + 1
-                wrapped = wrap_text(actual_line_no, line, width)
-                lines_to_display.extend([(l[0], l[1], style) for l in wrapped])
-            lines_to_display.append((("", "", curses.A_NORMAL)))  # Insert an empty line after processing an original block
-
-        # Display lines based on the scroll offset
-        for i in range(scroll_offset, len(lines_to_display)):
-            if y_pos >= max_y - 2:  # Adjusted for the extra empty line
-                break
-            line_label, line_content, line_style = lines_to_display[i]
-            if line_label:
-                screen.addstr(y_pos, 2, line_label, curses.A_BOLD | curses.color_pair(2))
-                y_pos += 1
-            if line_content:
-                screen.addstr(y_pos, 2, line_content, line_style)
-                y_pos += 1
 
-        screen.refresh()
+        state = (position, idx, scroll_offset, screen.getmaxyx())
+        if state != drawn:
+            title = f"{rule.name} ({idx + 1}/{len(line_numbers)})"
+            rows_below = draw_page(screen, layout, line_no, scroll_offset, title, file_path)
+            drawn = state
 
-        # Wait for user input
         key = screen.getch()
 
-        # Check for 'e' key press
         if key == ord('e'):
             curses.endwin()  # End curses mode temporarily
-            os.system(f'gnome-terminal -t "proofreading: {rule["name"]}" --hide-menubar -- vim +{line_no + 1} {file_path}')  # Gnome
+            os.system(f'gnome-terminal -t "proofreading: {rule.name}" --hide-menubar -- vim +{line_no + 1} {file_path}')  # Gnome
             curses.doupdate()  # Redraw the curses screen after returning
+            drawn = None
         elif key == ord('q'):
+            leave_item()
             break
         elif key in [curses.KEY_RIGHT, ord('n'), ord(' '), 10, 13]:
+            scroll_offset = 0
             if idx < len(line_numbers) - 1:
                 idx += 1
             else:
-                break  # If we're at the last line number, exit the loop
+                entry[2] = len(line_numbers)
+                leave_item()
+                if not next_item():
+                    break
+                idx = 0
+                drawn = None
         elif key == curses.KEY_DOWN:
-            # Only scroll down if there's more to display
-            if y_pos - max_y + 2 + scroll_offset < len(lines_to_display):  # Adjusted for the extra empty line
+            if rows_below > 0:
                 scroll_offset += 1
         elif key == curses.KEY_UP:
             if scroll_offset > 0:
                 scroll_offset -= 1
-        elif key in [curses.KEY_LEFT, ord('p')] and idx > 0:
-            idx -= 1
-        curses.endwin()
+        elif key in [curses.KEY_LEFT, ord('p')]:
+            scroll_offset = 0
+            if idx > 0:
+                idx -= 1
+            elif position > 0:
+                leave_item()
+                position -= 1
+                idx = len(history[position][0][3]) - 1
+        elif key == curses.KEY_RESIZE:
+            drawn = None
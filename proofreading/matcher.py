@@ -0,0 +1,100 @@
+"""
+Multi-pattern matcher for the text_replace table.
+
+An Aho-Corasick automaton is compiled once per target language, so finding
+every candidate in a text node is one linear scan regardless of how many
+entries the table holds. The compiled dictionaries of the language (see
+dictionary.py) are searched in their mapped files next to it.
+"""
+
+from functools import lru_cache
+from . import data
+from .dictionary import list_dictionaries, open_dictionary
+
+def lang_applies(entry_lang, lang):
+    """Check if a text_replace entry of entry_lang applies to text in lang."""
+    return lang == entry_lang or (lang.startswith("zh-") and entry_lang in ["zh", "any"])
+
+class Matcher:
+    """Aho-Corasick automaton over a set of keys, and the dictionaries searched with it."""
+
+    def __init__(self, table, dictionaries=()):
+        self.table = table  # key -> text_replace entry
+        self.dictionaries = list(dictionaries)
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]  # lengths of the keys ending at each state
+
+        for key in table:
+            if not key:
+                continue
+            state = 0
+            for char in key:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                state = next_state
+            self.out[state] = (len(key),)
+
+        # Breadth first, so the fail state is always resolved before its children
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.out[next_state] = self.out[next_state] + self.out[self.fail[next_state]]
+
+    def find(self, text):
+        """
+        Find the keys in text.
+
+        Returns a list of (start, end, key) spans, leftmost-longest and
+        without overlaps, in the same order as in the text.
+        """
+        candidates = []
+        if self.table:
+            goto, fail, out = self.goto, self.fail, self.out
+            state = 0
+            for idx, char in enumerate(text):
+                while state and char not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(char, 0)
+                for length in out[state]:
+                    candidates.append((idx + 1 - length, idx + 1))
+        for dictionary in self.dictionaries:
+            candidates.extend(dictionary.find(text))
+
+        if not candidates:
+            return []
+
+        hits = []
+        position = 0
+        for start, end in sorted(candidates, key=lambda span: (span[0], -span[1])):
+            if start >= position:
+                hits.append((start, end, text[start:end]))
+                position = end
+        return hits
+
+    def get(self, key):
+        """Get the entry of a key found by find, from the text_replace table first, then the dictionaries."""
+        value = self.table.get(key)
+        for dictionary in self.dictionaries:
+            if value is not None:
+                break
+            value = dictionary.get(key)
+        return value
+
+@lru_cache(maxsize=None)
+def get_matcher(lang):
+    """Get the compiled matcher for all text_replace entries and dictionaries that apply to lang."""
+    table = {key: value for key, value in data.text_replace.items() if lang_applies(value['lang'], lang)}
+    dictionaries = [open_dictionary(file_path) for file_path, header in list_dictionaries()
+                    if lang_applies(header['lang'], lang)]
+    return Matcher(table, dictionaries)
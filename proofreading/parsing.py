@@ -0,0 +1,182 @@
+"""
+Parsing layer shared by clean.py, pr.py and chinese_convert.py.
+
+Files are parsed with the lxml XML parser, which keeps the document as
+written, and with the recovering HTML parser when they are not well-formed.
+iter_text_nodes walks the tree without recursion and gives every text node
+with its inherited xml:lang and the line it starts on.
+"""
+
+from lxml import etree
+
+xml_lang = '{http://www.w3.org/XML/1998/namespace}lang'
+xhtml_namespace = 'http://www.w3.org/1999/xhtml'
+epub_type = '{http://www.idpf.org/2007/ops}type'
+note_anchor_types = ['noteref', 'backlink']
+
+# libxml2 reports this for every line after it in HTML mode, and is not exact after it in XML mode
+max_sourceline = 65535
+
+# Written as <tag/> in XHTML, other empty elements keep their end tag
+void_tags = frozenset(["area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"])
+
+class Document:
+    """A parsed file, serialize gives it back with its XML declaration and trailing newline."""
+
+    def __init__(self, tree, is_xml, declaration='', trailing='', has_doctype=True):
+        self.tree = tree
+        self.is_xml = is_xml
+        self.has_doctype = has_doctype
+        self.declaration = declaration  # the XML declaration and the whitespace after it, as in the source
+        self.trailing = trailing  # whitespace after the root element
+
+    @property
+    def root(self):
+        return self.tree.getroot()
+
+    def serialize(self, method="xml"):
+        if method == "xml" and (not self.is_xml or self.root.nsmap.get(None) == xhtml_namespace):
+            # <p></p> would be written as <p/>, which browsers read as an open tag
+            for element in self.root.iter(etree.Element):
+                if element.text is None and len(element) == 0 and local_name(element) not in void_tags:
+                    element.text = ''
+        # The HTML parser adds a doctype to files without one
+        node = self.tree if self.is_xml or self.has_doctype else self.root
+        content = etree.tostring(node, encoding='unicode', method=method)
+        return self.declaration + content + self.trailing
+
+def split_declaration(content):
+    """Split the XML declaration with the whitespace after it from content."""
+    if not content.startswith('<?xml'):
+        return '', content
+    end = content.find('?>')
+    if end < 0:
+        return '', content
+    end += 2
+    while end < len(content) and content[end] in ' \t\r\n':
+        end += 1
+    return content[:end], content[end:]
+
+def parse(content):
+    """Parse the text of a file, as XML if it is well-formed, else as HTML."""
+    declaration, body = split_declaration(content)
+    trailing = body[len(body.rstrip()):]
+    try:
+        parser = etree.XMLParser(huge_tree=True, remove_blank_text=False, resolve_entities=False)
+        # Parse the whole content, so the line numbers count the declaration too
+        root = etree.fromstring(content.encode('utf-8'), parser)
+        return Document(root.getroottree(), True, declaration, trailing)
+    except etree.XMLSyntaxError:
+        parser = etree.HTMLParser(recover=True, huge_tree=True, encoding='utf-8')
+        root = etree.fromstring(content.encode('utf-8'), parser)
+        if root is None:
+            root = etree.fromstring('<html/>', parser)
+        prolog = body.lower().partition('<html')[0]
+        has_doctype = '<!doctype' in prolog
+        return Document(root.getroottree(), False, declaration, trailing, has_doctype)
+
+def parse_file(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return parse(f.read())
+
+def local_name(element):
+    """Get the tag of element without namespace, None for comments and processing instructions."""
+    tag = element.tag
+    if not isinstance(tag, str):
+        return None
+    if tag[0] == '{':
+        return tag[tag.index('}') + 1:]
+    return tag.split(':')[-1]
+
+def get_lang(element, default=''):
+    return element.get(xml_lang) or element.get('xml:lang') or default
+
+def set_lang(element, lang):
+    """Set the xml:lang of element, under the same attribute name it is read from."""
+    key = 'xml:lang' if element.get('xml:lang') is not None else xml_lang
+    element.set(key, lang)
+
+def is_note_anchor(element):
+    """Check if element is an endnote number or backlink, their text is not part of the content."""
+    return local_name(element) == "a" and (element.get(epub_type) or element.get('epub:type')) in note_anchor_types
+
+class TextNode:
+    """A text or tail of an element, replace changes it in the tree."""
+
+    __slots__ = ('element', 'is_tail', 'text', 'lang', 'line', 'selected', 'is_comment')
+
+    def __init__(self, element, is_tail, text, lang, line, selected, is_comment=False):
+        self.element = element
+        self.is_tail = is_tail
+        self.text = text
+        self.lang = lang
+        self.line = line  # line of the first character
+        self.selected = selected  # in one of the selected tags
+        self.is_comment = is_comment  # text of a comment or processing instruction
+
+    def replace(self, text):
+        if self.is_tail:
+            self.element.tail = text
+        else:
+            self.element.text = text
+        self.text = text
+
+def iter_text_nodes(root, tags=None, lang=None, skip_note_anchors=True):
+    """
+    Yield every text node under root as TextNode, in document order.
+
+    Nodes in one of tags (local names), or anywhere if tags is None, are
+    selected. The text of note anchors is left out, their tail is not.
+    Line numbers count the newlines of the text and catch up with the
+    source lines of the elements, so newlines inside tags are counted too.
+    """
+    tags = None if tags is None else frozenset(tags)
+    lang = get_lang(root, lang or '')
+    selected = tags is None or local_name(root) in tags
+    line = root.sourceline if root.sourceline and root.sourceline < max_sourceline else 1
+
+    text = root.text
+    if text:
+        yield TextNode(root, False, text, lang, line, selected)
+        line += text.count('\n')
+
+    # Open elements with the lang and selection of their content.
+    # The texts are kept before they are yielded, the caller may replace them.
+    stack = [(root, iter(root), lang, selected)]
+    while stack:
+        element, children, lang, selected = stack[-1]
+        child = next(children, None)
+
+        if child is None:
+            stack.pop()
+            text = element.tail
+            if stack and text:
+                # The tail belongs to the parent
+                _, _, parent_lang, parent_selected = stack[-1]
+                yield TextNode(element, True, text, parent_lang, line, parent_selected)
+                line += text.count('\n')
+            continue
+
+        # Comments report the line they end on, elements the line their start tag ends on
+        is_element = isinstance(child.tag, str)
+        if is_element and child.sourceline and line < child.sourceline < max_sourceline:
+            line = child.sourceline
+
+        text = child.text
+        if not is_element or (skip_note_anchors and is_note_anchor(child)):
+            if text:
+                if not is_element:
+                    yield TextNode(child, False, text, lang, line, False, True)
+                line += text.count('\n')
+            text = child.tail
+            if text:
+                yield TextNode(child, True, text, lang, line, selected)
+                line += text.count('\n')
+            continue
+
+        child_lang = get_lang(child, lang)
+        child_selected = selected or local_name(child) in tags
+        if text:
+            yield TextNode(child, False, text, child_lang, line, child_selected)
+            line += text.count('\n')
+        stack.append((child, iter(child), child_lang, child_selected))
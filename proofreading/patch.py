@@ -0,0 +1,226 @@
+"""
+Span patches against the source of a parsed file.
+
+Changed text nodes are turned into (offset, length, replacement) edits on
+the original buffer, so the file is written back byte for byte except the
+changed text: no re-serialization, entities and whitespace elsewhere stay
+as written. A raw scanner finds the source span of every text node in the
+same order lxml reads them.
+"""
+
+import os
+import re
+import difflib
+import tempfile
+
+# Markup in the source, text is whatever is between two of them
+markup_pattern = re.compile(
+    r'<!--.*?-->'
+    r'|<\?.*?\?>'
+    r'|<!DOCTYPE(?:[^>\[]|\[.*?\])*>'
+    r'|</[^>]*>'
+    r'|<(?:[^>"\']|"[^"]*"|\'[^\']*\')*>',
+    re.S | re.I)
+
+reference_pattern = re.compile(r'&(#x[0-9a-fA-F]+|#[0-9]+|[A-Za-z][A-Za-z0-9]*);|\r\n?')
+predefined_entities = {"amp": "&", "lt": "<", "gt": ">", "quot": '"', "apos": "'"}
+
+def decode(raw, offset=0):
+    """
+    Decode the character references of raw text like the XML parser does.
+
+    Returns (text, offsets), offsets[k] is the offset in the source of the
+    k-th character of text, with one more entry for the end. None if raw has
+    an entity the parser would not know.
+    """
+    if '&' not in raw and '\r' not in raw:
+        return raw, None  # same as the source, offsets are offset + k
+
+    pieces = []
+    offsets = []
+    position = 0
+    for match in reference_pattern.finditer(raw):
+        start, end = match.span()
+        pieces.append(raw[position:start])
+        offsets.extend(range(offset + position, offset + start))
+        name = match.group(1)
+        if name is None:
+            char = '\n'  # line ends are normalized
+        elif name[0] == '#':
+            char = chr(int(name[2:], 16) if name[1] in 'xX' else int(name[1:]))
+        elif name in predefined_entities:
+            char = predefined_entities[name]
+        else:
+            return None
+        pieces.append(char)
+        offsets.append(offset + start)
+        position = end
+    pieces.append(raw[position:])
+    offsets.extend(range(offset + position, offset + len(raw) + 1))
+    return ''.join(pieces), offsets
+
+def escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def scan_text_spans(content):
+    """
+    Get the source span of the text and tail of every node under the root element.
+
+    Returns {(ordinal, is_tail): (start, end)}, ordinal is the position of
+    the node in root.iter(). None if the source has markup the scanner
+    can not follow.
+    """
+    if '<![CDATA[' in content:
+        return None
+
+    spans = {}
+    ordinal = -1  # the root is the first start tag
+    stack = []
+    slot = None
+    position = 0
+    for match in markup_pattern.finditer(content):
+        start, end = match.span()
+        if slot is not None and start > position:
+            spans[slot] = (position, start)
+        position = end
+
+        token = match.group()
+        if token.startswith('</'):
+            if not stack:
+                return None
+            slot = (stack.pop(), True)
+            if not stack:
+                return spans  # the root is closed, the rest is not in the tree
+        elif token.startswith('<!--') or token.startswith('<?'):
+            if stack:
+                ordinal += 1
+                slot = (ordinal, True)
+        elif token.startswith('<!'):
+            continue  # doctype before the root
+        else:
+            ordinal += 1
+            if token.endswith('/>'):
+                if not stack:
+                    return spans  # empty root
+                slot = (ordinal, True)
+            else:
+                stack.append(ordinal)
+                slot = (ordinal, False)
+    return None
+
+class Patcher:
+    """Collect the text changes of a parsed document as edits on its source."""
+
+    def __init__(self, content, document):
+        self.content = content
+        self.document = document
+        self.edits = []  # (offset, length, replacement)
+        self.changed = False
+        # The list keeps the element proxies alive, so they stay the same keys
+        self.elements = list(document.root.iter())
+        self.ordinals = {element: idx for idx, element in enumerate(self.elements)}
+        self.spans = self.get_spans()
+
+    def get_spans(self):
+        """Get the source spans of the text nodes, None if they do not match the tree."""
+        if not self.document.is_xml:
+            return None  # the HTML parser adds and moves tags
+        spans = scan_text_spans(self.content)
+        if spans is None:
+            return None
+
+        for idx, element in enumerate(self.elements):
+            slots = [(True, element.tail if idx else None)]
+            if isinstance(element.tag, str):
+                slots.append((False, element.text))  # the text of a comment is part of its markup
+            for is_tail, text in slots:
+                span = spans.get((idx, is_tail))
+                raw = self.content[span[0]:span[1]] if span else ''
+                decoded = decode(raw)
+                if decoded is None or decoded[0] != (text or ''):
+                    return None
+        return spans
+
+    @property
+    def patchable(self):
+        return self.spans is not None
+
+    def replace(self, node, text):
+        """Replace the text of a TextNode, in the tree and as edits on the source."""
+        old_text = node.text
+        node.replace(text)
+        self.changed = True
+        if self.spans is None:
+            return
+
+        start, end = self.spans[(self.ordinals[node.element], node.is_tail)]
+        _, offsets = decode(self.content[start:end], start)
+
+        # Only the part between the common prefix and suffix changed
+        prefix = 0
+        limit = min(len(old_text), len(text))
+        while prefix < limit and old_text[prefix] == text[prefix]:
+            prefix += 1
+        suffix = 0
+        limit -= prefix
+        while suffix < limit and old_text[-1 - suffix] == text[-1 - suffix]:
+            suffix += 1
+        old_end, new_end = len(old_text) - suffix, len(text) - suffix
+
+        if offsets is None or offsets[old_end] - offsets[prefix] == old_end - prefix:
+            # No reference in the changed part, it is replaced as one edit
+            opcodes = [('replace', prefix, old_end, prefix, new_end)]
+        else:
+            # Diff the changed part, so the references it keeps stay as written
+            matcher = difflib.SequenceMatcher(None, old_text[prefix:old_end], text[prefix:new_end], autojunk=False)
+            opcodes = [(tag, i1 + prefix, i2 + prefix, j1 + prefix, j2 + prefix) for tag, i1, i2, j1, j2 in matcher.get_opcodes()]
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == 'equal':
+                continue
+            if offsets is None:
+                raw_start, raw_end = start + i1, start + i2
+            else:
+                raw_start, raw_end = offsets[i1], offsets[i2]
+            self.edits.append((raw_start, raw_end - raw_start, escape(text[j1:j2])))
+
+    def get_output(self):
+        """Get the new content of the file, patched if possible, else serialized."""
+        if not self.changed:
+            return self.content
+        if self.spans is None:
+            return self.document.serialize()
+        return apply_edits(self.content, self.edits)
+
+def apply_edits(content, edits):
+    """Apply (offset, length, replacement) edits to content in one copy."""
+    pieces = []
+    position = 0
+    for offset, length, replacement in sorted(edits, key=lambda edit: edit[0]):
+        if offset < position:
+            raise ValueError(f"Overlapping edit at offset {offset}")
+        pieces.append(content[position:offset])
+        pieces.append(replacement)
+        position = offset + length
+    pieces.append(content[position:])
+    return ''.join(pieces)
+
+def write_atomic(file_path, content):
+    """Write content to a temporary file next to file_path and move it over, keeps the file mode."""
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(file_path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            f.write(content)
+        if os.path.exists(file_path):
+            os.chmod(tmp_path, os.stat(file_path).st_mode & 0o7777)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def get_diff(file_path, old, new):
+    """Get the unified diff of a file change, like git diff shows it."""
+    return ''.join(difflib.unified_diff(
+        old.splitlines(keepends=True), new.splitlines(keepends=True),
+        fromfile="a/" + file_path.lstrip(os.sep), tofile="b/" + file_path.lstrip(os.sep)))
@@ -3,6 +3,7 @@ Script for proofreading (pr).
 
 Usage:
     python pr.py pr <directory>
+    python pr.py pr --report json <directory>
 
 Arguments:
     pr: start the proofreading process
@@ -14,11 +15,35 @@ Arguments:
     -r {all|NAME_OF_RULE}
         if 'all' or null, check all rules;
         if others, try check the rule with that name.
+
+    --stream: extract text with iterparse, keeps memory flat on very large files.
+
+    --report {json|text}: check all files without the terminal interface and print the findings,
+        exit with 1 if anything is found.
+
+    --jobs N: number of worker processes for --report, default to the number of CPUs.
+
+    --resume: only show the findings not reviewed yet.
+
+    --store PATH: findings store to use, default to ~/.cache/proofreading/findings.sqlite.
+        Files that did not change since they were checked are not checked again.
+        With --report the store is only used when --store PATH is given, a report checks every file.
+
+    --no-store: do not read or write the findings store.
+
+    --watch: keep running after the first check, the files that change are checked again and their
+        findings show up in the review session, or are printed as one more report with --report.
+        Stop with q in the session, or Ctrl-C.
+
+    --stats: print the time of each phase and the counters of the run.
+
+    --stats-json PATH: same as --stats, also write them to PATH as JSON.
     --
 
 Features:
     - List the line in question with line number and lines nearby.
     - Press 'e' to open the file in editor.
+    - All files and rules are reviewed in one session, files are checked in the background.
 
 Dependencies:
 
@@ -26,79 +51,393 @@ Install Dependencies:
 
 """
 
-import sys, subprocess
+import sys
 import os
-import json
-from lxml import etree
+import json, hashlib
+import queue, threading
 import utils
-from utils import get_current_branch
-from data import RULES, text_style
+from utils import get_current_branch, get_jobs
+from utils import stats  # not a bare "import stats", that would load a second Stats object
+from discovery import FileIndex
+from data import rules, text_style
+from ruleset import build_rules
+from watch import Watcher
+
+# lxml (parsing), curses (display), sqlite3 (store) and the process pool are imported where they are used, keeps startup fast
+
+excerpt_length = 60  # characters of the line end in a finding
+finding_keys = ["file", "line", "column", "rule", "excerpt"]
+review_prefetch = 4  # files checked ahead of the reviewer
+
+def extract_lines(rule, file_path, stream=False):
+    """Get the text of the tags in the rule as a list of lines, in the same line as in the file."""
+    if not stats.enabled:
+        return read_lines(rule, file_path, stream)
+
+    with stats.timer("pr.extract.stream" if stream else "pr.extract", file_path):
+        text_lines = read_lines(rule, file_path, stream)
+    stats.count("pr.files")
+    stats.count("pr.bytes_read", os.path.getsize(file_path))
+    stats.count("pr.lines", len(text_lines))
+    return text_lines
+
+def read_lines(rule, file_path, stream=False):
+    """Extract the lines of extract_lines, without stats."""
+    if stream:
+        # Lines without selected text are the same empty string, no padding needed
+        text_lines = []
+        for line_num, line in iter_text_lines(rule, file_path):
+            text_lines.extend([''] * (line_num - 1 - len(text_lines)))
+            text_lines.append(line)
+        return text_lines
+
+    from parsing import parse_file, iter_text_nodes
+    document = parse_file(file_path)
 
-def process_rule(rule, file_path):
-    parser = etree.HTMLParser(recover=True)  # recover=True helps in parsing malformed XML
-    with open(file_path, 'r', encoding='utf-8') as f:
-        tree = etree.parse(f, parser=parser)
+    # Text outside the tags in the rule is replaced with spaces, so the line and column stay the same
+    text_lines = ['']
+    for node in iter_text_nodes(document.root, rule.tags):
+        text = node.text
+        if node.is_comment or not (node.selected or node.is_tail):
+            text = "\n".join(" " * len(line) for line in text.split("\n"))
+        text_lines.extend([''] * (node.line - len(text_lines)))
+        pieces = text.split("\n")
+        text_lines[-1] += pieces[0]
+        text_lines.extend(pieces[1:])
 
-    # This recursive function goes through the XML tree and appends all text it finds
-    def recursive_extract(node, processAll):
-        # processAll: process tags within selected tag without check for selection.
+    if not any(text_lines):
+        return []
+    return text_lines
 
-        # Remove endnotes numbers
-        if node.tag == "a" and node.get('epub:type') in ['noteref', 'backlink']:
-            # If yes, skip its text and children
+def get_rule_version(rule, stream=False):
+    """Get the version of a rule, changes with its settings, the checks and the extraction mode."""
+    content = json.dumps([rule.to_dict(), utils.checks_version, stream], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
+
+def get_store_key(rule, file_path, stream=False):
+    """Get the key of a file in the findings store, by its real path so any spelling of the path finds it."""
+    from store import get_content_hash
+    return os.path.realpath(file_path), rule.name, get_content_hash(file_path), get_rule_version(rule, stream)
+
+def set_file_path(findings, file_path):
+    """Show findings of the store under the path the file was given with, the store has its real path."""
+    for finding in findings:
+        finding["file"] = file_path
+    return findings
+
+def get_findings(rule, file_path, stream=False, store=None):
+    """
+    Get the findings of a file, with a store only check it if it changed since the last time.
+
+    Returns (findings, text lines), the lines are None when the findings come from the store.
+    """
+    findings = text_lines = None
+    if store:
+        store_key = get_store_key(rule, file_path, stream)
+        findings = store.get(*store_key)
+    if findings is None:
+        findings, text_lines = check_file(rule, file_path, stream)
+        if store:
+            findings = store.put(*store_key, findings)
+    return (set_file_path(findings, file_path) if store else findings), text_lines
+
+def queue_findings(rule, file_path, findings_queue, stop, errors, stream=False, store=None, resume=False):
+    """Put the file into findings_queue if it has findings, waits while the queue is full."""
+    try:
+        findings, text_lines = get_findings(rule, file_path, stream, store)
+        if resume:
+            findings = [finding for finding in findings if not finding["reviewed"]]
+        if not findings:
             return
+        if text_lines is None:
+            text_lines = extract_lines(rule, file_path, stream)  # not parsed yet, the findings were stored
+    except Exception as e:
+        errors.append(f"{file_path}: {rule.name}: {type(e).__name__}: {e}")
+        return
+
+    item = (rule, file_path, text_lines, [finding["line"] for finding in findings], findings)
+    while not stop.is_set():
+        try:
+            findings_queue.put(item, timeout=0.2)
+            break
+        except queue.Full:
+            pass
+
+def produce_findings(selected_rules, index, findings_queue, stop, errors, stream=False, store=None, resume=False,
+                     watcher=None):
+    """
+    Check the files of the rules and put the files with findings into findings_queue.
+
+    Runs in the background of a review session, the queue is bounded so only a
+    few files are loaded ahead of the reviewer. With a watcher, the files that
+    change are checked again until stop is set. Puts None at the end.
+    """
+    try:
+        for rule in selected_rules:
+            for entry in index.select_rule(rule):
+                if stop.is_set():
+                    return
+                queue_findings(rule, entry.path, findings_queue, stop, errors, stream, store, resume)
+
+        while watcher and not stop.is_set():
+            for file_path in watcher.changes(timeout=0.5):
+                for rule in selected_rules:
+                    if stop.is_set():
+                        return
+                    if rule.matches(file_path):
+                        queue_findings(rule, file_path, findings_queue, stop, errors, stream, store, resume)
+    finally:
+        findings_queue.put(None)
+
+def review_session(selected_rules, index, stream=False, store=None, resume=False, watcher=None):
+    """
+    Review the findings of all rules and files in one curses session, while they are checked in the background.
+
+    With a watcher the session goes on after the last file, the files that change show up as they are checked.
+    """
+    import curses
+    import display
+    findings_queue = queue.Queue(maxsize=review_prefetch)
+    stop = threading.Event()
+    errors = []
+
+    def on_reviewed(item, count):
+        if store:
+            store.mark_reviewed([finding["id"] for finding in item[4][:count]])
+
+    producer = threading.Thread(target=produce_findings, daemon=True,
+                                args=(selected_rules, index, findings_queue, stop, errors, stream, store, resume, watcher))
+    producer.start()
+    waiting_message = "Watching for changes... (q to quit)" if watcher else "Checking files... (q to quit)"
+    try:
+        curses.wrapper(display.review, findings_queue, on_reviewed, waiting_message=waiting_message)
+    finally:
+        stop.set()
+        # Unblock the producer if the queue is full
+        while producer.is_alive():
+            try:
+                findings_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    for error in errors:
+        print(f"Error: {error}")
 
-        if node.tag in rule["tag"]: 
-            processAll = True
+def check_file(rule, file_path, stream=False):
+    """Run the check of the rule on a file, returns the list of findings and the text lines they are in."""
+    text_lines = extract_lines(rule, file_path, stream)
+    findings = []
+    with stats.timer(f"pr.check.{rule.name}", file_path):
+        line_numbers = rule.handler(text_lines)
+    stats.count(f"pr.findings.{rule.name}", len(line_numbers))
+    for line_num in line_numbers:
+        line = text_lines[line_num - 1].rstrip()
+        excerpt = line.strip()
+        if len(excerpt) > excerpt_length:
+            excerpt = '…' + excerpt[-excerpt_length:]
+        findings.append({
+            "file": file_path,
+            "line": line_num,
+            "column": len(line),
+            "rule": rule.name,
+            "excerpt": excerpt,
+        })
+    return findings, text_lines
 
-        # Process tags in the rules only
-        if node.text:
-            if processAll or (node.tag in rule["tag"]): 
-                yield node.text
+def init_worker(stats_enabled):
+    stats.pop()  # a forked worker starts with a copy of the counts of the main process
+    if stats_enabled:
+        stats.enable()
+
+def check_file_task(rule, file_path, stream):
+    """
+    Check a file in a worker, return the error message instead of raising.
+
+    Returns (findings, error, worker stats), the stats are None when disabled.
+    """
+    try:
+        findings, error = check_file(rule, file_path, stream)[0], None
+    except Exception as e:
+        findings, error = [], f"{type(e).__name__}: {e}"
+    return findings, error, stats.pop() if stats.enabled else None
+
+def iter_text_lines(rule, file_path):
+    """
+    Stream the text of the tags in the rule line by line.
+
+    Yields (line_num, text) for each source line with selected text. The text
+    of an element is read once the next event shows it is complete, and
+    elements are cleared as soon as their tail is read.
+    """
+    line_num = 1
+    parts = []  # selected text on line_num
+    selected = [False]  # processAll of each open element
+    skip = 0  # depth inside skipped anchors
+    previous = None
+
+    def feed(text, is_selected):
+        """Add text at the current line, return the lines it finished."""
+        nonlocal line_num, parts
+        finished = []
+        pieces = text.split("\n")
+        for piece in pieces[:-1]:
+            if is_selected:
+                parts.append(piece)
+            if parts:
+                finished.append((line_num, ''.join(parts)))
+                parts = []
+            line_num += 1
+        if is_selected and pieces[-1]:
+            parts.append(pieces[-1])
+        return finished
+
+    from lxml import etree
+    from parsing import max_sourceline, is_note_anchor, local_name
+    events = etree.iterparse(file_path, events=('start', 'end', 'comment', 'pi'), html=True, recover=True)
+    for event, node in events:
+        # The text of the previous start, or the tail of the previous end, is complete now
+        if previous is not None:
+            previous_event, previous_node = previous
+            if previous_event == 'start':
+                if previous_node.text:
+                    yield from feed(previous_node.text, selected[-1] and not skip)
             else:
-                # Replace text content with spaces but retain line breaks
-                yield "\n".join(" " * len(line) for line in node.text.split("\n"))
-    
-        # If the node has children, recursively call this function on each child
-        for child in node:
-            yield from recursive_extract(child, processAll)
-            # If the child node has tail text, append it
-            if child.tail:
-                yield child.tail
-
-    # Joining the yielded results to get the entire text content
-    content = ''.join(recursive_extract(tree.getroot(), False))
-    
-    if content:
-        # Add one line in front for compensate the lost which might caused by the first xml line in xhtml files
-        content = '\n' + content
-        getattr(utils, rule["name"])(content, file_path, rule)
-
-def apply_rule(rule, path, rules):
-    # Add missing key value to rule
-    rule_default = next((d for d in rules if d["name"] == "default"), None)
-    if rule_default and rule:
-        # Add from default
-        for key, value in rule_default.items():
-            if key not in rule:
-                rule[key] = value
-
-    for root, dirs, files in os.walk(path):
-        # Modify 'dirs' in-place to remove directories that start with a dot.
-        # This also ensures that os.walk doesn't traverse into these directories.
-        dirs[:] = [d for d in dirs if not d.startswith('.')]
-
-        for file in files:
-            check_hidden = not file.startswith('.')
-            check_name = os.path.basename(file) not in rule["skip_file"]
-            check_extension = file.split('.')[-1] in rule["extension"]
-            if check_hidden and check_name and check_extension:
-                file_path = os.path.join(root, file)
-                process_rule(rule, file_path)
+                if previous_node.tail:
+                    yield from feed(previous_node.tail, not skip)
+                previous_node.clear()
+                parent = previous_node.getparent()
+                while parent is not None and previous_node.getprevious() is not None:
+                    del parent[0]
+
+        if event == 'start':
+            if node.sourceline and line_num < node.sourceline < max_sourceline:
+                # Catch up with newlines inside tags, doctype and xml declaration
+                if parts:
+                    yield line_num, ''.join(parts)
+                    parts = []
+                line_num = node.sourceline
+
+            # Remove endnotes numbers
+            if skip or is_note_anchor(node):
+                skip += 1
+            selected.append(selected[-1] or local_name(node) in rule.tags)
+        elif event == 'end':
+            selected.pop()
+            if skip:
+                skip -= 1
+        elif node.text:
+            yield from feed(node.text, False)  # comments and processing instructions only count lines
+
+        previous = (event, node)
+
+    if previous is not None and previous[0] != 'start' and previous[1].tail:
+        yield from feed(previous[1].tail, True)
+    if parts:
+        yield line_num, ''.join(parts)
+
+def report(selected_rules, index, output_format, jobs, stream=False, store=None):
+    """Check the rules on all files in a worker pool and print the findings, returns the exit code."""
+    tasks = []
+    for rule in selected_rules:
+        tasks.extend((rule, entry.path) for entry in index.select_rule(rule))
+    return report_tasks(tasks, output_format, jobs, stream, store)
+
+def watch_report(selected_rules, watcher, output_format, stream=False, store=None):
+    """
+    Report the findings of the files that change, until Ctrl-C. Returns the exit code of the last report.
+
+    Every batch of changes is printed as a report of its own, JSON reports take one line each.
+    """
+    print(f"Watching {watcher.path} for changes ({watcher.backend}), press Ctrl-C to stop.", file=sys.stderr)
+    exit_code = 0
+    try:
+        while True:
+            changed = watcher.changes()
+            tasks = [(rule, file_path) for rule in selected_rules for file_path in changed if rule.matches(file_path)]
+            if tasks:
+                # A few files at a time, checked in this process where everything is loaded already
+                exit_code = report_tasks(tasks, output_format, 1, stream, store, compact=True)
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    return exit_code
+
+def report_tasks(tasks, output_format, jobs, stream=False, store=None, compact=False):
+    """Check the (rule, file_path) tasks and print the findings, returns the exit code."""
+    # Reuse the stored findings of unchanged files
+    task_results = [None] * len(tasks)
+    store_keys = [None] * len(tasks)
+    pending = []
+    for idx, (rule, file_path) in enumerate(tasks):
+        stored = None
+        if store:
+            store_keys[idx] = get_store_key(rule, file_path, stream)
+            stored = store.get(*store_keys[idx])
+        if stored is None:
+            pending.append(idx)
+        else:
+            task_results[idx] = (set_file_path(stored, file_path), None)
+
+    if jobs > 1 and len(pending) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(stats.enabled,))
+        results = executor.map(check_file_task, [tasks[idx][0] for idx in pending], [tasks[idx][1] for idx in pending],
+                               [stream] * len(pending), chunksize=8)
+    else:
+        executor = None
+        results = (check_file_task(tasks[idx][0], tasks[idx][1], stream) for idx in pending)
+
+    try:
+        for idx, (file_findings, error, worker_stats) in zip(pending, results):
+            stats.merge(worker_stats)
+            if store and not error:
+                store.put(*store_keys[idx], file_findings)
+            task_results[idx] = (file_findings, error)
+    finally:
+        if executor:
+            executor.shutdown()
+
+    findings = []
+    errors = []
+    for (rule, file_path), (file_findings, error) in zip(tasks, task_results):
+        findings.extend({key: finding[key] for key in finding_keys} for finding in file_findings)
+        if error:
+            errors.append({"file": file_path, "rule": rule.name, "error": error})
+
+    by_rule = {}
+    for finding in findings:
+        by_rule[finding["rule"]] = by_rule.get(finding["rule"], 0) + 1
+    summary = {
+        "files_checked": len({file_path for _, file_path in tasks}),
+        "files_with_findings": len({finding["file"] for finding in findings}),
+        "findings": len(findings),
+        "errors": len(errors),
+        "by_rule": by_rule,
+    }
+
+    if output_format == "json":
+        print(json.dumps({"findings": findings, "errors": errors, "summary": summary}, ensure_ascii=False,
+                         indent=None if compact else 1))
+    else:
+        for finding in findings:
+            print(f"{finding['file']}:{finding['line']}:{finding['column']}: {finding['rule']}: {finding['excerpt']}")
+        for error in errors:
+            print(f"{error['file']}: {error['rule']}: error: {error['error']}")
+        print(f"{summary['findings']} findings in {summary['files_with_findings']} of {summary['files_checked']} files"
+              + (f", {summary['errors']} errors" if errors else "") + ".")
+
+    return 1 if findings or errors else 0
+
+# Rules with a check, built once, a mistake in data.rules stops the script here
+pr_rules = build_rules(rules, utils.rule_checks, list(utils.rule_checks))
 
 def main():
-    rules = json.loads(RULES)
-    
+    if "-h" in sys.argv or "--help" in sys.argv:
+        print(__doc__.strip())
+        return
+    stats_path = stats.setup(sys.argv)
+    jobs = get_jobs(sys.argv, os.cpu_count() or 1)
+
     if len(sys.argv) < 2 or sys.argv[1] not in ["pr", "--no-branch-check"]:
         print("Invalid arguments")
         return
@@ -108,6 +447,45 @@ def main():
     if "-r" in sys.argv:
         rule_name = sys.argv[sys.argv.index("-r") + 1]
     path = sys.argv[-1]
+    stream = '--stream' in sys.argv
+    resume = '--resume' in sys.argv
+    watch = '--watch' in sys.argv
+    store = None
+    store_path = None
+    if "--store" in sys.argv:
+        idx = sys.argv.index("--store")
+        if idx + 1 >= len(sys.argv):
+            print("Missing path after --store.")
+            sys.exit(1)
+        store_path = sys.argv[idx + 1]
+    # A report, like in CI, leaves no store behind unless it is asked for
+    if '--no-store' not in sys.argv and (store_path or "--report" not in sys.argv):
+        from store import FindingsStore
+        store = FindingsStore(store_path)
+
+    output_format = None
+    if "--report" in sys.argv:
+        output_format = sys.argv[sys.argv.index("--report") + 1]
+        if output_format not in ["json", "text"]:
+            print("Invalid report format. Use either 'json' or 'text'.")
+            sys.exit(2)
+
+        # No questions asked in report mode
+        if rule_name == "all" or rule_name is None:
+            selected_rules = list(pr_rules.values())
+        elif rule_name in pr_rules:
+            selected_rules = [pr_rules[rule_name]]
+        else:
+            print(f"Rule named {rule_name} not found or can not run in report mode.")
+            sys.exit(2)
+        # Files changed while the first report runs are checked again
+        watcher = Watcher(path) if watch else None
+        exit_code = report(selected_rules, FileIndex(path), output_format, jobs, stream, store)
+        if watcher:
+            exit_code = watch_report(selected_rules, watcher, output_format, stream, store)
+            watcher.close()
+        stats.report(stats_path)
+        sys.exit(exit_code)
 
     # Git branch check
     if '--no-branch-check' not in sys.argv:
@@ -127,16 +505,17 @@ def main():
             if choice != 'y':
                 sys.exit(0)
 
+    watcher = Watcher(path) if watch else None
+    index = FileIndex(path)
     if rule_name == "all" or rule_name is None:
-        for rule in rules:
-            apply_rule(rule, path, rules)
+        review_session(list(pr_rules.values()), index, stream, store, resume, watcher)
+    elif rule_name in pr_rules:
+        review_session([pr_rules[rule_name]], index, stream, store, resume, watcher)
     else:
-        for rule in rules:
-            if rule["name"] == rule_name:
-                apply_rule(rule, path, rules)
-                break
-        else:
-            print(f"Rule named {rule_name} not found.")
+        print(f"Rule named {rule_name} not found.")
+    if watcher:
+        watcher.close()
+    stats.report(stats_path)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,110 @@
+"""
+Rule tables of clean.py and pr.py, built once from data.rules.
+
+A Rule has the keys of the default rule filled in, its extensions, tags
+and skipped files as frozensets and the function that runs it. Rules can
+not be changed once built, and data.rules is checked while it is built,
+so a mistake in it stops the script at start instead of in the middle of
+a run.
+"""
+
+import os
+
+rule_keys = frozenset(["name", "location", "extension", "tag", "switch", "skip_file"])
+switches = frozenset(["prompt", "auto"])
+
+class RuleError(ValueError):
+    pass
+
+class Rule:
+    __slots__ = ('name', 'location', 'extensions', 'tags', 'switch', 'skip_files', 'handler')
+
+    def __init__(self, name, location=(), extensions=(), tags=(), switch="prompt", skip_files=(), handler=None):
+        values = (name, tuple(location), frozenset(extensions), frozenset(tags), switch, frozenset(skip_files), handler)
+        for key, value in zip(self.__slots__, values):
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"Rule {self.name} can not be changed")
+
+    def __delattr__(self, key):
+        raise AttributeError(f"Rule {self.name} can not be changed")
+
+    def __reduce__(self):
+        # Sent to worker processes, the default pickling would set the slots one by one
+        return Rule, tuple(getattr(self, key) for key in self.__slots__)
+
+    def __repr__(self):
+        return f"Rule({self.name!r})"
+
+    def matches(self, file_path):
+        """Check if the rule runs on a file, the same files FileIndex.select_rule gives."""
+        name = os.path.basename(file_path)
+        return not name.startswith('.') and name.rsplit('.', 1)[-1] in self.extensions and name not in self.skip_files
+
+    def to_dict(self):
+        """Get the settings of the rule as in data.rules, with sorted lists."""
+        return {
+            "name": self.name,
+            "location": list(self.location),
+            "extension": sorted(self.extensions),
+            "tag": sorted(self.tags),
+            "switch": self.switch,
+            "skip_file": sorted(self.skip_files),
+        }
+
+def get_strings(entry, key):
+    """Get the value of a list key of a rule entry as a tuple of strings, a single string counts as one."""
+    value = entry.get(key, ())
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, (list, tuple, set, frozenset)) or not all(isinstance(item, str) for item in value):
+        raise RuleError(f"Rule {entry.get('name')!r}: {key} should be a list of strings, not {value!r}")
+    return tuple(value)
+
+def build_rules(rule_dicts, handlers=None, names=None):
+    """
+    Build the rules of rule_dicts as a dict of name -> Rule, in the same order.
+
+    Every entry gets the keys it does not have from the "default" entry,
+    which is not a rule itself. handlers maps rule names to the function
+    running the rule. With names, only these rules are built, each must
+    be in rule_dicts and have a handler. Raises RuleError on a bad entry.
+    """
+    handlers = handlers or {}
+    default = {}
+    seen = set()
+    for entry in rule_dicts:
+        if not isinstance(entry, dict) or not isinstance(entry.get("name"), str) or not entry["name"]:
+            raise RuleError(f"Rule without a name: {entry!r}")
+        unknown = set(entry) - rule_keys
+        if unknown:
+            raise RuleError(f"Rule {entry['name']!r}: unknown keys {', '.join(sorted(unknown))}")
+        if entry["name"] in seen:
+            raise RuleError(f"Rule {entry['name']!r} is defined twice")
+        seen.add(entry["name"])
+        if entry["name"] == "default":
+            default = entry
+
+    table = {}
+    for entry in rule_dicts:
+        name = entry["name"]
+        if name == "default" or (names is not None and name not in names):
+            continue
+        merged = dict(default)
+        merged.update(entry)
+        if merged.get("switch", "prompt") not in switches:
+            raise RuleError(f"Rule {name!r}: switch should be one of {', '.join(sorted(switches))}")
+        handler = handlers.get(name)
+        if handler is not None and not callable(handler):
+            raise RuleError(f"Rule {name!r}: handler {handler!r} can not be called")
+        table[name] = Rule(name, get_strings(merged, "location"), get_strings(merged, "extension"),
+                           get_strings(merged, "tag"), merged.get("switch", "prompt"),
+                           get_strings(merged, "skip_file"), handler)
+
+    for name in names or ():
+        if name not in table:
+            raise RuleError(f"Rule {name!r} is not in the rule table")
+        if table[name].handler is None:
+            raise RuleError(f"Rule {name!r} has no handler")
+    return table
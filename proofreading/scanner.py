@@ -0,0 +1,135 @@
+"""
+Incremental scanner of XML and HTML source, for files too large to parse at once.
+
+iter_tokens reads a file in chunks and splits it into markup and text as
+written, without building a tree or checking that the document is
+well-formed. Long texts are cut at a line end or sentence end, so no piece
+is longer than text_limit and memory stays bounded by the chunk size.
+"""
+
+import re
+
+read_size = 1 << 16  # characters read at a time
+text_limit = 1 << 16  # longest text piece yielded
+markup_limit = 16 << 20  # longest markup before the file is taken as broken
+
+# Complete markup starting at a '<', by the characters after it
+tag_pattern = re.compile(r'<(?:[^>"\']|"[^"]*"|\'[^\']*\')*>')
+doctype_pattern = re.compile(r'<!(?:[^>\[]|\[[^\]]*\])*>')
+cdata_start = '<![CDATA['
+cdata_end = ']]>'
+split_chars = '\n。！？；!?;'  # a text is cut after one of these, conversions do not span them
+markup_start_chars = frozenset('/!?_:abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')  # after '<' in markup
+
+def get_split_point(text, limit):
+    """Get where to cut text before limit, after a line or sentence end if there is one."""
+    cut = max(text.rfind(char, 0, limit) for char in split_chars) + 1
+    if cut <= 0:
+        cut = text.rfind(' ', 0, limit) + 1
+    if cut <= 0:
+        cut = limit
+    # Do not cut a character reference
+    amp = text.rfind('&', 0, cut)
+    if amp > 0 and text.find(';', amp, cut) < 0:
+        cut = amp
+    return cut
+
+def find_markup_end(buffer, pos, eof):
+    """
+    Get the end of the markup starting at buffer[pos] == '<'.
+
+    Returns -1 if more of the file is needed to tell.
+    """
+    head = buffer[pos:pos + len(cdata_start)]
+    if len(head) < len(cdata_start) and not eof and cdata_start.startswith(head):
+        return -1  # may still be the start of a CDATA section
+    if head == cdata_start:
+        return pos + len(cdata_start)
+    if head.startswith('<!--'):
+        end = buffer.find('-->', pos + 4)
+        return -1 if end < 0 else end + 3
+    if head.startswith('<?'):
+        end = buffer.find('?>', pos + 2)
+        return -1 if end < 0 else end + 2
+    match = (doctype_pattern if head.startswith('<!') else tag_pattern).match(buffer, pos)
+    return -1 if match is None else match.end()
+
+def iter_tokens(f):
+    """
+    Yield (kind, string) for the source read from file object f, in order.
+
+    kind is 'markup' for tags, comments, processing instructions, doctype
+    and the delimiters of a CDATA section, 'text' for text between them and
+    'cdata' for the content of a CDATA section. Joining the strings gives
+    the source back.
+    """
+    buffer = ''
+    pos = 0
+    eof = False
+    in_cdata = False
+
+    def text_pieces(kind, text):
+        while len(text) > text_limit:
+            cut = get_split_point(text, text_limit)
+            yield kind, text[:cut]
+            text = text[cut:]
+        if text:
+            yield kind, text
+
+    while True:
+        if pos >= len(buffer) and eof:
+            return
+
+        if in_cdata:
+            end = buffer.find(cdata_end, pos)
+            if end >= 0:
+                yield from text_pieces('cdata', buffer[pos:end])
+                yield 'markup', cdata_end
+                pos = end + len(cdata_end)
+                in_cdata = False
+                continue
+            if eof:
+                yield from text_pieces('cdata', buffer[pos:])  # unclosed, kept as it is
+                return
+            keep = len(cdata_end) - 1  # the end may be split between two reads
+            if len(buffer) - pos - keep > text_limit:
+                cut = get_split_point(buffer[pos:len(buffer) - keep], text_limit) + pos
+                yield 'cdata', buffer[pos:cut]
+                pos = cut
+        elif pos + 1 < len(buffer) and buffer[pos] == '<' and buffer[pos + 1] not in markup_start_chars:
+            yield 'text', '<'  # a '<' in text, as the HTML parser reads it
+            pos += 1
+            continue
+        elif pos < len(buffer) and buffer[pos] == '<' and (pos + 1 < len(buffer) or eof):
+            end = find_markup_end(buffer, pos, eof)
+            if end >= 0:
+                token = buffer[pos:end]
+                yield 'markup', token
+                pos = end
+                in_cdata = token == cdata_start
+                continue
+            if eof:
+                yield from text_pieces('text', buffer[pos:])  # broken markup, kept as it is
+                return
+            if len(buffer) - pos > markup_limit:
+                raise ValueError(f"Markup longer than {markup_limit} characters, the file may be broken")
+        elif pos < len(buffer) and buffer[pos] != '<':
+            end = buffer.find('<', pos)
+            if end >= 0:
+                yield from text_pieces('text', buffer[pos:end])
+                pos = end
+                continue
+            if eof:
+                yield from text_pieces('text', buffer[pos:])
+                return
+            if len(buffer) - pos > text_limit:
+                cut = get_split_point(buffer[pos:], text_limit) + pos
+                yield 'text', buffer[pos:cut]
+                pos = cut
+
+        # Need more of the file
+        chunk = f.read(read_size)
+        if not chunk:
+            eof = True
+        buffer = buffer[pos:] + chunk
+        pos = 0
@@ -0,0 +1,138 @@
+"""
+Counters and timers of a run, shown with --stats.
+
+One Stats object is shared by the modules of a process. While it is
+disabled every call returns at once, and the hot loops check
+stats.enabled before they count anything, so a run without --stats
+pays close to nothing.
+"""
+
+import sys
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+null_timer = nullcontext()
+slowest_files = 10  # files listed in the summary
+top_keys = 10  # keys listed for each keyed counter
+
+class Stats:
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}  # name -> value
+        self.keys = {}  # name -> key -> value, like replacements by key
+        self.timers = {}  # name -> seconds
+        self.files = {}  # file path -> name -> seconds
+
+    def enable(self):
+        self.enabled = True
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def count_key(self, name, key, value=1):
+        if self.enabled:
+            counts = self.keys.setdefault(name, {})
+            counts[key] = counts.get(key, 0) + value
+
+    def add_time(self, name, seconds, file_path=None):
+        self.timers[name] = self.timers.get(name, 0) + seconds
+        if file_path is not None:
+            file_timers = self.files.setdefault(file_path, {})
+            file_timers[name] = file_timers.get(name, 0) + seconds
+
+    def timer(self, name, file_path=None):
+        """Time a block, also for file_path if given: with stats.timer("clean.parse", file_path): ..."""
+        if not self.enabled:
+            return null_timer
+        return self.timed_block(name, file_path)
+
+    @contextmanager
+    def timed_block(self, name, file_path):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start, file_path)
+
+    def to_dict(self):
+        return {"counters": self.counters, "keys": self.keys, "timers": self.timers, "files": self.files}
+
+    def pop(self):
+        """Get the collected stats as a dict and start over, used to send the stats of a worker back."""
+        collected = self.to_dict()
+        self.counters, self.keys, self.timers, self.files = {}, {}, {}, {}
+        return collected
+
+    def merge(self, collected):
+        """Add the stats of a worker, as returned by pop."""
+        if not collected:
+            return
+        for name, value in collected["counters"].items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        for name, counts in collected["keys"].items():
+            for key, value in counts.items():
+                self.count_key(name, key, value)
+        for name, seconds in collected["timers"].items():
+            self.timers[name] = self.timers.get(name, 0) + seconds
+        for file_path, file_timers in collected["files"].items():
+            merged = self.files.setdefault(file_path, {})
+            for name, seconds in file_timers.items():
+                merged[name] = merged.get(name, 0) + seconds
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=1)
+
+    def print_summary(self, file=sys.stderr):
+        """Print the summary table, to stderr so it does not mix with a report on stdout."""
+        print("\nTime by phase:", file=file)
+        for name, seconds in sorted(self.timers.items()):
+            print(f"  {name:40} {seconds * 1000:12.1f} ms", file=file)
+
+        print("\nCounters:", file=file)
+        for name, value in sorted(self.counters.items()):
+            print(f"  {name:40} {value:12,}", file=file)
+
+        for name, counts in sorted(self.keys.items()):
+            print(f"\n{name} by key:", file=file)
+            for key, value in sorted(counts.items(), key=lambda item: -item[1])[:top_keys]:
+                print(f"  {key:40} {value:12,}", file=file)
+
+        if self.files:
+            print("\nSlowest files:", file=file)
+            totals = {file_path: sum(file_timers.values()) for file_path, file_timers in self.files.items()}
+            for file_path, seconds in sorted(totals.items(), key=lambda item: -item[1])[:slowest_files]:
+                print(f"  {seconds * 1000:12.1f} ms  {file_path}", file=file)
+
+    def setup(self, args):
+        """
+        Enable the stats if --stats or --stats-json PATH is in args.
+
+        The options are removed from args, returns the JSON path or None.
+        """
+        json_path = None
+        if "--stats-json" in args:
+            idx = args.index("--stats-json")
+            if idx + 1 >= len(args):
+                print("Missing path after --stats-json.")
+                sys.exit(1)
+            json_path = args[idx + 1]
+            del args[idx:idx + 2]
+        if "--stats" in args:
+            args.remove("--stats")
+            self.enable()
+        if json_path:
+            self.enable()
+        return json_path
+
+    def report(self, json_path=None):
+        """Print the summary and write the JSON file if the stats are enabled."""
+        if not self.enabled:
+            return
+        self.print_summary()
+        if json_path:
+            self.dump(json_path)
+
+stats = Stats()
@@ -0,0 +1,100 @@
+"""
+Findings store of pr.py, a local SQLite database.
+
+Findings are kept by file and rule together with the content hash of the
+file and the version of the rule they were found with, so unchanged files
+are not checked again and the review can go on where it stopped.
+"""
+
+import os
+import sqlite3
+import hashlib
+import threading
+
+schema_version = 1
+
+def get_default_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'proofreading', 'findings.sqlite')
+
+def get_content_hash(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+class FindingsStore:
+    def __init__(self, db_path=None):
+        self.db_path = db_path or get_default_path()
+        if self.db_path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        # Shared by the review session and its producer thread, one query at a time
+        self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.RLock()
+        self.create_tables()
+
+    def create_tables(self):
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != schema_version:
+            self.connection.executescript("""
+                DROP TABLE IF EXISTS checks;
+                DROP TABLE IF EXISTS findings;
+            """)
+        self.connection.executescript(f"""
+            CREATE TABLE IF NOT EXISTS checks (
+                file TEXT NOT NULL,
+                rule TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                rule_version TEXT NOT NULL,
+                PRIMARY KEY (file, rule)
+            );
+            CREATE TABLE IF NOT EXISTS findings (
+                id INTEGER PRIMARY KEY,
+                file TEXT NOT NULL,
+                rule TEXT NOT NULL,
+                line INTEGER NOT NULL,
+                column INTEGER NOT NULL,
+                excerpt TEXT NOT NULL,
+                reviewed INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS findings_rule ON findings (rule);
+            CREATE INDEX IF NOT EXISTS findings_file ON findings (file, rule);
+            PRAGMA user_version = {schema_version};
+        """)
+        self.connection.commit()
+
+    def get(self, file_path, rule_name, content_hash, rule_version):
+        """Get the stored findings of a file, None if it was not checked with this content and rule version."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT content_hash, rule_version FROM checks WHERE file = ? AND rule = ?",
+                (file_path, rule_name)).fetchone()
+        if row is None or row["content_hash"] != content_hash or row["rule_version"] != rule_version:
+            return None
+        return self.get_findings(file_path, rule_name)
+
+    def get_findings(self, file_path, rule_name, unreviewed_only=False):
+        query = "SELECT id, file, rule, line, column, excerpt, reviewed FROM findings WHERE file = ? AND rule = ?"
+        if unreviewed_only:
+            query += " AND reviewed = 0"
+        with self.lock:
+            rows = self.connection.execute(query + " ORDER BY line, id", (file_path, rule_name))
+            return [dict(row) for row in rows]
+
+    def put(self, file_path, rule_name, content_hash, rule_version, findings):
+        """Replace the findings of a file, returns them with their ids."""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM findings WHERE file = ? AND rule = ?", (file_path, rule_name))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO checks (file, rule, content_hash, rule_version) VALUES (?, ?, ?, ?)",
+                (file_path, rule_name, content_hash, rule_version))
+            self.connection.executemany(
+                "INSERT INTO findings (file, rule, line, column, excerpt) VALUES (?, ?, ?, ?, ?)",
+                [(file_path, rule_name, finding["line"], finding["column"], finding["excerpt"]) for finding in findings])
+        return self.get_findings(file_path, rule_name)
+
+    def mark_reviewed(self, finding_ids):
+        with self.lock, self.connection:
+            self.connection.executemany("UPDATE findings SET reviewed = 1 WHERE id = ?", [(idx,) for idx in finding_ids])
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,65 @@
+"""
+The text nodes of a document as one buffer, for running a rule once over all of them.
+
+Texts are joined with a sentinel character that no rule pattern matches
+(NUL, which XML does not allow in text), so a match can not reach from one
+node into the next. The start of every node in the buffer is kept in an
+array, a position in the buffer is mapped back to its node by bisection.
+"""
+
+from array import array
+from bisect import bisect_right
+
+sentinel = '\x00'
+
+class TextBuffer:
+    def __init__(self, texts):
+        if any(sentinel in text for text in texts):
+            raise ValueError("A text contains the sentinel character")
+        self.count = len(texts)
+        self.text = sentinel.join(texts)
+        self.starts = None  # offsets of the nodes, built when needed
+
+    def get_starts(self):
+        """Get the offset of every node in the buffer as an array."""
+        if self.starts is None:
+            starts = array('q', [0]) * self.count
+            position = 0
+            for idx, text in enumerate(self.split()):
+                starts[idx] = position
+                position += len(text) + 1
+            self.starts = starts
+        return self.starts
+
+    def node_at(self, position):
+        """Get the index of the node the character at position belongs to."""
+        return bisect_right(self.get_starts(), position) - 1
+
+    def split(self):
+        return self.text.split(sentinel)
+
+    def set_text(self, text):
+        """
+        Take the buffer as changed by a rule.
+
+        Raises ValueError if the rule added or removed a separator, the
+        nodes can not be told apart then.
+        """
+        if text is self.text:
+            return
+        if text.count(sentinel) != self.count - 1:
+            raise ValueError("A rule changed the node separators of a text buffer")
+        self.text = text
+        self.starts = None
+
+    def apply(self, handler, *args):
+        """Run a rule over the whole buffer, handler is called like a rule on a single text."""
+        self.set_text(handler(self.text, *args))
+
+    def nodes_at(self, positions):
+        """Get the sorted indexes of the nodes the characters at the positions belong to."""
+        return sorted({self.node_at(position) for position in positions})
+
+    def set_texts(self, texts):
+        """Take the texts of all the nodes, as split gives them, after some of them changed."""
+        self.set_text(sentinel.join(texts))
@@ -1,33 +1,76 @@
-import os, sys, subprocess, re
-from . import display
-import curses
+import os, sys
+import json, hashlib
+from functools import lru_cache
 from . import data
+from .matcher import get_matcher
+from .dictionary import list_dictionaries
+from .stats import stats
 
 sentense_end_puctuation = { 
     "en": ['.', '?', '!', '……'],
     "zh": ['。', '？', '！', '······']
 }
 
-def punctuation_line_end(content, file_path, rule):
+def find_punctuation_line_end(lines):
+    """Get the numbers of the lines that do not end with punctuation."""
     line_numbers = []
 
-    puctuation_lsit = [item for sublist in sentense_end_puctuation.values() for item in sublist]
+    puctuation_lsit = tuple(item for sublist in sentense_end_puctuation.values() for item in sublist)
 
-    for idx, line in enumerate(content.splitlines(True), start=1):
+    for idx, line in enumerate(lines, start=1):
         if not line.strip():
             continue  # Skip empty lines
 
         # checks if line ends with Chinese or English character
-        if not line.strip().endswith(tuple(puctuation_lsit)):  # Handle end with space elsewhere
+        if not line.strip().endswith(puctuation_lsit):  # Handle end with space elsewhere
             line_numbers.append(idx)
-    
-    if line_numbers:
-        curses.wrapper(display.text, line_numbers, content, file_path, rule)
+
+    return line_numbers
+
+# Checks of the rules without user interaction, they get the list of lines and return the line numbers found
+# Increase checks_version when a check changes, stored findings are checked again.
+checks_version = 1
+rule_checks = {
+    "punctuation_line_end": find_punctuation_line_end,
+}
+
+def read_git_head(git_path):
+    """Read the branch name from the HEAD file of a .git directory, None if it can not be read."""
+    if os.path.isfile(git_path):
+        # Worktrees and submodules have a file pointing to the git directory
+        try:
+            with open(git_path, 'r', encoding='utf-8') as f:
+                content = f.read().strip()
+        except OSError:
+            return None
+        if not content.startswith('gitdir: '):
+            return None
+        git_path = os.path.join(os.path.dirname(git_path), content[len('gitdir: '):])
+
+    try:
+        with open(os.path.join(git_path, 'HEAD'), 'r', encoding='utf-8') as f:
+            head = f.read().strip()
+    except OSError:
+        return None
+
+    if head.startswith('ref: refs/heads/'):
+        return head[len('ref: refs/heads/'):]
+    elif head.startswith('ref: '):
+        return None
+    return 'HEAD'  # detached, the same as git rev-parse --abbrev-ref
 
 def get_current_branch(path):
     """Get the current git branch and the repo path."""
+    path = os.path.abspath(path)
     while path:
-        if os.path.isdir(os.path.join(path, '.git')):
+        git_path = os.path.join(path, '.git')
+        if os.path.exists(git_path):
+            branch_name = read_git_head(git_path)
+            if branch_name:
+                return branch_name, os.path.abspath(path)
+
+            # Fall back to git itself
+            import subprocess
             result = subprocess.run(
                 ['git', '-C', path, 'rev-parse', '--abbrev-ref', 'HEAD'],
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
@@ -42,6 +85,26 @@ def get_current_branch(path):
 
     return None, None
 
+def get_jobs(args, default=1):
+    """
+    Get the number of worker processes of --jobs N in args, default if it is not given.
+
+    The option is removed from args. A missing value or one below 1 is
+    printed and exits, the same in every script.
+    """
+    if "--jobs" not in args:
+        return default
+    idx = args.index("--jobs")
+    try:
+        jobs = int(args[idx + 1])
+    except (IndexError, ValueError):
+        jobs = 0
+    if jobs < 1:
+        print("Invalid --jobs value, it should be a number of 1 or more.")
+        sys.exit(1)
+    del args[idx:idx + 2]
+    return jobs
+
 def get_single_keypress():
     # UNIX-based system (Linux, macOS)
     if sys.platform in ['linux', 'darwin']:
@@ -69,43 +132,105 @@ def get_single_keypress():
     else:
         raise NotImplementedError("Platform not supported")
     
-def replace_text(text, lang, line_num, file_path, auto_only=False):
-    # Todo:
-    #   - Options to replace what if found multiple in one chunk.
-
+def highlight_spans(text, spans, color_code):
+    """Highlight the given spans in the text with given color code."""
+    pieces = []
+    position = 0
+    for start, end in spans:
+        pieces.append(text[position:start])
+        pieces.append(f"\033[{color_code}m{text[start:end]}\033[0m")
+        position = end
+    pieces.append(text[position:])
+    return ''.join(pieces)
+
+def prompt_replace(text, spans, key, replacement, line_num, file_path):
+    """Ask whether to replace key at spans of text with replacement, returns the key pressed. 'e' opens the file in vim."""
     RED_BOLD = "31;1"
     BLUE_BOLD = "34;1"
 
-    def highlight_text(text, keyword, color_code):
-        """Highlight the given keyword in the text with given color code."""
-        return re.sub(f"({keyword})", lambda m: f"\033[{color_code}m{m.group(1)}\033[0m", text)
-
-    for key, value in data.text_replace.items():
-        # Check for language matching conditions
-        if lang == value['lang'] or (lang.startswith("zh-") and value['lang'] in ["zh", "any"]):
-            occurrences = text.count(key)
-
-            if occurrences == 0:
-                continue
-
-            # If switch is 'auto', replace directly
-            if value['switch'] == 'auto':
-                text = text.replace(key, value['replace'])
-            elif auto_only:
-                continue  # skip non-auto
-            else:
-                # Show the replace prompt with highlighting
-                highlighted_text = highlight_text(text, key, RED_BOLD)
-                replace_text = highlight_text(value['replace'], value['replace'], BLUE_BOLD)
-                print(f"\n>>> Replace '{key}' below with '{replace_text}'? (y/e/n)\n\n{highlighted_text}\n")
-                # user_input = input("(y/n/e)? ")
-                user_input = get_single_keypress()
-
-                # Depending on user choice, perform action
-                if user_input == 'y':
-                    text = text.replace(key, value['replace'])
-                elif user_input == 'e':
-                    os.system(f'gnome-terminal -t "clean: replace" --hide-menubar -- vim +{line_num} {file_path}')  # Gnome
-                    continue
-
-    return text
\ No newline at end of file
+    # Show the replace prompt with highlighting
+    highlighted_text = highlight_spans(text, spans, RED_BOLD)
+    replace_text = highlight_spans(replacement, [(0, len(replacement))], BLUE_BOLD)
+    print(f"\n>>> Replace '{key}' below with '{replace_text}'? (y/e/n)\n\n{highlighted_text}\n")
+    # user_input = input("(y/n/e)? ")
+    user_input = get_single_keypress()
+    if user_input == 'e':
+        os.system(f'gnome-terminal -t "clean: replace" --hide-menubar -- vim +{line_num} {file_path}')  # Gnome
+    return user_input
+
+def replace_text(text, lang, line_num, file_path, auto_only=False, answer=None):
+    """
+    Replace the text_replace keys in text, asking for the prompt ones.
+
+    A prompt shows the text with the automatic replacements made and the
+    spans of the key in it. answer(key, entry, text, spans), if given, is
+    called with them instead of the prompt and returns the key pressed,
+    clean.py uses it to ask later.
+    """
+    # Todo:
+    #   - Options to replace what if found multiple in one chunk.
+
+    matcher = get_matcher(lang)
+    hits = matcher.find(text)
+    if not hits:
+        return text
+
+    # The automatic keys are replaced, the prompts show the text with them replaced already
+    entries = {key: matcher.get(key) for key in dict.fromkeys(key for _, _, key in hits)}
+    accepted = {key for key, value in entries.items() if value['switch'] == 'auto'}
+    prompt_keys = [] if auto_only else [key for key in entries if key not in accepted]
+    if prompt_keys:
+        shown, shown_hits = apply_replacements(text, hits, {key: entries[key]['replace'] for key in accepted})
+
+    # Ask for the prompt keys in order of first appearance
+    for key in prompt_keys:
+        value = entries[key]
+        spans = [(start, end) for start, end, hit in shown_hits if hit == key]
+        if answer is None:
+            user_input = prompt_replace(shown, spans, key, value['replace'], line_num, file_path)
+        else:
+            user_input = answer(key, value, shown, spans)
+
+        # Depending on user choice, perform action
+        if user_input == 'y':
+            accepted.add(key)
+
+    if not accepted:
+        return text
+
+    if stats.enabled:
+        for _, _, key in hits:
+            if key in accepted:
+                stats.count_key("replace_text.replacements", key)
+
+    return apply_replacements(text, hits, {key: entries[key]['replace'] for key in accepted})[0]
+
+def apply_replacements(text, hits, replacements):
+    """
+    Replace the hits of text whose key is in replacements, in one pass from the hit spans.
+
+    Returns the new text and the other hits, with their spans in the new text.
+    """
+    pieces = []
+    kept = []
+    position = 0
+    shift = 0
+    for start, end, key in hits:
+        if key in replacements:
+            pieces.append(text[position:start])
+            pieces.append(replacements[key])
+            position = end
+            shift += len(replacements[key]) - (end - start)
+        else:
+            kept.append((start + shift, end + shift, key))
+    pieces.append(text[position:])
+    return ''.join(pieces), kept
+
+@lru_cache(maxsize=None)
+def get_text_replace_hash():
+    """Get a hash of the text_replace table and the dictionaries, changes whenever an entry changes."""
+    content = json.dumps(data.text_replace, sort_keys=True, ensure_ascii=False)
+    dictionaries = [[os.path.basename(file_path), header['digest']] for file_path, header in list_dictionaries()]
+    if dictionaries:
+        content += json.dumps(dictionaries, ensure_ascii=False)  # without any, the hash stays as it was
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
@@ -0,0 +1,206 @@
+"""
+Watch a directory for changed files, used by --watch of clean.py and pr.py.
+
+On Linux the directory tree is watched with inotify through ctypes, other
+systems, or a tree with more directories than the inotify limit allows,
+fall back to polling the mtime and size of the files with FileIndex.
+Either way a file only counts as changed when its mtime or size differs
+from the last time it was seen, so refresh after writing a file keeps
+the watcher from reporting its own writes.
+"""
+
+import os
+import sys
+import time
+import select
+import struct
+
+from discovery import FileIndex  # a sibling of clean.py and pr.py, imported like them
+
+poll_interval = 0.5  # seconds between two scans when polling
+settle_time = 0.1  # seconds without events before a batch of changes is returned
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+watch_mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+event_header = struct.Struct('iIII')  # wd, mask, cookie, len, then the name
+
+def get_signature(file_path):
+    """Get the (mtime_ns, size) of a file, None if it is gone."""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+class Inotify:
+    """The inotify watches of a directory tree, raises OSError if they can not be set up."""
+
+    def __init__(self, path):
+        import ctypes, ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}  # watch descriptor -> directory
+        try:
+            self.add_tree(path)
+        except OSError:
+            self.close()
+            raise
+
+    def add_tree(self, path):
+        """Watch path and the directories under it, hidden ones are left out. Returns the files found."""
+        import ctypes
+        files = []
+        pending = [path]
+        while pending:
+            directory = pending.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), watch_mask)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                if directory != path and not os.path.isdir(directory):
+                    continue  # removed in the meantime
+                raise OSError(errno, f"inotify_add_watch failed for {directory}: {os.strerror(errno)}")
+            self.directories[wd] = directory
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry.path)
+        return files
+
+    def read(self, timeout):
+        """
+        Wait up to timeout seconds for events, None waits forever.
+
+        Returns the paths of the files the events name, None if the kernel
+        queue overflowed and events were lost.
+        """
+        paths = []
+        overflow = False
+        while True:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if not ready:
+                break
+            buffer = os.read(self.fd, 64 * 1024)
+            position = 0
+            while position < len(buffer):
+                wd, mask, _, length = event_header.unpack_from(buffer, position)
+                name = buffer[position + event_header.size:position + event_header.size + length].rstrip(b'\0')
+                position += event_header.size + length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    self.directories.pop(wd, None)  # the directory was removed
+                    continue
+                directory = self.directories.get(wd)
+                name = os.fsdecode(name)
+                if directory is None or not name or name.startswith('.'):
+                    continue
+                file_path = os.path.join(directory, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        paths.extend(self.add_tree(file_path))  # files written before the watch was added
+                else:
+                    paths.append(file_path)
+            timeout = settle_time  # wait for the rest of a save, editors write in several steps
+        return None if overflow else paths
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class Watcher:
+    """
+    Changed files under a directory.
+
+    changes waits for files to be created or modified and returns their
+    paths, deleted files are forgotten. Hidden files and directories are
+    left out like in FileIndex.
+    """
+
+    def __init__(self, path, polling=False):
+        self.path = path
+        self.known = {}  # file path -> (mtime_ns, size) when it was last seen
+        for entries in FileIndex(path).by_extension.values():
+            for entry in entries:
+                self.known[entry.path] = (entry.mtime_ns, entry.size)
+
+        self.inotify = None
+        if not polling and sys.platform.startswith('linux'):
+            try:
+                self.inotify = Inotify(path)
+            except (OSError, AttributeError):
+                self.inotify = None  # no inotify or too many directories, poll instead
+
+    @property
+    def backend(self):
+        return "inotify" if self.inotify else "polling"
+
+    def changes(self, timeout=None):
+        """Wait up to timeout seconds for changed files, None waits forever. Returns their sorted paths."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if self.inotify:
+                paths = self.inotify.read(remaining)
+                changed = self.poll() if paths is None else self.check(paths)
+            else:
+                time.sleep(poll_interval if remaining is None else min(poll_interval, remaining))
+                changed = self.poll()
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def check(self, paths):
+        """Get the paths that changed since they were last seen."""
+        changed = []
+        for file_path in sorted(set(paths)):
+            signature = get_signature(file_path)
+            if signature is None:
+                self.known.pop(file_path, None)
+            elif self.known.get(file_path) != signature:
+                self.known[file_path] = signature
+                changed.append(file_path)
+        return changed
+
+    def poll(self):
+        """Scan the whole directory, get the paths that changed since the last scan."""
+        current = {}
+        for entries in FileIndex(self.path).by_extension.values():
+            for entry in entries:
+                current[entry.path] = (entry.mtime_ns, entry.size)
+        changed = sorted(file_path for file_path, signature in current.items() if self.known.get(file_path) != signature)
+        self.known = current
+        return changed
+
+    def refresh(self, paths):
+        """Take the files as seen, call it after writing them so the writes are not reported."""
+        for file_path in paths:
+            signature = get_signature(file_path)
+            if signature is None:
+                self.known.pop(file_path, None)
+            else:
+                self.known[file_path] = signature
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
@@ -0,0 +1,21 @@
+"""
+Import setup of the tests, the same as the launcher in benchmarks/startup.py.
+
+pr.py and clean.py import their siblings by bare name while the siblings
+import each other relatively, so the proofreading package is loaded first
+and data and utils are aliased to it. Import this module before them.
+"""
+
+import os
+import sys
+import importlib
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if root not in sys.path:
+    sys.path.insert(0, root)
+for name in ["data", "utils"]:
+    sys.modules.setdefault(name, importlib.import_module("proofreading." + name))
+script_dir = os.path.join(root, "proofreading")
+if script_dir not in sys.path:
+    sys.path.insert(1, script_dir)
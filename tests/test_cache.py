@@ -0,0 +1,65 @@
+import unittest
+from unittest import mock
+
+import support  # noqa: F401
+from proofreading.cache import ConversionCache
+
+class DiskEvictionTest(unittest.TestCase):
+    def get_cache(self, max_disk_entries):
+        # A small memory tier, so a get has to go to disk
+        cache = ConversionCache(max_entries=1, max_disk_entries=max_disk_entries)
+        cache.open(':memory:')
+        self.addCleanup(cache.close)
+        return cache
+
+    def get_disk_texts(self, cache):
+        rows = cache.get_connection().execute("SELECT converted FROM conversions")
+        return sorted(converted for converted, in rows)
+
+    def test_single_puts_keep_the_newest(self):
+        cache = self.get_cache(5)
+        for idx in range(8):
+            cache.put('ns', f"text {idx}", f"converted {idx}")
+        self.assertEqual(self.get_disk_texts(cache), [f"converted {idx}" for idx in range(3, 8)])
+
+    def test_puts_at_the_same_time_keep_the_newest(self):
+        cache = self.get_cache(5)
+        with mock.patch('time.time', return_value=1000.0):
+            for idx in range(8):
+                cache.put('ns', f"text {idx}", f"converted {idx}")
+        self.assertEqual(self.get_disk_texts(cache), [f"converted {idx}" for idx in range(3, 8)])
+
+    def test_batch_over_capacity_keeps_part_of_it(self):
+        cache = self.get_cache(5)
+        cache.put_many('ns', {f"old {idx}": "old" for idx in range(3)})
+        cache.put_many('ns', {f"text {idx}": f"converted {idx}" for idx in range(8)})
+        texts = self.get_disk_texts(cache)
+        self.assertEqual(len(texts), 5)
+        self.assertNotIn("old", texts)
+        self.assertIn("converted 7", texts)
+
+    def test_replaced_entry_counts_as_new(self):
+        cache = self.get_cache(3)
+        with mock.patch('time.time', return_value=1000.0):
+            for idx in range(3):
+                cache.put('ns', f"text {idx}", f"converted {idx}")
+            cache.put('ns', "text 0", "converted 0 again")
+            cache.put('ns', "text 3", "converted 3")
+        self.assertEqual(self.get_disk_texts(cache), ["converted 0 again", "converted 2", "converted 3"])
+
+    def test_evicted_entries_are_not_found(self):
+        cache = self.get_cache(5)
+        for idx in range(8):
+            cache.put('ns', f"text {idx}", f"converted {idx}")
+        cache.memory.clear()
+        self.assertIsNone(cache.get('ns', "text 0"))
+        self.assertEqual(cache.get('ns', "text 7"), "converted 7")
+
+    def test_room_is_left_after_eviction(self):
+        cache = self.get_cache(32)
+        cache.put_many('ns', {f"text {idx}": "converted" for idx in range(40)})
+        self.assertEqual(len(self.get_disk_texts(cache)), 30)
+        self.assertEqual(cache.disk_count, 30)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+"""
+The fused patterns of the clean rules against the sequential re.sub passes they replaced.
+
+The reference functions are the rules as they were before they were fused,
+kept here as they were written. Each fused rule has to give the same text
+on random strings and on the cases where the passes interact.
+"""
+
+import re
+import random
+import unittest
+
+import support  # noqa: F401
+import clean
+from data import zh_chars, numbers, alphanumeric, zh_punct, zh_chars_punct
+
+def reference_chinese_spacing(content, *_):
+    content = re.sub(rf'({zh_chars})\s*({alphanumeric})', r'\1 \2', content)
+    content = re.sub(rf'({alphanumeric})\s*({zh_chars})', r'\1 \2', content)
+    content = re.sub(rf'({zh_chars})\s*({zh_punct})', r'\1\2', content)
+    content = re.sub(rf'({zh_punct})\s*({zh_chars})', r'\1\2', content)
+    content = re.sub(rf'({zh_punct})\s*({zh_punct})', r'\1\2', content)
+    content = re.sub(rf'({zh_punct})\s*({alphanumeric})', r'\1\2', content)
+    content = re.sub(rf'({alphanumeric})\s*({zh_punct})', r'\1\2', content)
+    return content
+
+def reference_chinese_punctuation(content, *_):
+    content = re.sub(rf'({zh_chars_punct})\s*,', r'\1，', content)
+    content = re.sub(rf'\(\s*({zh_chars_punct})', r'（\1', content)
+    content = re.sub(rf'({zh_chars_punct})\s*\)', r'\1）', content)
+    content = re.sub(rf'({zh_chars_punct})\s*\;', r'\1；', content)
+    return content
+
+def reference_number_spacing(content, lang, *_):
+    content = re.sub(rf'({numbers})\s*({numbers})', r'\1\2', content)
+    if lang == 'zh' or lang.startswith('zh-'):
+        content = re.sub(r'(\d)\s*\.\s*(\d)', r'\1.\2', content)
+    return content
+
+rule_pairs = [
+    (clean.chinese_spacing, reference_chinese_spacing),
+    (clean.chinese_punctuation, reference_chinese_punctuation),
+    (clean.number_spacing, reference_number_spacing),
+]
+langs = ["zh-Hant", "zh-Hans", "zh", "en", ""]
+
+# Characters of every class the patterns look at, with more than one kind of space
+alphabet = (list("中文字說") + ['\U00020000'] + list("aZ09") + list("123") + [' '] * 4 + ['\n', '\t', '　']
+            + list("。，「」（）…；") + list(",();.") + list("-x"))
+
+quirk_cases = [
+    "。 。 。", "。 。 。 。 。", "「 」 「 」",
+    "1 2 3", "1 2 3 4 5", "1 . 2 . 3", "10. 1, 10 .1, 10 . 1", "1.2.3", "1 .2 3. 4",
+    "中 , )", "中, )", "中 ,,, ;", "中 ( ( 文", "( 中 )", "中 ) ) )", "中 ; ;", "，, ，",
+    "中a中a中", "中 a 中 a", "a中 。b", "中 。 a 。 中", "中\n\t1 2　3",
+    "", " ", "中", "a",
+]
+
+class FusedRulesTest(unittest.TestCase):
+    def assert_same(self, text, lang):
+        for rule, reference in rule_pairs:
+            self.assertEqual(rule(text, lang), reference(text, lang), f"{rule.__name__} on {text!r} in {lang!r}")
+
+    def assert_same_chain(self, text, lang):
+        fused, sequential = text, text
+        for rule, reference in rule_pairs:
+            fused, sequential = rule(fused, lang), reference(sequential, lang)
+        self.assertEqual(fused, sequential, f"all rules on {text!r} in {lang!r}")
+
+    def test_quirk_cases(self):
+        for text in quirk_cases:
+            for lang in langs:
+                self.assert_same(text, lang)
+                self.assert_same_chain(text, lang)
+
+    def test_random_strings(self):
+        rnd = random.Random(6)
+        for _ in range(5000):
+            text = ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 30)))
+            lang = rnd.choice(langs)
+            self.assert_same(text, lang)
+            self.assert_same_chain(text, lang)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import io
+import json
+import shutil
+import tempfile
+import unittest
+import importlib.util
+from unittest import mock
+from contextlib import redirect_stdout
+
+import support  # noqa: F401
+import chinese_convert
+
+page = '<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="zh-Hant"><body><p>{}</p></body></html>\n'
+
+@unittest.skipUnless(importlib.util.find_spec("opencc"), "OpenCC is not installed")
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.input_dir = os.path.join(self.directory, "input")
+        self.output_dir = os.path.join(self.directory, "output")
+        self.text_dir = os.path.join(self.input_dir, "src", "epub", "text")
+        os.makedirs(self.text_dir)
+        for name, text in [("a.xhtml", "簡體與繁體"), ("b.xhtml", "這是測試")]:
+            with open(os.path.join(self.text_dir, name), 'w', encoding='utf-8') as f:
+                f.write(page.format(text))
+
+    def convert(self, *options):
+        argv = ["chinese_convert.py", *options, "t2s", self.input_dir, self.output_dir]
+        output = io.StringIO()
+        with mock.patch("sys.argv", argv), redirect_stdout(output):
+            chinese_convert.main()
+        return output.getvalue()
+
+    def get_output_path(self, name):
+        return os.path.join(self.output_dir, "src", "epub", "text", name)
+
+    def get_manifest(self):
+        with open(os.path.join(self.output_dir, chinese_convert.manifest_name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def test_second_run_is_up_to_date(self):
+        self.convert()
+        self.assertIn("0 converted, 2 up to date.", self.convert())
+
+    def test_force_removes_the_outputs_of_removed_sources(self):
+        self.convert()
+        os.remove(os.path.join(self.text_dir, "b.xhtml"))
+        output = self.convert("--force")
+        self.assertIn("1 converted, 0 up to date.", output)
+        self.assertFalse(os.path.exists(self.get_output_path("b.xhtml")))
+        self.assertEqual(sorted(self.get_manifest()["files"]), [os.path.join("src", "epub", "text", "a.xhtml")])
+
+    def test_outputs_of_another_converter_version_are_converted_again(self):
+        self.convert()
+        manifest = self.get_manifest()
+        for entry in manifest["files"].values():
+            del entry["converter_version"]  # written before the version was kept
+        with open(os.path.join(self.output_dir, chinese_convert.manifest_name), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        self.assertIn("2 converted, 0 up to date.", self.convert())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,206 @@
+import os
+import json
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import support  # noqa: F401
+from proofreading import dictionary
+from proofreading.dictionary import compile_dictionary, read_header, list_dictionaries, header_struct, magic
+from proofreading.dictionary import read_source, open_dictionary, Dictionary
+from proofreading import matcher
+from proofreading.utils import replace_text
+
+entries = {f"鍵{idx}": (f"值{idx}", "prompt" if idx % 2 else "auto", "variant") for idx in range(50)}
+
+class BrokenDictionaryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "good.dict")
+        compile_dictionary(entries, "zh", self.path)
+        with open(self.path, 'rb') as f:
+            self.content = f.read()
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def with_header(self, change):
+        _, length = header_struct.unpack(self.content[:header_struct.size])
+        header = json.loads(self.content[header_struct.size:header_struct.size + length])
+        change(header)
+        encoded = json.dumps(header, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        # Padded to the same length, so the sections start where they did
+        self.assertLessEqual(len(encoded), length)
+        encoded += b' ' * (length - len(encoded))
+        return self.content[:header_struct.size] + encoded + self.content[header_struct.size + length:]
+
+    def assert_broken(self, content, message):
+        path = self.write("broken.dict", content)
+        with self.assertRaisesRegex(ValueError, message) as raised:
+            read_header(path)
+        self.assertIn(path, str(raised.exception))
+
+    def test_good_file(self):
+        header = read_header(self.path)
+        self.assertEqual(header["count"], len(entries))
+        self.assertEqual(dictionary.Dictionary(self.path).get("鍵7")["replace"], "值7")
+
+    def test_truncated_files(self):
+        for size in [0, 4, len(magic), header_struct.size + 10, len(self.content) // 2, len(self.content) - 1]:
+            with self.subTest(size=size):
+                self.assert_broken(self.content[:size], "")
+
+    def test_other_version(self):
+        self.assert_broken(b'PRDICT\x00\x02' + self.content[len(magic):], "not a compiled dictionary")
+
+    def test_broken_header(self):
+        _, length = header_struct.unpack(self.content[:header_struct.size])
+        garbled = self.content[:header_struct.size] + b'{' * length + self.content[header_struct.size + length:]
+        self.assert_broken(garbled, "header is broken")
+        self.assert_broken(self.with_header(lambda header: header.pop("digest")), "header is broken")
+        self.assert_broken(self.with_header(lambda header: header.update(count="50")), "header is broken")
+        self.assert_broken(self.with_header(lambda header: header.update(pair_bits=100)), "pair bits")
+
+    def test_sections(self):
+        self.assert_broken(self.with_header(lambda header: header["sections"].pop("keys")), "keys section is missing")
+        self.assert_broken(self.with_header(lambda header: header.update(count=51)), "key_offsets section has")
+        self.assert_broken(self.with_header(lambda header: header["sections"]["values"].__setitem__(1, 10 ** 6)),
+                           "values section ends after the end of the file")
+
+    def test_list_names_the_broken_file(self):
+        path = self.write("truncated.dict", self.content[:-1])
+        with mock.patch.dict(os.environ, {"PROOFREADING_DICTIONARIES": self.directory}):
+            list_dictionaries.cache_clear()
+            self.addCleanup(list_dictionaries.cache_clear)
+            with self.assertRaisesRegex(ValueError, "truncated.dict"):
+                list_dictionaries()
+            os.remove(path)
+            self.assertEqual([file_path for file_path, _ in list_dictionaries()], [self.path])
+
+source = """# key, replacement, switch and type
+中	仲
+中文	中國文	auto
+中文字	漢字	prompt	term
+文字	字	auto
+甲乙丙	丙
+A	a	auto
+C	c	auto
+𪛖	龍	auto
+"""
+
+def find_longest(keys, text):
+    """The spans of find, by trying every key at every position."""
+    spans = []
+    for start in range(len(text)):
+        ends = [start + len(key) for key in keys if text.startswith(key, start)]
+        if ends:
+            spans.append((start, max(ends)))
+    return spans
+
+class LookupTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def compile(self, entries, lang="zh", name="test.dict"):
+        path = os.path.join(self.directory, name)
+        compile_dictionary(entries, lang, path)
+        return Dictionary(path)
+
+    def compile_source(self):
+        source_path = os.path.join(self.directory, "source.tsv")
+        with open(source_path, 'w', encoding='utf-8') as f:
+            f.write(source)
+        entries, lang = read_source(source_path, "zh", "prompt", "variant")
+        return self.compile(entries, lang)
+
+    def test_get(self):
+        found = self.compile_source()
+        self.assertEqual(found.get("中"), {'replace': "仲", 'lang': "zh", 'switch': "prompt", 'type': "variant"})
+        self.assertEqual(found.get("中文字"), {'replace': "漢字", 'lang': "zh", 'switch': "prompt", 'type': "term"})
+        self.assertEqual(found.get("文字")['switch'], "auto")
+        self.assertEqual(found.get("\U0002a6d6")['replace'], "龍")
+        # Misses: not a key, only the prefix of one, longer than any key of its first character, empty
+        for key in ["乙", "甲乙", "中文字典", "B", "字", ""]:
+            self.assertIsNone(found.get(key), key)
+
+    def test_find_longest_at_each_position(self):
+        found = self.compile_source()
+        self.assertEqual(found.find("中文字中"), [(0, 3), (1, 3), (3, 4)])
+        self.assertEqual(found.find("中文"), [(0, 2)])
+        self.assertEqual(found.find("甲乙"), [])
+        self.assertEqual(found.find("甲乙甲乙丙"), [(2, 5)])
+        self.assertEqual(found.find("沒有"), [])
+        self.assertEqual(found.find(""), [])
+
+    def test_find_first_characters(self):
+        # The first and the last of the first characters, and the ones next to them that are not
+        found = self.compile_source()
+        self.assertEqual(found.find("@ABCD"), [(1, 2), (3, 4)])
+        self.assertEqual(found.find("\U0002a6d5\U0002a6d6\U0002a6d7"), [(1, 2)])
+        self.assertEqual(found.find("C"), [(0, 1)])
+
+    def test_find_random_keys(self):
+        # A small alphabet gives many keys sharing their first characters, and pairs that are not
+        # the start of a key but have the bit of one set
+        rnd = random.Random(24)
+        alphabet = "中文字詞句段\U00020000ab"
+        keys = {''.join(rnd.choice(alphabet) for _ in range(rnd.randint(1, 5))) for _ in range(300)}
+        found = self.compile({key: (key.upper(), "auto", None) for key in keys})
+        for _ in range(500):
+            text = ''.join(rnd.choice(alphabet + "xy") for _ in range(rnd.randint(0, 20)))
+            self.assertEqual(found.find(text), find_longest(keys, text), text)
+        for key in keys:
+            self.assertEqual(found.get(key)['replace'], key.upper())
+
+    def test_empty_dictionary(self):
+        found = self.compile({})
+        self.assertEqual(found.find("中文"), [])
+        self.assertIsNone(found.get("中"))
+
+class MatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        compile_dictionary({"簡體詞": ("简体词", "auto", None), "晩": ("夜", "auto", None),
+                            "晩飯": ("晚饭", "auto", None), "一一一": ("———", "auto", None)},
+                           "zh-Hans", os.path.join(self.directory, "hans.dict"))
+        compile_dictionary({"colour": ("color", "auto", None)}, "en", os.path.join(self.directory, "en.dict"))
+        environ = mock.patch.dict(os.environ, {"PROOFREADING_DICTIONARIES": self.directory})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.clear_caches()
+        self.addCleanup(self.clear_caches)
+
+    def clear_caches(self):
+        for cached in [list_dictionaries, open_dictionary, matcher.get_matcher]:
+            cached.cache_clear()
+
+    def test_dictionaries_of_the_lang(self):
+        self.assertEqual(matcher.get_matcher("zh-Hans").get("簡體詞")['replace'], "简体词")
+        self.assertIsNone(matcher.get_matcher("zh-Hant").get("簡體詞"))
+        self.assertIsNone(matcher.get_matcher("en").get("簡體詞"))
+        self.assertEqual(matcher.get_matcher("en").get("colour")['replace'], "color")
+        self.assertIsNone(matcher.get_matcher("zh-Hans").get("colour"))
+        self.assertEqual(replace_text("colour 簡體詞", "zh-Hans", 1, "test.xhtml"), "colour 简体词")
+
+    def test_text_replace_comes_first(self):
+        # 晩 is in data.text_replace for zh, the dictionary gives it another replacement
+        self.assertEqual(matcher.get_matcher("zh-Hans").get("晩")['replace'], "晚")
+        self.assertEqual(replace_text("晩上", "zh-Hans", 1, "test.xhtml"), "晚上")
+
+    def test_leftmost_longest_over_table_and_dictionary(self):
+        found = matcher.get_matcher("zh-Hans")
+        self.assertEqual(found.find("晩飯晩"), [(0, 2, "晩飯"), (2, 3, "晩")])
+        # 一一 is a key of data.text_replace, the longer key of the dictionary starts at the same place
+        self.assertEqual(found.find("一一一一"), [(0, 3, "一一一")])
+        self.assertEqual(replace_text("晩飯", "zh-Hans", 1, "test.xhtml"), "晚饭")
+
+if __name__ == "__main__":
+    unittest.main()
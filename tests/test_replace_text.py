@@ -0,0 +1,47 @@
+import unittest
+from unittest import mock
+
+import support  # noqa: F401
+from proofreading import utils
+from proofreading.matcher import Matcher
+
+def entry(replace, switch):
+    return {'replace': replace, 'lang': "zh", 'switch': switch, 'type': None}
+
+table = {
+    "ab": entry("X", "auto"),
+    "cd": entry("Y", "prompt"),
+    "e": entry("ZZ", "prompt"),
+    "fgh": entry("", "auto"),
+}
+
+class ReplaceTextTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(utils, "get_matcher", return_value=Matcher(table))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def replace(self, text, answers, auto_only=False):
+        prompts = []
+        def answer(key, value, shown, spans):
+            prompts.append((key, shown, spans))
+            return answers.get(key, 'n')
+        return utils.replace_text(text, "zh", 1, "test.xhtml", auto_only, answer), prompts
+
+    def test_prompts_show_the_automatic_replacements(self):
+        output, prompts = self.replace("ab cd fgh e cd", {"cd": 'y'})
+        self.assertEqual(prompts, [("cd", "X cd  e cd", [(2, 4), (8, 10)]), ("e", "X cd  e cd", [(6, 7)])])
+        self.assertEqual(output, "X Y  e Y")
+
+    def test_answers(self):
+        self.assertEqual(self.replace("cd e", {"cd": 'y', "e": 'y'})[0], "Y ZZ")
+        self.assertEqual(self.replace("cd e", {})[0], "cd e")
+        self.assertEqual(self.replace("ab cd e", {}, auto_only=True), ("X cd e", []))
+
+    def test_prompt_without_answer(self):
+        with mock.patch.object(utils, "prompt_replace", return_value='y') as prompt_replace:
+            self.assertEqual(utils.replace_text("fghe", "zh", 3, "test.xhtml"), "ZZ")
+        prompt_replace.assert_called_once_with("e", [(0, 1)], "e", "ZZ", 3, "test.xhtml")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+"""
+The rules run once over the TextBuffer of a file against the rules run node by node.
+
+clean.run_rules joins the texts of each lang with the sentinel and runs
+every rule once over the buffer. Each node has to come out the same as
+when the rules run on it alone, with the prompts of replace_text given
+the same answers and asked in the same order.
+"""
+
+import random
+import unittest
+from types import SimpleNamespace
+
+import support  # noqa: F401
+import clean
+from textbuffer import TextBuffer, sentinel
+
+handlers = [(rule.name, rule.handler) for rule in clean.clean_rules.values()]
+
+def get_answer(prompts):
+    """Answer the same for a key wherever it is asked, the prompts are added to the list."""
+    def answer(node_idx, line_num, key, entry, text, spans):
+        prompts.append((node_idx, key, text, spans))
+        return 'y' if len(key) > 1 else 'n'
+    return answer
+
+def get_nodes(texts, langs):
+    return [SimpleNamespace(text=text, lang=lang, line=idx + 1) for idx, (text, lang) in enumerate(zip(texts, langs))]
+
+def run_rules_per_node(nodes, file_path, answer):
+    results = []
+    for idx, node in enumerate(nodes):
+        text = node.text
+        for name, handler in handlers:
+            if name == "replace_text":
+                text = handler(text, node.lang, node.line, file_path, False,
+                               lambda *prompt: answer(idx, node.line, *prompt))
+            else:
+                text = handler(text, node.lang, node.line, file_path, False)
+        results.append(text)
+    return results
+
+# Nodes whose ends would be changed by a rule if the node next to them was part of the same text
+boundary_cases = [
+    ["中 ", "a"], ["中", " a"], ["a ", "中"], ["a", " 中"],
+    ["1 ", " 2"], ["1", " 2"], ["1 .", "2"], ["1", ". 2"], ["10 ", ". 1"],
+    ["中 ", ","], ["中", ", )"], ["中 ", ")"], ["中", ";"], ["(", " 中"], ["( ", "中"],
+    ["。 ", " 。"], ["。", "。"], ["「 ", "」"], ["中 。", " a"],
+    ["一", "一"], ["一", "一一"], ["著", "一"], ["晩", ""],
+    ["", "", "中 a"], [" ", "中", " "], ["a  1", "中"], ["中 a 中", "a 中 a"],
+    ["中 ,", "", ") ;"], ["1 2 3", "4 5"], ["。 。 。", "。 。"],
+]
+langs = ["zh-Hant", "zh-Hans", "zh", "en", ""]
+
+# Characters the rules and the replacement keys look at, and more than one kind of space
+alphabet = (list("中文字說") + list("一著晩") + list("aZ09") + list("123") + [' '] * 4 + ['\n', '\t', '　']
+            + list("。，「」（）…；") + list(",();.") + list("-x"))
+
+class TextBufferRulesTest(unittest.TestCase):
+    def assert_same(self, texts, langs):
+        nodes = get_nodes(texts, langs)
+        prompts, expected_prompts = [], []
+        self.assertEqual(clean.run_rules(handlers, nodes, "test.xhtml", get_answer(prompts)),
+                         run_rules_per_node(nodes, "test.xhtml", get_answer(expected_prompts)),
+                         f"rules on {texts!r} in {langs!r}")
+        # The prompts come in the order of the nodes, also when their langs are mixed
+        self.assertEqual(prompts, expected_prompts, f"prompts on {texts!r} in {langs!r}")
+
+    def test_boundary_cases(self):
+        for texts in boundary_cases:
+            for lang in langs:
+                self.assert_same(texts, [lang] * len(texts))
+
+    def test_random_nodes(self):
+        rnd = random.Random(22)
+        for _ in range(2000):
+            count = rnd.randint(1, 6)
+            texts = [''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 12))) for _ in range(count)]
+            # Mostly one lang, a file can have nodes of other langs between them
+            node_langs = [rnd.choice(langs) if rnd.random() < 0.2 else "zh-Hant" for _ in range(count)]
+            self.assert_same(texts, node_langs)
+
+    def test_prompts_of_mixed_langs(self):
+        texts = ["一一", "著一一", "中 一一", "一一 a", "一一"]
+        self.assert_same(texts, ["zh-Hans", "zh-Hant", "zh-Hans", "zh", "zh-Hant"])
+        self.assert_same(texts + ["1\x00一一"], ["zh-Hans", "zh-Hant", "zh", "zh-Hans", "zh-Hant", "zh"])
+
+    def test_texts_with_the_sentinel_go_node_by_node(self):
+        texts = ["中 a", "1\x00 2", "a 中"]
+        self.assert_same(texts, ["zh-Hant"] * len(texts))
+
+class TextBufferTest(unittest.TestCase):
+    def test_node_at(self):
+        buffer = TextBuffer(["ab", "", "c"])
+        self.assertEqual([buffer.node_at(position) for position in range(len(buffer.text))], [0, 0, 0, 1, 2])
+
+    def test_apply_is_per_node(self):
+        buffer = TextBuffer(["中 ", "a", "1 ", " 2"])
+        buffer.apply(clean.chinese_spacing, "zh-Hant")
+        buffer.apply(clean.number_spacing, "zh-Hant")
+        self.assertEqual(buffer.split(), ["中 ", "a", "1 ", " 2"])
+
+    def test_changed_separators_are_rejected(self):
+        buffer = TextBuffer(["a", "b"])
+        with self.assertRaises(ValueError):
+            buffer.apply(lambda text: text.replace(sentinel, ''))
+        with self.assertRaises(ValueError):
+            TextBuffer(["a" + sentinel])
+
+if __name__ == "__main__":
+    unittest.main()